@@ -0,0 +1,70 @@
+"""
+Load shedding by priority. When requests start waiting for database connections, reports and
+history go first, then logins and pings, so that /join-session and session setup keep working
+while a class is starting.
+"""
+from db import pool_pressure
+import json
+import os
+
+CRITICAL, NORMAL, LOW = 0, 1, 2
+
+CRITICAL_PATHS = {"/join-session", "/active-sessions", "/create-session", "/add-locations"}
+
+LOW_PATHS = {
+    "/get-attendance", "/check-attendance", "/get-sessions-created", "/my-sessions",
+    "/get-attended-sessions", "/get-session-attendees",
+}
+LOW_PREFIXES = ("/bulk/", "/reports")
+
+# Never shed, monitoring is how an overload gets seen
+EXEMPT_PATHS = {
+    "/hello", "/robots.txt", "/metrics", "/debug/profile", "/pool-stats", "/ingest-stats", "/password-stats",
+    "/auth-stats", "/session-cache-stats", "/presence-stats", "/admission-stats", "/report-stats",
+}
+
+# Seconds of average pool wait above which each priority is turned away
+SHED_LOW_WAIT = float(os.getenv("SHED_LOW_WAIT", "0.05"))
+SHED_NORMAL_WAIT = float(os.getenv("SHED_NORMAL_WAIT", "0.5"))
+
+BUSY = json.dumps({"detail": "Server is busy, retry later"}).encode()
+
+stats = {"shed_low": 0, "shed_normal": 0}
+
+def priority(path):
+    if path in CRITICAL_PATHS:
+        return CRITICAL
+    if path in LOW_PATHS or path.startswith(LOW_PREFIXES):
+        return LOW
+    return NORMAL
+
+def admit(level):
+    if level == CRITICAL:
+        return True
+    wait = pool_pressure()
+    if level == LOW and wait > SHED_LOW_WAIT:
+        stats["shed_low"] += 1
+        return False
+    if level == NORMAL and wait > SHED_NORMAL_WAIT:
+        stats["shed_normal"] += 1
+        return False
+    return True
+
+def admission_metrics():
+    return {"pool_wait_average": pool_pressure(), "shed_low_wait": SHED_LOW_WAIT, "shed_normal_wait": SHED_NORMAL_WAIT, **stats}
+
+class AdmissionMiddleware:
+    """ASGI middleware answering 503 before the app runs when the request's priority is being shed"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS or admit(priority(scope["path"])):
+            return await self.app(scope, receive, send)
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(BUSY)).encode()), (b"retry-after", b"2")],
+        })
+        await send({"type": "http.response.body", "body": BUSY})
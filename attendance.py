@@ -0,0 +1,138 @@
+from collections import namedtuple
+from geofence import EARTH_RADIUS_M
+import metrics
+
+# numpy is imported by the functions scoring raw pings: only rebuilds and checks do, requests read
+# the stored scores, and it would add a tenth of a second to every worker's start
+
+# Share of a session's pings that must fall inside its geofence to be marked present
+PRESENCE_THRESHOLD = 0.8
+
+# Sessions starting before this have had their pings dropped by retention.py, only their scores remain
+RETAINED_SINCE = "(select coalesce(max(DroppedBefore), '-infinity'::timestamp) from PingRetention)"
+
+# Every location of every ended session the student joined that still has its pings, optionally
+# limited to one admin or session
+SESSION_LOCATIONS = """
+select s.SessionID, extract(epoch from s.StartTime)::float8, extract(epoch from s.EndTime)::float8, s.GeofenceRadius,
+       sl.Latitude::float8, sl.Longitude::float8, s.StartTime, s.EndTime
+from SessionLocations sl
+join Sessions s on s.SessionID=sl.SessionID
+join Attended_By ab on ab.SessionID=s.SessionID
+where ab.UniqueID=%(student_id)s and s.EndTime<=%(time_now)s and (%(admin_id)s::int is null or s.AdminID=%(admin_id)s)
+and (%(session_id)s::int is null or s.SessionID=%(session_id)s) and s.StartTime>=""" + RETAINED_SINCE + """
+order by s.SessionID;
+"""
+
+# Only the pings that fall inside one of the (merged) session windows. The first/last bounds let
+# Postgres skip the monthly partitions that cannot hold any of them. A dwell row (dwell.py) stands
+# for PingCount pings at its first ping's time and position.
+WINDOW_PINGS = """
+select extract(epoch from al.LocationTimestamp)::float8, al.Latitude::float8, al.Longitude::float8, al.PingCount::float8
+from AttendeesLocations al
+where al.UniqueID=%(student_id)s and al.LocationTimestamp between %(first)s and %(last)s
+and exists (select 1 from unnest(%(starts)s::timestamp[], %(ends)s::timestamp[]) w(s, e) where al.LocationTimestamp between w.s and w.e)
+order by al.LocationTimestamp;
+"""
+
+# Counters kept up to date by scores.py, ended sessions only
+STORED_SCORES = """
+select sc.SessionID, sc.InRange, sc.Total
+from AttendanceScores sc
+join Sessions s on s.SessionID=sc.SessionID
+where sc.UniqueID=%(student_id)s and sc.Total>0 and s.EndTime<=%(time_now)s and (%(admin_id)s::int is null or s.AdminID=%(admin_id)s)
+order by sc.SessionID;
+"""
+
+SessionWindow = namedtuple("SessionWindow", ["session_id", "start", "end", "radius", "latitudes", "longitudes", "start_time", "end_time"])
+
+def group_sessions(rows):
+    """Collapse one-row-per-location results into one SessionWindow per session, locations in radians"""
+    import numpy as np
+
+    sessions = []
+    for row in rows:
+        if not sessions or sessions[-1].session_id != row[0]:
+            sessions.append(SessionWindow(row[0], row[1], row[2], float(row[3]), [], [], row[6], row[7]))
+        sessions[-1].latitudes.append(row[4])
+        sessions[-1].longitudes.append(row[5])
+    return [s._replace(latitudes=np.radians(s.latitudes), longitudes=np.radians(s.longitudes)) for s in sessions]
+
+def merge_windows(sessions):
+    """Sweep the session windows in start order and merge the overlapping ones"""
+    merged = []
+    for session in sorted(sessions, key=lambda s: s.start_time):
+        if merged and session.start_time <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], session.end_time)
+        else:
+            merged.append([session.start_time, session.end_time])
+    return merged
+
+def score_pings(sessions, times, latitudes, longitudes, counts=None):
+    """
+    Count (in range, total) pings for every session from ping arrays sorted by time, each ping
+    weighted by counts when given.
+
+    Each session's pings are a contiguous slice found by binary search on the window bounds, and
+    the haversine distance from that slice to each session location is computed in one array
+    operation, so the cost is O(sessions * (log N + pings in window * locations)).
+    """
+    import numpy as np
+
+    latitudes = np.radians(latitudes)
+    longitudes = np.radians(longitudes)
+    cos_latitudes = np.cos(latitudes)
+    scores = {}
+    for session in sessions:
+        lo = np.searchsorted(times, session.start, side="left")
+        hi = np.searchsorted(times, session.end, side="right")
+        if hi <= lo:
+            continue
+
+        ping_lat = latitudes[lo:hi]
+        ping_lon = longitudes[lo:hi]
+        ping_cos = cos_latitudes[lo:hi]
+        inside = np.zeros(hi - lo, dtype=bool)
+        for location_lat, location_lon in zip(session.latitudes, session.longitudes):
+            a = np.sin((location_lat - ping_lat) / 2) ** 2 + ping_cos * np.cos(location_lat) * np.sin((location_lon - ping_lon) / 2) ** 2
+            inside |= 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a))) <= session.radius
+        if counts is None:
+            scores[session.session_id] = (int(inside.sum()), int(hi - lo))
+        else:
+            weights = counts[lo:hi]
+            scores[session.session_id] = (int(weights[inside].sum()), int(weights.sum()))
+    return scores
+
+def verdicts(scores):
+    return {session_id: in_range / total >= PRESENCE_THRESHOLD for session_id, (in_range, total) in scores.items()}
+
+async def fetch_scores(control, student_id, time_now, admin_id=None, session_id=None):
+    """{SessionID: (in range, total)} computed from the raw pings"""
+    import numpy as np
+
+    await control.execute(SESSION_LOCATIONS, {"student_id": student_id, "time_now": time_now, "admin_id": admin_id, "session_id": session_id})
+    sessions = group_sessions(await control.fetchall())
+    if not sessions:
+        return {}
+
+    windows = merge_windows(sessions)
+    await control.execute(WINDOW_PINGS, {
+        "student_id": student_id,
+        "first": windows[0][0],
+        "last": windows[-1][1],
+        "starts": [w[0] for w in windows],
+        "ends": [w[1] for w in windows],
+    })
+    rows = await control.fetchall()
+    with metrics.timed("score_sessions"):
+        pings = np.array(rows, dtype=np.float64).reshape(-1, 4)
+        return score_pings(sessions, pings[:, 0], pings[:, 1], pings[:, 2], pings[:, 3])
+
+async def stored_scores(control, student_id, time_now, admin_id=None):
+    """{SessionID: (in range, total)} as materialized in AttendanceScores"""
+    await control.execute(STORED_SCORES, {"student_id": student_id, "time_now": time_now, "admin_id": admin_id})
+    return {row[0]: (row[1], row[2]) for row in await control.fetchall()}
+
+async def student_attendance(control, student_id, time_now, admin_id=None):
+    """{SessionID: present} for every ended session the student joined and sent pings during"""
+    return verdicts(await stored_scores(control, student_id, time_now, admin_id))
@@ -10,7 +10,8 @@ CREATE TABLE Sessions (
     SessionID SERIAL PRIMARY KEY,
     StartTime TIMESTAMP,
     EndTime TIMESTAMP,
-    AdminID INT REFERENCES Admins(AdminID)
+    AdminID INT REFERENCES Admins(AdminID),
+    GeofenceRadius REAL DEFAULT 100 -- metres around each session location
 );
 
 CREATE TABLE Attendees (
@@ -22,12 +23,18 @@ CREATE TABLE Attendees (
     Address VARCHAR(100)
 );
 
+-- Append-only ping log, one partition per month, see ensure_ping_partitions below. A dwell row
+-- (dwell.py) stands for PingCount pings at one position up to EndTimestamp, the time of its last
+-- ping, equal to LocationTimestamp while it holds a single ping. Pings stored without dwell.py
+-- (compression off, batched uploads, rows older than migration 0007) leave EndTimestamp NULL.
 CREATE TABLE AttendeesLocations (
     LocationTimestamp TIMESTAMP,
     Longitude NUMERIC(9, 6),
     Latitude NUMERIC(8, 6),
-    UniqueID INT REFERENCES Attendees(UniqueID)
-);
+    UniqueID INT REFERENCES Attendees(UniqueID),
+    EndTimestamp TIMESTAMP,
+    PingCount INT NOT NULL DEFAULT 1
+) PARTITION BY RANGE (LocationTimestamp);
 
 CREATE TABLE SessionLocations (
     Address VARCHAR(100),
@@ -43,6 +50,63 @@ CREATE TABLE Attended_By (
     PRIMARY KEY (SessionID, UniqueID)
 );
 
+-- Pings of each joined session inside and outside its geofence, maintained by scores.py
+CREATE TABLE AttendanceScores (
+    UniqueID INT REFERENCES Attendees(UniqueID),
+    SessionID INT REFERENCES Sessions(SessionID),
+    InRange INT NOT NULL DEFAULT 0,
+    Total INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (UniqueID, SessionID)
+);
+
+-- Pings older than the latest DroppedBefore are gone, only their AttendanceScores are kept
+CREATE TABLE PingRetention (
+    DroppedBefore TIMESTAMP PRIMARY KEY,
+    DroppedAt TIMESTAMP DEFAULT now()
+);
+
+-- Token buckets shared by the workers when RATE_LIMIT_BACKEND=postgres, losing them only resets the limits
+CREATE UNLOGGED TABLE RateLimits (
+    Key VARCHAR(300) PRIMARY KEY,
+    Tokens DOUBLE PRECISION NOT NULL,
+    UpdatedAt TIMESTAMP NOT NULL,
+    Allowed BOOLEAN NOT NULL
+);
+
+-- Highest sequence number stored per attendee and device by the batched ping upload, see uploads.py
+CREATE TABLE PingUploads (
+    UniqueID INT NOT NULL REFERENCES Attendees(UniqueID),
+    Device VARCHAR(64) NOT NULL,
+    LastSeq BIGINT NOT NULL,
+    UpdatedAt TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (UniqueID, Device)
+);
+
+-- Attendance report jobs shared by the workers, see reports.py
+CREATE TABLE ReportJobs (
+    JobID SERIAL PRIMARY KEY,
+    AdminID INT NOT NULL REFERENCES Admins(AdminID),
+    Status VARCHAR(10) NOT NULL DEFAULT 'queued',
+    Fingerprint VARCHAR(100),
+    ReportTime TIMESTAMP NOT NULL,
+    SessionsDone INT NOT NULL DEFAULT 0,
+    SessionsTotal INT,
+    CreatedAt TIMESTAMP NOT NULL DEFAULT now(),
+    StartedAt TIMESTAMP,
+    FinishedAt TIMESTAMP,
+    Error TEXT,
+    Result JSONB
+);
+CREATE INDEX reportjobs_admin_fingerprint ON ReportJobs (AdminID, Fingerprint);
+CREATE INDEX reportjobs_pending ON ReportJobs (JobID) WHERE Status IN ('queued', 'running');
+
+-- Indexes behind the attendance, active session and history queries (migrations/0003)
+CREATE INDEX attendeeslocations_attendee_time ON AttendeesLocations (UniqueID, LocationTimestamp) INCLUDE (Latitude, Longitude, PingCount);
+CREATE INDEX attendeeslocations_time_brin ON AttendeesLocations USING BRIN (LocationTimestamp);
+CREATE INDEX sessions_end_start ON Sessions (EndTime, StartTime);
+CREATE INDEX sessions_admin_start_id ON Sessions (AdminID, StartTime DESC, SessionID DESC);
+CREATE INDEX attended_by_attendee ON Attended_By (UniqueID, SessionID);
+
 -- Stored procedure for GetSessionDetails
 CREATE OR REPLACE PROCEDURE GetSessionDetails(
     IN admin_id INT,
@@ -115,4 +179,124 @@ $$ LANGUAGE plpgsql;
 CREATE TRIGGER validate_attendees_location
 BEFORE INSERT ON AttendeesLocations
 FOR EACH ROW
-EXECUTE FUNCTION validate_attendees_location();
\ No newline at end of file
+EXECUTE FUNCTION validate_attendees_location();
+
+-- Creates the missing monthly partitions between first_ts and last_ts. There is no default
+-- partition, it would rule out DETACH PARTITION CONCURRENTLY in retention.py.
+CREATE OR REPLACE FUNCTION ensure_ping_partitions(first_ts TIMESTAMP, last_ts TIMESTAMP)
+RETURNS INT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', first_ts);
+    part_name TEXT;
+    created INT := 0;
+BEGIN
+    -- Several workers run this on startup
+    PERFORM pg_advisory_xact_lock(hashtext('attendeeslocations_partitions'));
+    WHILE month_start <= last_ts LOOP
+        part_name := 'attendeeslocations_p' || to_char(month_start, 'YYYYMM');
+        IF to_regclass(part_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I (LIKE AttendeesLocations INCLUDING DEFAULTS)', part_name);
+            EXECUTE format(
+                'ALTER TABLE AttendeesLocations ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                part_name, month_start, month_start + interval '1 month'
+            );
+            created := created + 1;
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+-- Great-circle distance in metres, the same formula and earth radius as geofence.haversine_m
+CREATE OR REPLACE FUNCTION haversine_m(lat1 FLOAT8, lon1 FLOAT8, lat2 FLOAT8, lon2 FLOAT8)
+RETURNS FLOAT8
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$
+    SELECT 2 * 6371008.8 * asin(least(1.0, sqrt(
+        sin((radians(lat2) - radians(lat1)) / 2) ^ 2
+        + cos(radians(lat1)) * cos(radians(lat2)) * sin((radians(lon2) - radians(lon1)) / 2) ^ 2)))
+$$;
+
+-- Checks the attendee, that the session is running at p_now and that the position is inside its
+-- geofence, then records the join, its ping and the session's score from the pings sent before
+-- joining, and notifies p_channel when given. Returns joined, already_joined, no_attendee,
+-- no_session, not_active, no_location or outside, nothing is written unless it is joined.
+CREATE OR REPLACE FUNCTION join_session(p_attendee INT, p_session INT, p_latitude FLOAT8, p_longitude FLOAT8,
+                                        p_now TIMESTAMP, p_channel TEXT DEFAULT NULL, p_payload TEXT DEFAULT NULL)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    s RECORD;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM Attendees WHERE UniqueID = p_attendee) THEN
+        RETURN 'no_attendee';
+    END IF;
+    SELECT StartTime, EndTime, GeofenceRadius INTO s FROM Sessions WHERE SessionID = p_session;
+    IF NOT FOUND THEN
+        RETURN 'no_session';
+    END IF;
+    IF p_now < s.StartTime OR p_now > s.EndTime THEN
+        RETURN 'not_active';
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM SessionLocations WHERE SessionID = p_session) THEN
+        RETURN 'no_location';
+    END IF;
+    IF NOT EXISTS (
+        SELECT 1 FROM SessionLocations sl
+        WHERE sl.SessionID = p_session
+        AND haversine_m(p_latitude, p_longitude, sl.Latitude::float8, sl.Longitude::float8) <= s.GeofenceRadius
+    ) THEN
+        RETURN 'outside';
+    END IF;
+
+    INSERT INTO Attended_By (UniqueID, SessionID) VALUES (p_attendee, p_session) ON CONFLICT DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN 'already_joined';
+    END IF;
+    INSERT INTO AttendeesLocations (LocationTimestamp, Longitude, Latitude, UniqueID)
+    VALUES (p_now, p_longitude, p_latitude, p_attendee);
+
+    -- Pings sent during the session before joining count towards it too, as in scores.rebuild_scores
+    INSERT INTO AttendanceScores (SessionID, UniqueID, InRange, Total)
+    SELECT p_session, p_attendee,
+           coalesce(sum(CASE WHEN EXISTS (
+               SELECT 1 FROM SessionLocations sl
+               WHERE sl.SessionID = p_session
+               AND haversine_m(al.Latitude::float8, al.Longitude::float8, sl.Latitude::float8, sl.Longitude::float8) <= s.GeofenceRadius
+           ) THEN al.PingCount ELSE 0 END), 0),
+           coalesce(sum(al.PingCount), 0)
+    FROM AttendeesLocations al
+    WHERE al.UniqueID = p_attendee AND al.LocationTimestamp BETWEEN s.StartTime AND s.EndTime
+    ON CONFLICT (UniqueID, SessionID) DO UPDATE SET InRange = excluded.InRange, Total = excluded.Total;
+
+    IF p_channel IS NOT NULL THEN
+        PERFORM pg_notify(p_channel, p_payload);
+    END IF;
+    RETURN 'joined';
+END;
+$$;
+
+SELECT ensure_ping_partitions(now()::timestamp, now()::timestamp + interval '2 months');
+
+-- Migrations already contained in this script, see migrate.py
+CREATE TABLE SchemaMigrations (
+    Version VARCHAR(100) PRIMARY KEY,
+    AppliedAt TIMESTAMP DEFAULT now()
+);
+
+INSERT INTO SchemaMigrations (Version) VALUES
+    ('0001_session_geofence_radius.sql'),
+    ('0002_attendance_scores.sql'),
+    ('0003_query_indexes.sql'),
+    ('0004_partition_attendees_locations.sql'),
+    ('0005_history_keyset_index.sql'),
+    ('0006_rate_limits.sql'),
+    ('0007_ping_dwells.sql'),
+    ('0008_join_session_function.sql'),
+    ('0009_report_jobs.sql'),
+    ('0010_ping_uploads.sql'),
+    ('0011_drop_default_ping_partition.sql');
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from fastapi import HTTPException, status
+from db import get_connection, get_cursor
+from jose import jwt
+from datetime import datetime, timedelta
+from pytz import timezone
+import hashlib
+import metrics
+import os
+import time
+
+ALGORITHM = 'HS256'
+
+def create_jwt_token(data: dict):
+    to_encode = data.copy()
+    # Add 14 days to the current time in IST and format the result
+    exp_time = datetime.now(timezone("Asia/Kolkata")) + timedelta(days=14)
+    to_encode.update({"exp": exp_time})
+    encoded_jwt = jwt.encode(to_encode, os.getenv("JWT_SECRET"), algorithm=ALGORITHM)
+    return encoded_jwt
+
+class ExpiringCache:
+    """LRU mapping whose entries also expire at their own deadline (time.time() seconds)"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[0]
+
+    def put(self, key, value, expires_at):
+        if expires_at <= time.time() or self.max_size <= 0:
+            return
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def metrics(self):
+        return {"size": len(self.entries), "max_size": self.max_size, **self.stats}
+
+# Verified claims by token digest, so a client sending the same token does not pay an HMAC per request
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+token_cache = ExpiringCache(int(os.getenv("TOKEN_CACHE_SIZE", "100000")))
+
+# (role, id) -> whether the admin or attendee exists, so pings skip the existence query
+ID_CACHE_TTL = float(os.getenv("ID_CACHE_TTL", "60"))
+known_ids = ExpiringCache(int(os.getenv("ID_CACHE_SIZE", "100000")))
+
+USER_TABLES = {
+    "admin": ("SELECT 1 FROM Admins WHERE AdminID = %s;", "Admin does not exist"),
+    "attendee": ("SELECT 1 FROM Attendees WHERE UniqueID = %s;", "Attendee does not exist"),
+}
+
+def decode_jwt_token(tok: str):
+    key = hashlib.sha256(tok.encode('utf-8')).digest()
+    claims = token_cache.get(key)
+    if claims is not None:
+        return claims
+
+    with metrics.timed("jwt_decode"):
+        claims = jwt.decode(tok, os.getenv("JWT_SECRET"), algorithms=[ALGORITHM])
+    # Never keep a token past its own expiry
+    expires_at = time.time() + TOKEN_CACHE_TTL
+    if "exp" in claims:
+        expires_at = min(expires_at, float(claims["exp"]))
+    token_cache.put(key, claims, expires_at)
+    return claims
+
+async def require_user(role, user_id, control=None):
+    """
+    404 unless the admin or attendee exists. The database is only asked on a cache miss, on
+    control if the handler already has a cursor, otherwise on a connection of its own.
+    """
+    query, missing = USER_TABLES[role]
+    exists = known_ids.get((role, user_id))
+    if exists is None:
+        if control is None:
+            async with get_connection() as connection:
+                async with get_cursor(connection) as control:
+                    await control.execute(query, (user_id,))
+                    exists = await control.fetchone() is not None
+        else:
+            await control.execute(query, (user_id,))
+            exists = await control.fetchone() is not None
+        known_ids.put((role, user_id), exists, time.time() + ID_CACHE_TTL)
+
+    if not exists:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=missing)
+
+def forget_user(role, user_id):
+    # A new registration may reuse an id that was cached as missing
+    known_ids.discard((role, user_id))
+
+def auth_metrics():
+    return {"tokens": token_cache.metrics(), "ids": known_ids.metrics()}
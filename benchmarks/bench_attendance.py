@@ -0,0 +1,101 @@
+"""
+Attendance computation over synthetic semesters: the per-ping, per-session Python loop the
+attendance endpoints used to run against the sorted-array engine in attendance.py.
+
+Pings are spread over the semester with a share of them inside session windows, a share of those
+outside the geofence. The old loop is only timed up to --legacy-max pings since it is O(N*M).
+
+python benchmarks/bench_attendance.py --pings 10000,100000,1000000
+"""
+from datetime import datetime, timedelta
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+from attendance import SessionWindow, score_pings, verdicts
+from geofence import GeofenceIndex
+
+def make_semester(rng, sessions_count, locations_per_session, radius):
+    epoch = datetime(2024, 1, 1)
+    sessions = []
+    for sid in range(1, sessions_count + 1):
+        start = epoch + timedelta(hours=6 * sid)
+        end = start + timedelta(hours=1)
+        lats = [12.97 + rng.uniform(-0.01, 0.01) for _ in range(locations_per_session)]
+        lons = [77.59 + rng.uniform(-0.01, 0.01) for _ in range(locations_per_session)]
+        sessions.append((sid, start, end, radius, lats, lons))
+    return epoch, sessions
+
+def make_pings(rng, count, epoch, sessions):
+    span = (sessions[-1][2] - epoch).total_seconds()
+    pings = []
+    for _ in range(count):
+        if rng.random() < 0.7:
+            sid, start, end, radius, lats, lons = rng.choice(sessions)
+            ts = start + timedelta(seconds=rng.uniform(0, (end - start).total_seconds()))
+            k = rng.randrange(len(lats))
+            jitter = 0.0002 if rng.random() < 0.85 else 0.01
+            pings.append((ts, lats[k] + rng.uniform(-jitter, jitter), lons[k] + rng.uniform(-jitter, jitter)))
+        else:
+            ts = epoch + timedelta(seconds=rng.uniform(0, span))
+            pings.append((ts, 12.97 + rng.uniform(-0.05, 0.05), 77.59 + rng.uniform(-0.05, 0.05)))
+    pings.sort()
+    return pings
+
+def legacy(sessions, pings):
+    windows = {sid: (start, end) for sid, start, end, radius, lats, lons in sessions}
+    fences = {sid: GeofenceIndex(list(zip(lats, lons)), radius) for sid, start, end, radius, lats, lons in sessions}
+    satt = {}
+    for ts, lat, lon in pings:
+        temp = {}
+        for k in windows:
+            if windows[k][0] <= ts <= windows[k][1]:
+                temp[k] = 1 if fences[k].contains(lat, lon) else 0
+        for k in temp:
+            satt.setdefault(k, [0, 0])
+            satt[k][0] += temp[k]
+            satt[k][1] += 1
+    return {k: (v[0] / v[1]) >= 0.8 for k, v in satt.items()}
+
+def engine(sessions, pings):
+    windows = [SessionWindow(sid, start.timestamp(), end.timestamp(), radius, np.radians(lats), np.radians(lons), start, end)
+               for sid, start, end, radius, lats, lons in sessions]
+    # The endpoints get these columns straight from Postgres as float8
+    arrays = np.array([(ts.timestamp(), lat, lon) for ts, lat, lon in pings], dtype=np.float64).reshape(-1, 3)
+    return verdicts(score_pings(windows, arrays[:, 0], arrays[:, 1], arrays[:, 2]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pings", default="10000,100000,1000000")
+    parser.add_argument("--sessions", type=int, default=120)
+    parser.add_argument("--locations", type=int, default=3)
+    parser.add_argument("--radius", type=float, default=50.0)
+    parser.add_argument("--legacy-max", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    epoch, sessions = make_semester(rng, args.sessions, args.locations, args.radius)
+    for count in (int(x) for x in args.pings.split(",")):
+        pings = make_pings(rng, count, epoch, sessions)
+
+        start = time.perf_counter()
+        fast = engine(sessions, pings)
+        fast_time = time.perf_counter() - start
+        line = f"{count:8d} pings, {args.sessions} sessions: engine {fast_time * 1000:9.1f} ms"
+
+        if count <= args.legacy_max:
+            start = time.perf_counter()
+            slow = legacy(sessions, pings)
+            slow_time = time.perf_counter() - start
+            assert slow == fast, "engine and loop disagree"
+            line += f"  loop {slow_time * 1000:9.1f} ms  speedup {slow_time / fast_time:6.1f}x"
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Onboarding a term of attendees: one /auth/register-attendee style round trip per student (existence
+check, bcrypt, single-row insert) against the chunked COPY import in bulk.py fed a CSV stream.
+
+Runs in a scratch schema built from attendance_db_postgres.sql and dropped afterwards. A low
+--rounds keeps bcrypt from hiding the database side, both paths hash on the same process pool.
+The peak Python memory of the bulk import is reported to show it does not grow with the file.
+
+python benchmarks/bench_bulk_import.py --dsn "$SQL_URL" --rows 1000,10000,100000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import psycopg
+
+SCHEMA = "bench_bulk"
+SCHEMA_SQL = os.path.join(os.path.dirname(__file__), "..", "attendance_db_postgres.sql")
+
+def prepare(dsn):
+    with psycopg.connect(dsn) as connection:
+        connection.execute(f"drop schema if exists {SCHEMA} cascade; create schema {SCHEMA}; set search_path to {SCHEMA};")
+        with open(SCHEMA_SQL) as f:
+            connection.execute(f.read())
+
+def drop(dsn):
+    with psycopg.connect(dsn) as connection:
+        connection.execute(f"drop schema if exists {SCHEMA} cascade;")
+
+async def csv_stream(prefix, count, chunk_rows=500):
+    """The request body as a client would send it, a few hundred rows per network read"""
+    yield b"email,fname,lname,password,address\n"
+    for start in range(0, count, chunk_rows):
+        yield "".join(f"{prefix}{i}@example.com,First,Last,secret{i},Campus\n" for i in range(start, min(count, start + chunk_rows))).encode()
+
+async def per_row(prefix, count, concurrency):
+    import passwords
+    from db import get_connection, get_cursor
+    gate = asyncio.Semaphore(concurrency)
+
+    async def register(i):
+        async with gate:
+            async with get_connection() as connection:
+                async with get_cursor(connection) as control:
+                    email = f"{prefix}{i}@example.com"
+                    await control.execute("SELECT 1 FROM Attendees WHERE Email = %s;", (email,))
+                    if await control.fetchone():
+                        return
+                    hashed = await passwords.hasher.run(passwords.hash_password, f"secret{i}", passwords.hasher.rounds, shed=False)
+                    await control.execute(
+                        "INSERT INTO Attendees (Email, Fname, Lname, Passwd, Address) VALUES (%s, %s, %s, %s, %s) RETURNING UniqueID;",
+                        (email, "First", "Last", hashed, "Campus")
+                    )
+                    await connection.commit()
+
+    await asyncio.gather(*(register(i) for i in range(count)))
+
+async def run(args):
+    import bulk
+    import db
+    import passwords
+
+    await db.open_pool()
+    passwords.hasher = passwords.PasswordHasher(workers=args.workers, rounds=args.rounds)
+    await passwords.hasher.start()
+    try:
+        for count in (int(x) for x in args.rows.split(",")):
+            line = f"{count:7d} rows:"
+            if count <= args.per_row_max:
+                start = time.perf_counter()
+                await per_row(f"single{count}_", count, args.concurrency)
+                elapsed = time.perf_counter() - start
+                line += f"  per row {count / elapsed:9.1f} rows/s"
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            report = await bulk.import_attendees(bulk.read_records(csv_stream(f"bulk{count}_", count), "text/csv"))
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            assert report["inserted"] == count, report
+            line += f"  bulk {count / elapsed:9.1f} rows/s  peak memory {peak / 2 ** 20:6.1f} MiB"
+            print(line)
+    finally:
+        await passwords.hasher.stop()
+        await db.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True)
+    parser.add_argument("--rows", default="1000,10000,100000")
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--concurrency", type=int, default=40, help="in-flight requests for the per-row path")
+    parser.add_argument("--per-row-max", type=int, default=10000)
+    args = parser.parse_args()
+
+    prepare(args.dsn)
+    # The app's pool reads SQL_URL, PGOPTIONS points every connection at the scratch schema
+    os.environ["SQL_URL"] = args.dsn
+    os.environ["PGOPTIONS"] = f"-c search_path={SCHEMA}"
+    try:
+        asyncio.run(run(args))
+    finally:
+        os.environ.pop("PGOPTIONS")
+        drop(args.dsn)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Load benchmark for the data-access layer: the old psycopg2 SimpleConnectionPool driven from a
+threadpool (how sync FastAPI handlers run) against the async psycopg pool in db.py.
+
+Each simulated request does what /current-location does on the database: an attendee existence
+check followed by a short server-side delay standing in for the insert.
+
+python benchmarks/bench_db_pool.py --dsn "$SQL_URL" --requests 5000 --concurrency 1000
+"""
+from concurrent.futures import ThreadPoolExecutor
+from psycopg_pool import AsyncConnectionPool
+from psycopg2 import pool as sync_pool
+import argparse
+import asyncio
+import statistics
+import time
+
+QUERY = "select 1 from Attendees where UniqueID=%s;"
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def report(name, latencies, errors, elapsed):
+    done = len(latencies)
+    print(f"{name:>6}: {done / elapsed:8.1f} req/s  "
+          f"p50 {percentile(latencies, 50) * 1000:7.2f} ms  "
+          f"p99 {percentile(latencies, 99) * 1000:7.2f} ms  "
+          f"mean {statistics.mean(latencies) * 1000:7.2f} ms  errors {errors}")
+
+def run_sync(args):
+    connection_pool = sync_pool.SimpleConnectionPool(1, args.pool_size, dsn=args.dsn)
+    latencies = []
+    errors = 0
+
+    def one_request(i):
+        start = time.perf_counter()
+        connection = connection_pool.getconn()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(QUERY, (i % 1000,))
+            cursor.fetchone()
+            cursor.execute("select pg_sleep(%s);", (args.sleep_ms / 1000,))
+            connection.commit()
+            cursor.close()
+        finally:
+            connection_pool.putconn(connection)
+        return time.perf_counter() - start
+
+    # Starlette runs sync endpoints on a 40 thread limiter
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        futures = [executor.submit(one_request, i) for i in range(args.requests)]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                # SimpleConnectionPool raises once all connections are checked out
+                errors += 1
+    elapsed = time.perf_counter() - started
+    connection_pool.closeall()
+    report("sync", latencies, errors, elapsed)
+
+async def run_async(args):
+    connection_pool = AsyncConnectionPool(args.dsn, min_size=1, max_size=args.pool_size, timeout=30,
+                                          check=AsyncConnectionPool.check_connection, open=False)
+    await connection_pool.open(wait=True)
+    latencies = []
+    errors = 0
+    gate = asyncio.Semaphore(args.concurrency)
+
+    async def one_request(i):
+        nonlocal errors
+        async with gate:
+            start = time.perf_counter()
+            try:
+                async with connection_pool.connection() as connection:
+                    cursor = connection.cursor()
+                    await cursor.execute(QUERY, (i % 1000,))
+                    await cursor.fetchone()
+                    await cursor.execute("select pg_sleep(%s);", (args.sleep_ms / 1000,))
+                    await cursor.close()
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_request(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    await connection_pool.close()
+    report("async", latencies, errors, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=1000, help="in-flight requests for the async path")
+    parser.add_argument("--threads", type=int, default=40, help="worker threads for the sync path")
+    parser.add_argument("--pool-size", type=int, default=30)
+    parser.add_argument("--sleep-ms", type=float, default=2.0, help="simulated statement time")
+    args = parser.parse_args()
+
+    run_sync(args)
+    asyncio.run(run_async(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Dwell compression of pings (dwell.py) on a class day: rows stored with and without compression,
+the time attendance.score_pings takes on each, and a check that every attendee gets the same
+(in range, total) counts for every session from both.
+
+Traces are generated (students sitting in class with GPS jitter, walking between rooms) unless
+recorded ones are given: --trace with unique_id,timestamp,latitude,longitude rows in time order and
+--sessions-csv with session_id,start,end,radius,latitude,longitude rows, one per location, e.g.
+
+\\copy (select UniqueID, LocationTimestamp, Latitude, Longitude from AttendeesLocations where LocationTimestamp::date='2024-03-04' order by LocationTimestamp) to 'trace.csv' csv
+\\copy (select s.SessionID, s.StartTime, s.EndTime, s.GeofenceRadius, sl.Latitude, sl.Longitude from Sessions s join SessionLocations sl on sl.SessionID=s.SessionID where s.StartTime::date='2024-03-04') to 'sessions.csv' csv
+
+With --dsn both versions are also loaded into scratch tables to measure their size with the
+attendance index and the attendance query on each.
+
+python benchmarks/bench_dwell.py --students 2000 --interval 15
+python benchmarks/bench_dwell.py --trace trace.csv --sessions-csv sessions.csv --dsn "$SQL_URL"
+"""
+from datetime import datetime, timedelta
+from math import cos, radians, sin
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+from attendance import WINDOW_PINGS, SessionWindow, merge_windows, score_pings
+from dwell import DwellCompressor
+from sessions import group_sessions
+
+CAMPUS = (12.9716, 77.5946)
+
+def offset(lat, lon, north_m, east_m):
+    return lat + north_m / 111320.0, lon + east_m / (111320.0 * cos(radians(lat)))
+
+def make_day(rng, students, rooms, radius, interval, jitter):
+    """(session rows as sessions.group_sessions takes them, pings sorted by time)"""
+    day = datetime(2024, 3, 4, 9, 0)
+    places = [offset(*CAMPUS, rng.uniform(-400, 400), rng.uniform(-400, 400)) for _ in range(rooms)]
+    rows = []
+    slots = []
+    for hour in range(8):
+        start = day + timedelta(hours=hour)
+        end = start + timedelta(minutes=50)
+        slot = []
+        for room, (lat, lon) in enumerate(places):
+            session_id = hour * rooms + room + 1
+            rows.append((session_id, start, end, 0, radius, round(lat, 6), round(lon, 6)))
+            slot.append((session_id, lat, lon))
+        slots.append((start, end, slot))
+
+    pings = []
+    for unique_id in range(1, students + 1):
+        here = offset(*CAMPUS, rng.uniform(-400, 400), rng.uniform(-400, 400))
+        for start, end, slot in slots:
+            if rng.random() < 0.25:
+                # Skips this class and wanders about
+                seat = offset(*CAMPUS, rng.uniform(-500, 500), rng.uniform(-500, 500))
+            else:
+                _, lat, lon = rng.choice(slot)
+                # Most sit well inside the room, some close to or past the edge of the fence
+                distance = radius * min(1.3, abs(rng.gauss(0.5, 0.3)))
+                angle = rng.uniform(0, 6.2832)
+                seat = offset(lat, lon, distance * cos(angle), distance * sin(angle))
+            t = start - timedelta(minutes=10)
+            while t < end:
+                if t < start:
+                    # Walking over from the last room
+                    share = (t - (start - timedelta(minutes=10))).total_seconds() / 600
+                    position = (here[0] + (seat[0] - here[0]) * share, here[1] + (seat[1] - here[1]) * share)
+                else:
+                    position = seat
+                error = jitter * (8 if rng.random() < 0.03 else 1)
+                lat, lon = offset(*position, rng.gauss(0, error), rng.gauss(0, error))
+                pings.append((unique_id, lat, lon, t))
+                t += timedelta(seconds=interval * rng.uniform(0.8, 1.2))
+            here = seat
+    pings.sort(key=lambda p: p[3])
+    # Pings are stamped to the second
+    return rows, [(u, lat, lon, t.replace(microsecond=0)) for u, lat, lon, t in pings]
+
+def load_recorded(trace, sessions_csv):
+    with open(sessions_csv) as f:
+        rows = [(int(r[0]), datetime.fromisoformat(r[1]), datetime.fromisoformat(r[2]), 0, float(r[3]), float(r[4]), float(r[5])) for r in csv.reader(f)]
+    with open(trace) as f:
+        pings = [(int(r[0]), float(r[2]), float(r[3]), datetime.fromisoformat(r[1])) for r in csv.reader(f)]
+    pings.sort(key=lambda p: p[3])
+    return sorted(rows), pings
+
+def compress(pings, sessions, compressor, batch):
+    """Dwell rows as the ingest path leaves them, by applying plan() like the database would"""
+    table = []
+    written = {}
+    for i in range(0, len(pings), batch):
+        rows, extends = compressor.plan(pings[i:i + batch], sessions)
+        for unique_id, start, written_end, latitude, longitude, end, added, _ in extends:
+            row = written.pop((unique_id, start, written_end))
+            row[4] = end
+            row[5] += added
+            written[(unique_id, start, end)] = row
+        for row in rows:
+            table.append(row)
+            written[(row[0], row[3], row[4])] = row
+    return table
+
+def windows(sessions):
+    epoch = lambda t: (t - datetime(1970, 1, 1)).total_seconds()
+    return [SessionWindow(s.session_id, epoch(s.start_time), epoch(s.end_time), float(s.radius),
+                          np.radians([float(l[0]) for l in s.locations]), np.radians([float(l[1]) for l in s.locations]),
+                          s.start_time, s.end_time) for s in sessions]
+
+def per_attendee(rows, weighted):
+    epoch = datetime(1970, 1, 1)
+    attendees = {}
+    for row in rows:
+        attendees.setdefault(row[0], []).append(((row[3] - epoch).total_seconds(), row[1], row[2], row[5] if weighted else 1))
+    return {u: np.array(sorted(r), dtype=np.float64).reshape(-1, 4) for u, r in attendees.items()}
+
+def score_all(arrays, session_windows, weighted):
+    """Every attendee against every session, {unique_id: scores} and the seconds it took"""
+    scores = {}
+    start = time.perf_counter()
+    for unique_id, a in arrays.items():
+        scores[unique_id] = score_pings(session_windows, a[:, 0], a[:, 1], a[:, 2], a[:, 3] if weighted else None)
+    return scores, time.perf_counter() - start
+
+def joined(scores, session_windows):
+    """As if each attendee joined the sessions they were inside at least once, {unique_id: windows}"""
+    by_id = {w.session_id: w for w in session_windows}
+    return {u: [by_id[sid] for sid, (in_range, _) in s.items() if in_range] for u, s in scores.items()}
+
+def time_joined(arrays, attendee_windows, weighted):
+    start = time.perf_counter()
+    for unique_id, a in arrays.items():
+        score_pings(attendee_windows[unique_id], a[:, 0], a[:, 1], a[:, 2], a[:, 3] if weighted else None)
+    return time.perf_counter() - start
+
+def measure_database(dsn, raw, dwells, attendee_windows):
+    import psycopg
+    params = {}
+    for unique_id, session_windows in attendee_windows.items():
+        if session_windows:
+            merged = merge_windows(session_windows)
+            params[unique_id] = {"student_id": unique_id, "first": merged[0][0], "last": merged[-1][1],
+                                 "starts": [w[0] for w in merged], "ends": [w[1] for w in merged]}
+    results = {}
+    with psycopg.connect(dsn, autocommit=True) as connection:
+        for name, rows in (("bench_raw_pings", raw), ("bench_dwell_pings", dwells)):
+            connection.execute(f"drop table if exists {name};")
+            connection.execute(f"create unlogged table {name} (LocationTimestamp timestamp, Longitude numeric(9, 6), Latitude numeric(8, 6), UniqueID int, EndTimestamp timestamp, PingCount int not null default 1);")
+            with connection.cursor() as cursor:
+                with cursor.copy(f"copy {name} (UniqueID, Latitude, Longitude, LocationTimestamp, EndTimestamp, PingCount) from stdin") as copy:
+                    for row in rows:
+                        copy.write_row(row)
+            connection.execute(f"create index on {name} (UniqueID, LocationTimestamp) include (Latitude, Longitude, PingCount);")
+            connection.execute(f"vacuum analyze {name};")
+            size = connection.execute(f"select pg_total_relation_size('{name}');").fetchone()[0]
+
+            query = WINDOW_PINGS.replace("AttendeesLocations", name)
+            start = time.perf_counter()
+            for unique_id, query_params in params.items():
+                fetched = connection.execute(query, query_params).fetchall()
+                a = np.array(fetched, dtype=np.float64).reshape(-1, 4)
+                score_pings(attendee_windows[unique_id], a[:, 0], a[:, 1], a[:, 2], a[:, 3])
+            results[name] = (size, time.perf_counter() - start)
+            connection.execute(f"drop table {name};")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--radius", type=float, default=40.0)
+    parser.add_argument("--interval", type=float, default=15.0, help="Seconds between a client's pings")
+    parser.add_argument("--jitter", type=float, default=2.0, help="GPS error in metres, one sigma")
+    parser.add_argument("--tolerance", type=float, default=5.0, help="PING_DWELL_TOLERANCE_M")
+    parser.add_argument("--max-gap", type=float, default=60.0)
+    parser.add_argument("--max-span", type=float, default=1800.0)
+    parser.add_argument("--batch", type=int, default=500, help="Pings per plan() call, as PING_BATCH_SIZE")
+    parser.add_argument("--trace", help="Recorded pings, needs --sessions-csv")
+    parser.add_argument("--sessions-csv")
+    parser.add_argument("--dsn", help="Also measure table size and the attendance query in Postgres")
+    parser.add_argument("--seed", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.trace:
+        rows, pings = load_recorded(args.trace, args.sessions_csv)
+    else:
+        rows, pings = make_day(random.Random(args.seed), args.students, args.rooms, args.radius, args.interval, args.jitter)
+    sessions = list(group_sessions(rows).values())
+    session_windows = windows(sessions)
+
+    raw = [[u, round(lat, 6), round(lon, 6), t, None, 1] for u, lat, lon, t in pings]
+    compressor = DwellCompressor(args.tolerance, args.max_gap, args.max_span)
+    start = time.perf_counter()
+    dwells = compress(pings, sessions, compressor, args.batch)
+    plan_time = time.perf_counter() - start
+    print(f"{len(pings)} pings from {len({p[0] for p in pings})} attendees, {len(sessions)} sessions")
+    print(f"rows:      {len(raw):9d} raw  {len(dwells):9d} dwell  {len(raw) / len(dwells):5.2f}x fewer  "
+          f"({compressor.stats['near_boundary']} pings kept single near a fence edge)")
+    print(f"compress:  {plan_time * 1e6 / len(pings):9.2f} us per ping")
+
+    raw_arrays, dwell_arrays = per_attendee(raw, False), per_attendee(dwells, True)
+    raw_scores, _ = score_all(raw_arrays, session_windows, False)
+    dwell_scores, _ = score_all(dwell_arrays, session_windows, True)
+    mismatches = sum(raw_scores[u] != dwell_scores.get(u) for u in raw_scores)
+    print(f"attendees with different counts for any session: {mismatches}")
+
+    attendee_windows = joined(raw_scores, session_windows)
+    raw_time = time_joined(raw_arrays, attendee_windows, False)
+    dwell_time = time_joined(dwell_arrays, attendee_windows, True)
+    print(f"score:     {raw_time * 1000:9.1f} ms raw  {dwell_time * 1000:9.1f} ms dwell  {raw_time / dwell_time:5.2f}x faster")
+
+    if args.dsn:
+        results = measure_database(args.dsn, raw, dwells, attendee_windows)
+        (raw_size, raw_query), (dwell_size, dwell_query) = results["bench_raw_pings"], results["bench_dwell_pings"]
+        print(f"storage:   {raw_size / 2**20:9.1f} MB raw  {dwell_size / 2**20:9.1f} MB dwell  {raw_size / dwell_size:5.2f}x smaller")
+        print(f"query:     {raw_query * 1000:9.1f} ms raw  {dwell_query * 1000:9.1f} ms dwell  {raw_query / dwell_query:5.2f}x faster")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+Geofence lookups for sessions with many locations: GeofenceIndex against measuring the distance
+to every location of the session.
+
+Locations are scattered over a few kilometres around a campus, query points over a slightly
+larger area so that both hits and misses are exercised.
+
+python benchmarks/bench_geofence.py --points 20000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from geofence import GeofenceIndex, haversine_m
+
+def linear_contains(locations, radius_m, lat, lon):
+    return any(haversine_m(lat, lon, location_lat, location_lon) <= radius_m for location_lat, location_lon in locations)
+
+def scatter(rng, count, centre, spread):
+    return [(centre[0] + rng.uniform(-spread, spread), centre[1] + rng.uniform(-spread, spread)) for _ in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=20000)
+    parser.add_argument("--radius", type=float, default=50.0)
+    parser.add_argument("--sizes", default="1,10,100,500,1000")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # Bengaluru and a high latitude campus, where a degree of longitude is much shorter
+    for name, centre in (("12.97N", (12.9716, 77.5946)), ("64.14N", (64.1466, -21.9426))):
+        for size in (int(x) for x in args.sizes.split(",")):
+            locations = scatter(rng, size, centre, 0.02)
+            points = scatter(rng, args.points, centre, 0.025)
+
+            start = time.perf_counter()
+            index = GeofenceIndex(locations, args.radius)
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            indexed = [index.contains(lat, lon) for lat, lon in points]
+            indexed_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            linear = [linear_contains(locations, args.radius, lat, lon) for lat, lon in points]
+            linear_time = time.perf_counter() - start
+
+            assert indexed == linear, "index and linear scan disagree"
+            print(f"{name} {size:5d} locations: build {build * 1000:7.2f} ms  "
+                  f"index {indexed_time / args.points * 1e6:7.2f} us/point  "
+                  f"linear {linear_time / args.points * 1e6:8.2f} us/point  "
+                  f"hits {sum(indexed)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+/join-session as it was, a statement per step with the checks and the score rebuild in Python,
+against the join_session() function that does it all in one statement. Counts the round trips each
+join makes (statements plus the commit) and reports latency percentiles under concurrency.
+
+Half the attendees join one session the old way and half an identical session through the
+function, with the same pings sent before joining, so their AttendanceScores must match.
+
+Runs in a scratch schema built from attendance_db_postgres.sql and dropped afterwards.
+
+python benchmarks/bench_join.py --dsn "$SQL_URL" --attendees 2000 --concurrency 40
+"""
+from datetime import timedelta
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import psycopg
+
+SCHEMA = "bench_join"
+SCHEMA_SQL = os.path.join(os.path.dirname(__file__), "..", "attendance_db_postgres.sql")
+LAT, LON = 12.9716, 77.5946
+
+# Sessions 1 and 2 are identical, attendees in the first half join 1, the others 2. Attendee i
+# and i + half send the same pings before joining, some of them outside the fence.
+SEED = """
+insert into Admins (Email, FirstName, LastName, Passwd) values ('bench@example.com', 'Bench', 'Admin', '');
+insert into Attendees (Email, Fname, Lname, Passwd, Address)
+select 'join' || i || '@example.com', 'First', 'Last', '', 'Campus' from generate_series(1, %(attendees)s) i;
+insert into Sessions (StartTime, EndTime, AdminID, GeofenceRadius)
+select %(now)s::timestamp - interval '10 minutes', %(now)s::timestamp + interval '1 hour', 1, 50 from generate_series(1, 2);
+insert into SessionLocations (Address, Longitude, Latitude, SessionID)
+select 'Room ' || k, %(lon)s + k / 5000.0, %(lat)s, s from generate_series(1, 2) s, generate_series(0, 1) k;
+insert into AttendeesLocations (LocationTimestamp, Longitude, Latitude, UniqueID)
+select %(now)s::timestamp - interval '9 minutes' + k * interval '15 seconds',
+       round((%(lon)s + ((a - 1) %% %(half)s * 7 + k) %% 11 / 10000.0)::numeric, 6), %(lat)s, a
+from generate_series(1, %(attendees)s) a, generate_series(1, %(pings)s) k;
+"""
+
+def prepare(dsn, attendees, pings, now):
+    with psycopg.connect(dsn) as connection:
+        connection.execute(f"drop schema if exists {SCHEMA} cascade; create schema {SCHEMA}; set search_path to {SCHEMA};")
+        with open(SCHEMA_SQL) as f:
+            connection.execute(f.read())
+        with psycopg.ClientCursor(connection) as cursor:
+            cursor.execute(SEED, {"attendees": attendees, "half": attendees // 2, "pings": pings, "now": now, "lat": LAT, "lon": LON})
+
+def drop(dsn):
+    with psycopg.connect(dsn) as connection:
+        connection.execute(f"drop schema if exists {SCHEMA} cascade;")
+
+class Counted:
+    """A cursor that counts the statements sent through it, each one a round trip"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.trips = 0
+
+    async def execute(self, *args, **kwargs):
+        self.trips += 1
+        return await self.cursor.execute(*args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        # Pipelined by psycopg, one round trip for the batch
+        self.trips += 1
+        return await self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+async def statement_join(control, attendee, session, fence, joined_at):
+    from scores import rebuild_scores
+    # The attendee check on an ID cache miss, the session and its fence come from the session cache
+    await control.execute("SELECT 1 FROM Attendees WHERE UniqueID = %s;", (attendee,))
+    if await control.fetchone() is None or not fence.contains(LAT, LON):
+        return "refused"
+    await control.execute("INSERT INTO Attended_By (UniqueID, SessionID) VALUES (%s, %s);", (attendee, session))
+    await control.execute(
+        "INSERT INTO AttendeesLocations (LocationTimestamp, Longitude, Latitude, UniqueID) VALUES (%s, %s, %s, %s);",
+        (joined_at, LON, LAT, attendee)
+    )
+    await rebuild_scores(control, attendee, session)
+    return "joined"
+
+async def function_join(control, attendee, session, fence, joined_at):
+    await control.execute("select join_session(%s, %s, %s, %s, %s, %s, %s);", (attendee, session, LAT, LON, joined_at, None, None))
+    return (await control.fetchone())[0]
+
+async def run_path(join, attendees, session, fence, now, concurrency):
+    from db import get_connection, get_cursor
+    queue = asyncio.Queue()
+    for attendee in attendees:
+        queue.put_nowait(attendee)
+    latencies, trips, outcomes = [], [], {}
+
+    async def worker():
+        while not queue.empty():
+            attendee = queue.get_nowait()
+            start = time.perf_counter()
+            async with get_connection() as connection:
+                async with get_cursor(connection) as cursor:
+                    control = Counted(cursor)
+                    try:
+                        outcome = await join(control, attendee, session, fence, now)
+                        await connection.commit()
+                    except psycopg.errors.UniqueViolation:
+                        outcome = "unique_violation"
+                        await connection.rollback()
+            latencies.append(time.perf_counter() - start)
+            trips.append(control.trips + 1)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, trips, outcomes, time.perf_counter() - start
+
+def report(name, latencies, trips, outcomes, elapsed):
+    q = statistics.quantiles(latencies, n=100)
+    print(f"{name:10s} {len(latencies):6d} joins  {statistics.mean(trips):4.1f} round trips  "
+          f"p50 {q[49] * 1000:7.2f} ms  p95 {q[94] * 1000:7.2f} ms  p99 {q[98] * 1000:7.2f} ms  "
+          f"{len(latencies) / elapsed:8.1f} joins/s  {outcomes}")
+
+async def run(args, now):
+    import db
+    from geofence import GeofenceIndex
+    from db import get_connection, get_cursor
+
+    await db.open_pool()
+    try:
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute("select Latitude, Longitude from SessionLocations where SessionID=1;")
+                fence = GeofenceIndex(await control.fetchall(), 50)
+                await control.execute("select 1;")
+                start = time.perf_counter()
+                for _ in range(100):
+                    await control.execute("select 1;")
+                print(f"one round trip: {(time.perf_counter() - start) * 10:.3f} ms")
+
+        half = args.attendees // 2
+        first, second = list(range(1, half + 1)), list(range(half + 1, 2 * half + 1))
+        report("statements", *await run_path(statement_join, first, 1, fence, now, args.concurrency))
+        report("function", *await run_path(function_join, second, 2, fence, now, args.concurrency))
+
+        # Joining again: the old path hit the primary key, the function says so
+        report("again old", *await run_path(statement_join, first[:args.concurrency], 1, fence, now, args.concurrency))
+        report("again new", *await run_path(function_join, second[:args.concurrency], 2, fence, now, args.concurrency))
+
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute(
+                    "select count(*) from AttendanceScores a join AttendanceScores b on b.UniqueID=a.UniqueID+%s and b.SessionID=2 "
+                    "where a.SessionID=1 and (a.InRange, a.Total) is distinct from (b.InRange, b.Total);",
+                    (half,)
+                )
+                print(f"attendees whose scores differ between the two paths: {(await control.fetchone())[0]}")
+    finally:
+        await db.close_pool()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True)
+    parser.add_argument("--attendees", type=int, default=2000)
+    parser.add_argument("--pings", type=int, default=20, help="Pings each attendee sent before joining")
+    parser.add_argument("--concurrency", type=int, default=40)
+    args = parser.parse_args()
+
+    from sessions import ist_now
+    now = ist_now().replace(microsecond=0)
+    prepare(args.dsn, args.attendees, args.pings, now)
+    # The app's pool reads SQL_URL, PGOPTIONS points every connection at the scratch schema
+    os.environ["SQL_URL"] = args.dsn
+    os.environ["PGOPTIONS"] = f"-c search_path={SCHEMA}"
+    os.environ.setdefault("DB_POOL_MAX", str(args.concurrency))
+    try:
+        asyncio.run(run(args, now + timedelta(seconds=1)))
+    finally:
+        os.environ.pop("PGOPTIONS")
+        drop(args.dsn)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Login throughput of bcrypt verification: the shared request threadpool the handlers used to call
+into against the PasswordHasher process pool, at a range of worker counts and work factors.
+
+Each run verifies --logins passwords as concurrent requests would and reports logins/s overall
+and per worker.
+
+python benchmarks/bench_passwords.py --workers 1,2,4,8 --rounds 10,12
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from starlette.concurrency import run_in_threadpool
+from passwords import PasswordHasher, hash_password, verify_password
+
+async def threadpool_logins(count, hashed):
+    await asyncio.gather(*(run_in_threadpool(verify_password, "correct horse", hashed) for _ in range(count)))
+
+async def hasher_logins(count, hashed, workers, rounds):
+    hasher = PasswordHasher(workers=workers, max_pending=count, wait_timeout=3600, rounds=rounds)
+    await hasher.start()
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(hasher.verify("correct horse", hashed) for _ in range(count)))
+        elapsed = time.perf_counter() - start
+    finally:
+        await hasher.stop()
+    assert all(results)
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--workers", default=",".join(str(n) for n in sorted({1, 2, 4, os.cpu_count() or 1})))
+    parser.add_argument("--rounds", default="10,12")
+    args = parser.parse_args()
+
+    for rounds in (int(x) for x in args.rounds.split(",")):
+        hashed = hash_password("correct horse", rounds)
+
+        start = time.perf_counter()
+        asyncio.run(threadpool_logins(args.logins, hashed))
+        elapsed = time.perf_counter() - start
+        print(f"rounds {rounds:2d}  threadpool          {args.logins / elapsed:8.1f} logins/s")
+
+        for workers in (int(x) for x in args.workers.split(",")):
+            elapsed = asyncio.run(hasher_logins(args.logins, hashed, workers, rounds))
+            rate = args.logins / elapsed
+            print(f"rounds {rounds:2d}  {workers:3d} processes       {rate:8.1f} logins/s  {rate / workers:7.1f} per core")
+
+if __name__ == "__main__":
+    main()
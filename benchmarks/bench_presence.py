@@ -0,0 +1,84 @@
+"""
+Presence fan-out: one session watched by many admins' feeds, attendees pinging in and out of the
+geofence. Measures how long the broker takes to deliver each enter/leave to every subscriber and
+how far behind the last subscriber gets.
+
+A share of the subscribers never read (--stalled), their buffers stay at --buffer messages and the
+broker drops their oldest instead of slowing the others down.
+
+python benchmarks/bench_presence.py --subscribers 1000 --events 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from presence import PresenceBroker
+
+SESSION = 1
+
+async def consume(subscriber, expected, received):
+    while received[subscriber] < expected:
+        message = await subscriber.next(5.0)
+        if message is None:
+            return
+        if message.startswith("event: lagged"):
+            received[subscriber] += json.loads(message.split("data: ", 1)[1])["missed"]
+        elif message.startswith("event: enter") or message.startswith("event: leave"):
+            received[subscriber] += 1
+
+async def run(args):
+    broker = PresenceBroker(buffer=args.buffer)
+    subscribers = [broker.subscribe(SESSION) for _ in range(args.subscribers)]
+    stalled = subscribers[:int(len(subscribers) * args.stalled)]
+    readers = subscribers[len(stalled):]
+
+    # Every ping flips its attendee's verdict, so each one is an enter or leave event
+    batches = []
+    for start in range(0, args.events, args.batch):
+        batches.append([("ping", SESSION, i % args.attendees, "2024-01-01 10:00:00", (i // args.attendees) % 2 == 0)
+                        for i in range(start, min(args.events, start + args.batch))])
+
+    received = {subscriber: 0 for subscriber in readers}
+    consumers = [asyncio.create_task(consume(subscriber, args.events, received)) for subscriber in readers]
+
+    tracemalloc.start()
+    dispatch_seconds = 0.0
+    start = time.perf_counter()
+    for batch in batches:
+        t = time.perf_counter()
+        broker.dispatch(batch)
+        dispatch_seconds += time.perf_counter() - t
+        # Let the readers run between writer batches, as the ping writer awaits its database work
+        await asyncio.sleep(0)
+    await asyncio.gather(*consumers)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    delivered = broker.stats["delivered"]
+    print(f"{args.subscribers} subscribers ({len(stalled)} stalled), {args.events} events in batches of {args.batch}")
+    print(f"  dispatch      {dispatch_seconds * 1e6 / args.events:8.1f} us/event  {delivered / dispatch_seconds:12.0f} deliveries/s")
+    print(f"  end to end    {elapsed:8.3f} s      {delivered / elapsed:12.0f} deliveries/s")
+    print(f"  readers       {len(readers)} caught up, {broker.stats['dropped']} messages dropped in total")
+    print(f"  stalled       at most {max((len(s.messages) for s in stalled), default=0)} messages buffered each")
+    print(f"  peak memory   {peak / 2 ** 20:8.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--attendees", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=50, help="events per ping writer transaction")
+    parser.add_argument("--buffer", type=int, default=256)
+    parser.add_argument("--stalled", type=float, default=0.1, help="share of subscribers that never read")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
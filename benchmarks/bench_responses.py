@@ -0,0 +1,125 @@
+"""
+Response encoding for large payloads: the rows handlers used to return, passed through FastAPI's
+jsonable_encoder and JSONResponse, against the rows they return now encoded by FastJSONResponse
+or by the pydantic models' own serializer. Each payload is checked to decode to the same JSON,
+apart from history page coordinates, which the old models sent as strings.
+
+python benchmarks/bench_responses.py --rows 10000
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from responses import FastJSONResponse, model_response
+from sessions import group_sessions
+import history
+
+def coordinate(rng, centre):
+    # NUMERIC(9, 6) as psycopg returns it
+    return Decimal(f"{centre + rng.uniform(-0.05, 0.05):.6f}")
+
+def make_sessions(rng, count, locations):
+    start = datetime(2024, 1, 1, 9)
+    rows = []
+    for session_id in range(1, count + 1):
+        begin = start + timedelta(minutes=session_id)
+        for _ in range(rng.randint(1, locations)):
+            rows.append((session_id, begin, begin + timedelta(hours=1), session_id % 50 + 1, 100.0,
+                         coordinate(rng, 12.97), coordinate(rng, 77.59)))
+    return rows
+
+def timed(encode, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = encode()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), body
+
+def compare(name, old, new, repeat, same=None):
+    old_time, old_body = timed(old, repeat)
+    new_time, new_body = timed(new, repeat)
+    old_json, new_json = json.loads(old_body), json.loads(new_body)
+    matches = (same or (lambda a, b: a == b))(old_json, new_json)
+    print(f"{name:24s} {len(old_body) / 1e6:6.2f} MB  old {old_time * 1000:8.2f} ms  new {new_time * 1000:8.2f} ms  "
+          f"{old_time / new_time:5.1f}x  same output: {matches}")
+
+def old_response(content):
+    return JSONResponse(jsonable_encoder(content)).body
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--locations", type=int, default=3, help="Most locations per session")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    rows = make_sessions(rng, args.rows, args.locations)
+    active = list(group_sessions(rows).values())
+    compare(
+        "active-sessions",
+        lambda: old_response({"sessions": [(x.session_id, x.start_time, x.end_time, x.admin_id) + sum(x.locations, ()) for x in active]}),
+        lambda: FastJSONResponse({"sessions": [x.row for x in active]}).body,
+        args.repeat,
+    )
+
+    summaries = [row[:4] for row in rows]
+    compare(
+        "my-sessions",
+        lambda: old_response({"sessions": summaries}),
+        lambda: FastJSONResponse({"sessions": summaries}).body,
+        args.repeat,
+    )
+
+    # get-attended-sessions rows, the query now casts the coordinates to float8
+    attended = [row[:4] + row[5:] for row in rows]
+    attended_float = [row[:4] + (float(row[4]), float(row[5])) for row in attended]
+    compare(
+        "get-attended-sessions",
+        lambda: old_response({"sessions": attended}),
+        lambda: FastJSONResponse({"sessions": attended_float}).body,
+        args.repeat,
+    )
+
+    def old_page():
+        sessions, current = [], None
+        for row in attended:
+            if current is None or current.sessionid != row[0]:
+                current = history.SessionWithLocations(sessionid=row[0], starttime=row[1], endtime=row[2], adminid=row[3])
+                sessions.append(current)
+            current.locations.append(history.SessionLocation(latitude=row[4], longitude=row[5]))
+        return old_response(history.AttendedSessionPage(sessions=sessions, next_cursor="x"))
+
+    def new_page():
+        sessions, current = [], None
+        for row in attended_float:
+            if current is None or current.sessionid != row[0]:
+                current = history.SessionWithLocations(sessionid=row[0], starttime=row[1], endtime=row[2], adminid=row[3])
+                sessions.append(current)
+            current.locations.append(history.SessionLocation(latitude=row[4], longitude=row[5]))
+        return model_response(history.AttendedSessionPage(sessions=sessions, next_cursor="x")).body
+
+    def same_page(old, new):
+        # The old page sent each coordinate as a string, the new one as a number
+        for session in old["sessions"]:
+            for location in session["locations"]:
+                location["latitude"], location["longitude"] = float(location["latitude"]), float(location["longitude"])
+        return old == new
+
+    # Models built and encoded, as history.page() does both per request
+    compare("history page (attended)", old_page, new_page, args.repeat, same_page)
+
+if __name__ == "__main__":
+    main()
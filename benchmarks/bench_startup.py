@@ -0,0 +1,86 @@
+"""
+Startup cost of a worker: the time to import main, broken down by the packages main imports
+from python -X importtime, and with --dsn the time until serve.py answers requests for a few worker
+counts, which adds opening the pools, loading the session cache and starting the bcrypt processes.
+
+python benchmarks/bench_startup.py --top 15
+python benchmarks/bench_startup.py --dsn "$SQL_URL" --workers 1,2,4
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def import_times():
+    """{package main imports: cumulative microseconds} of importing main, its own code under "main", and the total"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT, capture_output=True, text=True, check=True)
+    packages = {}
+    children = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package, indented two spaces per level
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if depth == 1:
+            # Imported by the top level module listed after them, deeper ones are in these already
+            children[name.split(".")[0]] = children.get(name.split(".")[0], 0) + int(cumulative)
+        elif depth == 0:
+            if name == "main":
+                packages = dict(children, main=int(own))
+                total = int(cumulative)
+            children = {}
+    return packages, total
+
+def median_import_times(repeat):
+    runs = [import_times() for _ in range(repeat)]
+    names = {name for packages, _ in runs for name in packages}
+    packages = {name: statistics.median(packages.get(name, 0) for packages, _ in runs) for name in names}
+    return packages, statistics.median(total for _, total in runs)
+
+def time_to_ready(port, workers, dsn, timeout=120.0):
+    env = dict(os.environ, SQL_URL=dsn, PORT=str(port))
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "serve.py", "--workers", str(workers)], cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=1) as s:
+                    s.sendall(b"GET /hello HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+                    if s.recv(64).startswith(b"HTTP/1.1 200"):
+                        return time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(0.05)
+        raise RuntimeError("Server did not come up")
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=5, help="Imports to take the median of")
+    parser.add_argument("--dsn", help="Also time serve.py until it answers, needs a database")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    packages, total = median_import_times(args.repeat)
+    print(f"import main: {total / 1000:8.1f} ms, median of {args.repeat}")
+    for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {name:24s} {us / 1000:8.1f} ms  {100 * us / total:5.1f}%")
+
+    if args.dsn:
+        for workers in (int(x) for x in args.workers.split(",")):
+            # The first worker to answer, the others come up alongside it
+            print(f"serve.py --workers {workers}: ready in {time_to_ready(args.port, workers, args.dsn):6.2f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Query plan regression check: seeds a scratch schema with a few semesters of data, runs the
+endpoints' queries under EXPLAIN and fails if any of them scans one of the large tables
+sequentially. Run it after changing a query or the schema.
+
+The schema is built from attendance_db_postgres.sql in its own search_path and dropped again
+unless --keep is given.
+
+python benchmarks/check_query_plans.py --dsn "$SQL_URL" --pings 1000000
+"""
+from datetime import timedelta
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import psycopg
+from attendance import SESSION_LOCATIONS, WINDOW_PINGS, STORED_SCORES
+from scores import PING_SESSIONS
+from sessions import WINDOW_SESSIONS, SESSIONS_BY_ID
+import history
+
+SCHEMA_SQL = os.path.join(os.path.dirname(__file__), "..", "attendance_db_postgres.sql")
+
+# Tables that grow with usage, a sequential scan on any of them is a regression
+LARGE_TABLES = {"attendeeslocations", "attended_by", "sessions", "sessionlocations", "attendancescores"}
+
+SEED = """
+insert into Admins (Email, FirstName, LastName, Passwd)
+select 'admin' || i || '@example.com', 'a', 'b', 'x' from generate_series(1, %(admins)s) i;
+
+insert into Attendees (Email, Fname, Lname, Passwd, Address)
+select 'student' || i || '@example.com', 's', 't', 'x', 'campus' from generate_series(1, %(attendees)s) i;
+
+-- One hour sessions, six hours apart, the last ones still running
+insert into Sessions (StartTime, EndTime, AdminID, GeofenceRadius)
+select now()::timestamp - (%(sessions)s - i) * interval '6 hours',
+       now()::timestamp - (%(sessions)s - i) * interval '6 hours' + interval '1 hour',
+       1 + i %% %(admins)s, 50
+from generate_series(1, %(sessions)s) i;
+
+insert into SessionLocations (Address, Longitude, Latitude, SessionID)
+select 'room ' || k, 77.59 + random() / 100, 12.97 + random() / 100, s from generate_series(1, %(sessions)s) s, generate_series(1, 3) k;
+
+insert into Attended_By (SessionID, UniqueID)
+select s, 1 + (s * 37 + k * 101) %% %(attendees)s from generate_series(1, %(sessions)s) s, generate_series(1, %(per_session)s) k
+on conflict do nothing;
+
+insert into AttendanceScores (SessionID, UniqueID, InRange, Total)
+select SessionID, UniqueID, 8, 10 from Attended_By;
+
+select ensure_ping_partitions(now()::timestamp - %(sessions)s * interval '6 hours', now()::timestamp);
+alter table AttendeesLocations disable trigger validate_attendees_location;
+insert into AttendeesLocations (LocationTimestamp, Longitude, Latitude, UniqueID)
+select now()::timestamp - (%(pings)s - i) * interval '1 second' * (%(sessions)s * 21600.0 / %(pings)s),
+       77.59 + random() / 100, 12.97 + random() / 100, 1 + (i * 7919) %% %(attendees)s
+from generate_series(1, %(pings)s) i
+order by 1;
+alter table AttendeesLocations enable trigger validate_attendees_location;
+"""
+
+def history_page(kind, user_id, session_id, now):
+    """A second page of history, past a cursor on the newest session"""
+    cursor = history.encode_cursor(history.SessionSummary(sessionid=session_id, starttime=now, endtime=now))
+    sql, params = history.query(kind, cursor, 51)
+    return sql, {**params, "user_id": user_id}
+
+def endpoint_queries(student_id, admin_id, session_id, now):
+    """(name, sql, params) for every query an endpoint runs against a large table"""
+    attendance = {"student_id": student_id, "time_now": now, "admin_id": admin_id, "session_id": None}
+    return [
+        ("get-attendance sessions", SESSION_LOCATIONS, attendance),
+        # A single day, so the plan should touch one monthly partition
+        ("get-attendance pings", WINDOW_PINGS, {"student_id": student_id, "first": now - timedelta(days=1), "last": now,
+                                                "starts": [now - timedelta(days=1)], "ends": [now]}),
+        ("check-attendance scores", STORED_SCORES, attendance),
+        ("current-location scoring", PING_SESSIONS, {"ids": [student_id], "times": [now]}),
+        ("session cache window", WINDOW_SESSIONS, {"now": now, "until": now + timedelta(days=1)}),
+        ("session cache by id", SESSIONS_BY_ID, {"ids": [session_id]}),
+        ("active-sessions joined", "select SessionID from Attended_By where UniqueID=%(id)s", {"id": student_id}),
+        ("my-sessions", "select Sessions.SessionID, Sessions.StartTime, Sessions.EndTime, Sessions.AdminID from Attended_By, Sessions where Attended_By.UniqueID=%(id)s and Sessions.SessionID=Attended_By.SessionID", {"id": student_id}),
+        ("get-attended-sessions", "select Sessions.SessionID, Sessions.StartTime, Sessions.EndTime, Sessions.AdminID, SessionLocations.Latitude::float8, SessionLocations.Longitude::float8 from Attended_By, Sessions, SessionLocations where Attended_By.UniqueID=%(id)s and Sessions.SessionID=Attended_By.SessionID and Sessions.SessionID=SessionLocations.SessionID order by Sessions.StartTime desc;", {"id": student_id}),
+        ("get-sessions-created page", *history_page("created", admin_id, session_id, now)),
+        ("my-sessions page", *history_page("joined", student_id, session_id, now)),
+        ("get-attended-sessions page", *history_page("attended", student_id, session_id, now)),
+        ("get-sessions-created", "select SessionID, StartTime, EndTime from Sessions where AdminID=%(id)s order by StartTime desc;", {"id": admin_id}),
+        ("get-session-attendees", "select a.Email, a.Fname, a.Lname from Attendees a, Attended_By ab where ab.UniqueID=a.UniqueID and ab.SessionID=%(id)s;", {"id": session_id}),
+        ("join-session members", "select UniqueID from Attended_By where SessionID=%(id)s order by UniqueID;", {"id": session_id}),
+    ]
+
+def seq_scans(plan):
+    """Relations scanned sequentially anywhere in an EXPLAIN (FORMAT JSON) plan"""
+    found = []
+    relation = plan.get("Relation Name", "").lower()
+    # Monthly partitions of AttendeesLocations count as the table itself, the default one stays near empty
+    if plan.get("Node Type") == "Seq Scan" and (relation in LARGE_TABLES or relation.startswith("attendeeslocations_p")):
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", default=os.getenv("SQL_URL"))
+    parser.add_argument("--schema", default="plan_check")
+    parser.add_argument("--admins", type=int, default=200)
+    parser.add_argument("--attendees", type=int, default=20000)
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--per-session", type=int, default=40)
+    parser.add_argument("--pings", type=int, default=1000000)
+    parser.add_argument("--keep", action="store_true", help="Leave the seeded schema in place")
+    parser.add_argument("--verbose", action="store_true", help="Print every plan")
+    args = parser.parse_args()
+
+    # Client side binding so parameters are inlined into the EXPLAINed text
+    with psycopg.connect(args.dsn, cursor_factory=psycopg.ClientCursor) as connection:
+        connection.execute(f"drop schema if exists {args.schema} cascade; create schema {args.schema}; set search_path to {args.schema};")
+        with open(SCHEMA_SQL) as f:
+            connection.execute(f.read())
+        print(f"Seeding {args.sessions} sessions, {args.attendees} attendees, {args.pings} pings")
+        connection.execute(SEED, {"admins": args.admins, "attendees": args.attendees, "sessions": args.sessions,
+                                  "per_session": args.per_session, "pings": args.pings})
+        connection.execute("analyze;")
+
+        student_id, session_id = connection.execute("select UniqueID, SessionID from Attended_By order by SessionID desc limit 1;").fetchone()
+        now = connection.execute("select now()::timestamp;").fetchone()[0]
+
+        failures = 0
+        for name, sql, params in endpoint_queries(student_id, 1, session_id, now):
+            plan = connection.execute("explain (format json) " + sql.strip().rstrip(";"), params).fetchone()[0]
+            plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+            scans = seq_scans(plan)
+            failures += bool(scans)
+            print(f"{'FAIL' if scans else 'ok  '}  {name:28s} cost {plan['Total Cost']:10.1f}" + (f"  seq scan on {', '.join(scans)}" if scans else ""))
+            if args.verbose:
+                print(json.dumps(plan, indent=2))
+
+        if not args.keep:
+            connection.execute(f"drop schema {args.schema} cascade;")
+        connection.commit()
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
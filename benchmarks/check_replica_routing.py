@@ -0,0 +1,117 @@
+"""
+Replica routing check against two local Postgres instances: a primary and a replica, either a
+streaming standby of it or simply a second server. Opens the app's pools on them and checks that
+get_read_connection() sends a reader to the replica, a reader who just wrote to the primary until
+DB_REPLICA_STICKY has passed, and everyone to the primary while the replica lags too far or is down.
+
+With a streaming standby it also writes a row on the primary and times how long the standby takes
+to show it, which is what DB_REPLICA_STICKY has to cover.
+
+python benchmarks/check_replica_routing.py --primary "postgresql://localhost:5432/app" --replica "postgresql://localhost:5433/app"
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import db
+
+# Two servers started at different times, also when they share a system identifier
+SERVER = "select pg_postmaster_start_time(), pg_is_in_recovery();"
+
+async def server_of(user):
+    async with db.get_read_connection(user) as connection:
+        cursor = await connection.execute(SERVER)
+        return await cursor.fetchone()
+
+async def wait_for_lag_check(router, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while router.lag is None and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    return router.lag is not None
+
+async def catch_up_time(primary, timeout=10.0):
+    """Seconds until a row committed on the primary can be read from the standby"""
+    async with primary.connection() as connection:
+        await connection.execute("create table if not exists replica_check (id serial primary key, at timestamp default now());")
+        cursor = await connection.execute("insert into replica_check default values returning id;")
+        row_id = (await cursor.fetchone())[0]
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        async with db.replica.pool.connection() as connection:
+            cursor = await connection.execute("select 1 from pg_class where relname='replica_check';")
+            if await cursor.fetchone() is not None:
+                cursor = await connection.execute("select 1 from replica_check where id=%s;", (row_id,))
+                if await cursor.fetchone() is not None:
+                    return time.perf_counter() - start
+        await asyncio.sleep(0.005)
+    return None
+
+async def run(args):
+    failures = 0
+
+    def check(name, ok, detail=""):
+        nonlocal failures
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'}  {name:44s} {detail}")
+
+    await db.open_pool()
+    try:
+        router = db.replica
+        check("replica lag measured", await wait_for_lag_check(router), f"lag {router.lag}")
+        async with db.get_connection() as connection:
+            cursor = await connection.execute(SERVER)
+            primary = await cursor.fetchone()
+        replica = await server_of(("attendee", 1))
+        check("reader goes to the replica", replica != primary, f"standby: {replica[1]}")
+
+        db.wrote(("attendee", 2))
+        check("reader who just wrote goes to the primary", await server_of(("attendee", 2)) == primary)
+        check("other readers stay on the replica", await server_of(("attendee", 3)) == replica)
+        await asyncio.sleep(router.sticky + 0.1)
+        check("writer back on the replica after sticky", await server_of(("attendee", 2)) == replica)
+
+        max_lag, router.max_lag = router.max_lag, -1.0
+        check("lagging replica skipped", await server_of(("attendee", 1)) == primary)
+        router.max_lag = max_lag
+
+        if replica[1]:
+            waited = await catch_up_time(db.pool)
+            check("standby shows a committed row", waited is not None,
+                  f"after {waited * 1000:.1f} ms, DB_REPLICA_STICKY={router.sticky}" if waited is not None else "")
+    finally:
+        await db.close_pool()
+
+    # Nothing listens on the dead address, reads fall back once the lag check or a checkout fails
+    os.environ["SQL_REPLICA_URL"] = args.dead
+    await db.open_pool()
+    try:
+        start = time.perf_counter()
+        fell_back = await server_of(("attendee", 1)) == primary
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(db.replica.check_interval + db.replica.timeout + 0.2)
+        check("replica down, reads on the primary", fell_back and await server_of(("attendee", 1)) == primary,
+              f"first read {elapsed * 1000:.1f} ms, {db.replica.metrics()}")
+    finally:
+        await db.close_pool()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--primary", default=os.getenv("SQL_URL"))
+    parser.add_argument("--replica", default=os.getenv("SQL_REPLICA_URL"))
+    parser.add_argument("--dead", default="postgresql://127.0.0.1:1/none?connect_timeout=1", help="A replica address nothing answers on")
+    parser.add_argument("--sticky", type=float, default=1.0)
+    args = parser.parse_args()
+
+    os.environ["SQL_URL"] = args.primary
+    os.environ["SQL_REPLICA_URL"] = args.replica
+    os.environ["DB_REPLICA_STICKY"] = str(args.sticky)
+    os.environ.setdefault("DB_POOL_MAX", "4")
+    sys.exit(1 if asyncio.run(run(args)) else 0)
+
+if __name__ == "__main__":
+    main()
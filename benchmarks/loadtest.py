@@ -0,0 +1,379 @@
+"""
+Load test of the running API under the traffic of a class day, against a scratch schema seeded with
+a term of data. Four scenarios run one after the other:
+
+  login       a login storm, every attendee logging in at once as class starts
+  join        the /join-session burst for a session that has just started
+  stream      steady /current-location pings from the joined attendees at --stream-rate per second
+  report      end of term /get-attendance reports, each admin looking up their students
+
+Every request is timed from the moment it was scheduled, so a slow server cannot hide its queueing
+delay. The throughput and latency percentiles of each endpoint are printed. With --output they are
+saved as JSON, and --baseline compares a run with a saved one so regressions show up between commits.
+
+The server is started with uvicorn on the scratch schema unless --url points at one already
+running. Seeding a term takes a while, --keep and --skip-seed reuse the same data between commits:
+
+python benchmarks/loadtest.py --dsn "$SQL_URL" --keep --output base.json
+python benchmarks/loadtest.py --dsn "$SQL_URL" --skip-seed --keep --baseline base.json
+
+Realistic volumes are the defaults except for pings, pass --pings 20000000 for a full term.
+"""
+from datetime import datetime, timedelta
+from pytz import timezone
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bcrypt
+import psycopg
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SCHEMA_SQL = os.path.join(ROOT, "attendance_db_postgres.sql")
+
+PASSWORD = "loadtest"
+CAMPUS = (12.9716, 77.5946)
+JWT_SECRET = "loadtest-secret"
+
+SEED = """
+insert into Admins (Email, FirstName, LastName, Passwd)
+select 'admin' || i || '@example.com', 'Admin', 'User', %(hash)s from generate_series(1, %(admins)s) i;
+
+insert into Attendees (Email, Fname, Lname, Passwd, Address)
+select 'student' || i || '@example.com', 'Student', 'User', %(hash)s, 'Campus' from generate_series(1, %(attendees)s) i;
+
+-- One hour classes spread over the term, all ended
+insert into Sessions (StartTime, EndTime, AdminID, GeofenceRadius)
+select %(now)s::timestamp - %(term_days)s * interval '1 day' + (i - 1) * (%(term_days)s * interval '1 day' / %(sessions)s),
+       %(now)s::timestamp - %(term_days)s * interval '1 day' + (i - 1) * (%(term_days)s * interval '1 day' / %(sessions)s) + interval '1 hour',
+       1 + i %% %(admins)s, 100
+from generate_series(1, %(sessions)s) i;
+
+insert into SessionLocations (Address, Longitude, Latitude, SessionID)
+select 'Room ' || s, %(lon)s + (s %% 50) / 10000.0, %(lat)s + (s %% 50) / 10000.0, s from generate_series(1, %(sessions)s) s;
+
+insert into Attended_By (SessionID, UniqueID)
+select s, 1 + (s * 37 + k * 101) %% %(attendees)s from generate_series(1, %(sessions)s) s, generate_series(1, %(per_session)s) k
+on conflict do nothing;
+
+insert into AttendanceScores (SessionID, UniqueID, InRange, Total)
+select SessionID, UniqueID, 40 + (UniqueID %% 20), 60 from Attended_By;
+
+select ensure_ping_partitions(%(now)s::timestamp - %(term_days)s * interval '1 day', %(now)s::timestamp + interval '1 month');
+alter table AttendeesLocations disable trigger validate_attendees_location;
+insert into AttendeesLocations (LocationTimestamp, Longitude, Latitude, UniqueID)
+select %(now)s::timestamp - (%(pings)s - i) * (%(term_days)s * interval '1 day' / %(pings)s),
+       %(lon)s + (random() - 0.5) / 500, %(lat)s + (random() - 0.5) / 500, 1 + (i * 7919) %% %(attendees)s
+from generate_series(1, %(pings)s) i;
+alter table AttendeesLocations enable trigger validate_attendees_location;
+
+-- The class starting now, its session is the last one
+insert into Sessions (StartTime, EndTime, AdminID, GeofenceRadius) values (%(now)s, %(now)s, 1, 100);
+insert into SessionLocations (Address, Longitude, Latitude, SessionID)
+select 'Main hall', %(lon)s, %(lat)s, max(SessionID) from Sessions;
+"""
+
+def ist_now():
+    return datetime.now(timezone("Asia/Kolkata")).replace(tzinfo=None).replace(microsecond=0)
+
+def seed(args):
+    # Client side binding, the seed script is several statements with parameters
+    with psycopg.connect(args.dsn, cursor_factory=psycopg.ClientCursor) as connection:
+        connection.execute(f"drop schema if exists {args.schema} cascade; create schema {args.schema}; set search_path to {args.schema};")
+        with open(SCHEMA_SQL) as f:
+            connection.execute(f.read())
+        print(f"Seeding {args.sessions} sessions, {args.attendees} attendees, {args.pings} pings")
+        start = time.perf_counter()
+        hashed = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(args.rounds)).decode()
+        connection.execute(SEED, {
+            "hash": hashed, "admins": args.admins, "attendees": args.attendees, "sessions": args.sessions,
+            "per_session": args.per_session, "pings": args.pings, "term_days": args.term_days,
+            "now": ist_now(), "lat": CAMPUS[0], "lon": CAMPUS[1],
+        })
+        connection.execute("analyze;")
+        print(f"Seeded in {time.perf_counter() - start:.0f}s")
+
+def reset_live(args):
+    """Restart the live session now without attendees, so every run starts from the same state"""
+    now = ist_now()
+    with psycopg.connect(args.dsn) as connection:
+        connection.execute(f"set search_path to {args.schema};")
+        session_id = connection.execute("select max(SessionID) from Sessions;").fetchone()[0]
+        connection.execute("delete from AttendanceScores where SessionID=%s;", (session_id,))
+        connection.execute("delete from Attended_By where SessionID=%s;", (session_id,))
+        connection.execute("update Sessions set StartTime=%s, EndTime=%s where SessionID=%s;",
+                           (now - timedelta(minutes=5), now + timedelta(hours=3), session_id))
+        return session_id
+
+def drop(args):
+    with psycopg.connect(args.dsn) as connection:
+        connection.execute(f"drop schema if exists {args.schema} cascade;")
+
+def start_server(args, port):
+    # Every simulated client shares the load tester's address, the per address login limit is off
+    env = dict(os.environ, SQL_URL=args.dsn, PGOPTIONS=f"-c search_path={args.schema}", JWT_SECRET=JWT_SECRET,
+               BCRYPT_ROUNDS=str(args.rounds), LOGIN_IP_RATE_LIMIT="0")
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning", "--no-access-log"]
+    if args.workers > 1:
+        command += ["--workers", str(args.workers)]
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+class Client:
+    """A keep-alive HTTP/1.1 connection speaking just enough of the protocol for JSON endpoints"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        data = json.dumps(body).encode() if body is not None else b""
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n"
+        self.writer.write(head.encode() + data)
+        try:
+            status = int((await self.reader.readline()).split()[1])
+            headers = {}
+            while True:
+                line = await self.reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+            payload = await self.reader.readexactly(int(headers.get("content-length", "0")))
+        except (IndexError, ValueError, asyncio.IncompleteReadError, ConnectionError):
+            await self.close()
+            raise ConnectionError("Connection closed mid-response")
+        if headers.get("connection") == "close":
+            await self.close()
+        return status, payload
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+async def wait_for_server(host, port, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client = Client(host, port)
+        try:
+            status, _ = await client.request("GET", "/hello")
+            await client.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("Server did not come up")
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, endpoint, seconds, ok):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + (not ok)
+
+    def summary(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        result = {}
+        for endpoint, latencies in self.latencies.items():
+            latencies.sort()
+            pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+            result[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "rps": len(latencies) / elapsed,
+                "p50_ms": pick(0.50),
+                "p90_ms": pick(0.90),
+                "p99_ms": pick(0.99),
+                "max_ms": latencies[-1] * 1000,
+            }
+        return result
+
+async def timed(recorder, client, endpoint, body, scheduled=None):
+    """POST body, timed from scheduled when the request was due earlier than it could be sent"""
+    start = scheduled or time.perf_counter()
+    try:
+        status, payload = await client.request("POST", endpoint, body)
+    except ConnectionError:
+        status, payload = 0, b""
+    recorder.record(endpoint, time.perf_counter() - start, status == 200)
+    return status, payload
+
+async def closed_loop(host, port, concurrency, jobs):
+    """Run the (endpoint, body) jobs on concurrency connections, each sending as soon as the last returned"""
+    recorder = Recorder()
+    queue = list(reversed(jobs))
+
+    async def worker():
+        client = Client(host, port)
+        while queue:
+            endpoint, body = queue.pop()
+            await timed(recorder, client, endpoint, body)
+        await client.close()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    recorder.finished = time.perf_counter()
+    return recorder
+
+def jwt_for(role, user_id):
+    from jose import jwt
+    claims = {"id": user_id, "role": role, "email": f"{role}{user_id}@example.com", "fname": "Load", "lname": "Test",
+              "exp": datetime.now(timezone("Asia/Kolkata")) + timedelta(days=1)}
+    return jwt.encode(claims, JWT_SECRET, algorithm="HS256")
+
+def near(rng, spread):
+    return CAMPUS[0] + rng.uniform(-spread, spread), CAMPUS[1] + rng.uniform(-spread, spread)
+
+async def login_storm(host, port, args, rng):
+    users = rng.sample(range(1, args.attendees + 1), args.logins)
+    jobs = [("/auth/login-attendee", {"email": f"student{i}@example.com", "password": PASSWORD}) for i in users]
+    return await closed_loop(host, port, args.concurrency, jobs)
+
+async def join_burst(host, port, args, rng, session_id):
+    jobs = []
+    for student in range(1, args.joins + 1):
+        # Everyone stands inside the 100 m geofence of the hall
+        latitude, longitude = near(rng, 0.0003)
+        jobs.append(("/join-session", {"tok": jwt_for("attendee", student), "sessionid": session_id,
+                                       "latitude": latitude, "longitude": longitude}))
+    return await closed_loop(host, port, args.concurrency, jobs)
+
+async def location_stream(host, port, args, rng):
+    """Open loop: each attendee pings on its own schedule whatever the server's latency"""
+    recorder = Recorder()
+    users = min(args.joins, args.stream_users)
+    interval = users / args.stream_rate
+    deadline = time.perf_counter() + args.stream_seconds
+
+    async def attendee(student):
+        client = Client(host, port)
+        token = jwt_for("attendee", student)
+        due = time.perf_counter() + rng.uniform(0, interval)
+        while due < deadline:
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            # Most pings from inside the hall, some from the corridor outside
+            latitude, longitude = near(rng, 0.0003 if rng.random() < 0.8 else 0.003)
+            await timed(recorder, client, "/current-location", {"tok": token, "latitude": latitude, "longitude": longitude}, due)
+            due += interval
+        await client.close()
+
+    await asyncio.gather(*(attendee(student) for student in range(1, users + 1)))
+    recorder.finished = time.perf_counter()
+    return recorder
+
+async def term_reports(host, port, args, rng):
+    jobs = []
+    for _ in range(args.reports):
+        admin = rng.randint(1, args.admins)
+        jobs.append(("/get-attendance", {"tok": jwt_for("admin", admin), "id": rng.randint(1, args.attendees)}))
+    return await closed_loop(host, port, args.report_concurrency, jobs)
+
+def print_summary(scenario, summary, baseline=None):
+    print(f"\n{scenario}")
+    for endpoint, s in summary.items():
+        line = (f"  {endpoint:24s} {s['requests']:7d} req {s['errors']:5d} err {s['rps']:9.1f} req/s"
+                f"  p50 {s['p50_ms']:8.1f}  p90 {s['p90_ms']:8.1f}  p99 {s['p99_ms']:8.1f}  max {s['max_ms']:8.1f} ms")
+        base = (baseline or {}).get(scenario, {}).get(endpoint)
+        if base:
+            line += f"  (req/s {100 * (s['rps'] / base['rps'] - 1):+.0f}%, p99 {100 * (s['p99_ms'] / base['p99_ms'] - 1):+.0f}%)"
+        print(line)
+
+async def run(args, host, port, session_id):
+    rng = random.Random(args.seed)
+    await wait_for_server(host, port)
+    scenarios = {
+        "login": lambda: login_storm(host, port, args, rng),
+        "join": lambda: join_burst(host, port, args, rng, session_id),
+        "stream": lambda: location_stream(host, port, args, rng),
+        "report": lambda: term_reports(host, port, args, rng),
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["scenarios"]
+
+    results = {}
+    for name in args.scenarios.split(","):
+        recorder = await scenarios[name]()
+        results[name] = recorder.summary()
+        print_summary(name, results[name], baseline)
+    return results
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", default=os.getenv("SQL_URL"))
+    parser.add_argument("--schema", default="load_test")
+    parser.add_argument("--url", help="Test a server already running on the scratch schema instead of starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--admins", type=int, default=200)
+    parser.add_argument("--attendees", type=int, default=50000)
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--per-session", type=int, default=60)
+    parser.add_argument("--pings", type=int, default=2000000)
+    parser.add_argument("--term-days", type=int, default=120)
+    parser.add_argument("--rounds", type=int, default=10, help="bcrypt cost of the seeded passwords and of the server")
+    parser.add_argument("--scenarios", default="login,join,stream,report")
+    parser.add_argument("--logins", type=int, default=2000)
+    parser.add_argument("--joins", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200, help="connections for the login and join bursts")
+    parser.add_argument("--stream-users", type=int, default=2000)
+    parser.add_argument("--stream-rate", type=float, default=1000, help="pings per second")
+    parser.add_argument("--stream-seconds", type=float, default=30)
+    parser.add_argument("--reports", type=int, default=2000)
+    parser.add_argument("--report-concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--skip-seed", action="store_true", help="Reuse the schema left by --keep")
+    parser.add_argument("--keep", action="store_true", help="Leave the seeded schema in place")
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare with")
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        seed(args)
+    session_id = reset_live(args)
+
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        host, port = "127.0.0.1", args.port
+        server = start_server(args, port)
+    try:
+        results = asyncio.run(run(args, host, port, session_id))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if not args.keep:
+            drop(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit": commit(), "args": vars(args), "scenarios": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
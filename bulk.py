@@ -0,0 +1,440 @@
+"""
+Bulk import and export of attendees, sessions and session locations.
+
+Uploads are CSV with a header row or NDJSON, read from the request body line by line and handled
+in chunks of BULK_CHUNK_SIZE rows. Each chunk is copied into a temporary staging table and
+inserted from there, so memory stays flat however large the file is and a duplicate or invalid
+row is reported on its own instead of failing the COPY. Exports stream COPY ... TO STDOUT
+straight into the response.
+"""
+from fastapi import HTTPException, status
+from pydantic import BaseModel, EmailStr, Field, ValidationError, validator
+from psycopg import sql
+from db import get_connection, get_read_connection, get_cursor
+from auth import forget_user
+from geofence import DEFAULT_RADIUS_M
+from scores import rebuild_session_scores
+from datetime import datetime
+from typing import Optional
+import codecs
+import csv
+import json
+import os
+import passwords
+import reports
+import sessions
+
+CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+# Only this many errors are listed in the report, the rest are counted
+MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", "1000"))
+
+STAGE_ATTENDEES = """
+create temp table if not exists bulk_attendees (
+    Email VARCHAR(50), Fname VARCHAR(15), Lname VARCHAR(15), Passwd CHAR(64), Address VARCHAR(100)
+) on commit delete rows;
+"""
+
+INSERT_ATTENDEES = """
+insert into Attendees (Email, Fname, Lname, Passwd, Address)
+select Email, Fname, Lname, Passwd, Address from bulk_attendees
+on conflict (Email) do nothing
+returning Email, UniqueID;
+"""
+
+STAGE_SESSIONS = """
+create temp table if not exists bulk_sessions (
+    Ord INT, StartTime TIMESTAMP, EndTime TIMESTAMP, Radius REAL
+) on commit delete rows;
+create temp table if not exists bulk_session_locations (
+    Ord INT, Address VARCHAR(100), Longitude NUMERIC(9, 6), Latitude NUMERIC(8, 6)
+) on commit delete rows;
+"""
+
+# Ids are drawn up front so the locations can be joined to their new session in the same statement
+INSERT_SESSIONS = """
+with numbered as (
+    select Ord, StartTime, EndTime, Radius, nextval(pg_get_serial_sequence('sessions', 'sessionid')) as SessionID
+    from bulk_sessions
+), created as (
+    insert into Sessions (SessionID, StartTime, EndTime, AdminID, GeofenceRadius)
+    select SessionID, StartTime, EndTime, %(admin_id)s, Radius from numbered
+), located as (
+    insert into SessionLocations (Address, Longitude, Latitude, SessionID)
+    select l.Address, l.Longitude, l.Latitude, n.SessionID from bulk_session_locations l join numbered n on n.Ord=l.Ord
+    on conflict do nothing
+)
+select Ord, SessionID from numbered;
+"""
+
+STAGE_LOCATIONS = """
+create temp table if not exists bulk_locations (
+    SessionID INT, Address VARCHAR(100), Longitude NUMERIC(9, 6), Latitude NUMERIC(8, 6)
+) on commit delete rows;
+"""
+
+INSERT_LOCATIONS = """
+insert into SessionLocations (Address, Longitude, Latitude, SessionID)
+select Address, Longitude, Latitude, SessionID from bulk_locations
+on conflict do nothing;
+"""
+
+# Sessions are exported in the same columns the import takes
+EXPORTS = {
+    # Only attendees who joined one of the admin's sessions
+    "attendees": """
+copy (
+    select a.UniqueID, a.Email, a.Fname, a.Lname, a.Address
+    from Attendees a
+    where exists (
+        select 1 from Attended_By ab join Sessions s on s.SessionID=ab.SessionID
+        where ab.UniqueID=a.UniqueID and s.AdminID={admin_id}
+    )
+    order by a.UniqueID
+) to stdout with (format csv, header)
+""",
+    "sessions": """
+copy (
+    select s.SessionID as ref, to_char(s.StartTime, 'YYYY-MM-DD HH24:MI:SS') as start_time, to_char(s.EndTime, 'YYYY-MM-DD HH24:MI:SS') as end_time,
+           s.GeofenceRadius as radius, sl.Address as address, sl.Latitude as latitude, sl.Longitude as longitude
+    from Sessions s left join SessionLocations sl on sl.SessionID=s.SessionID
+    where s.AdminID={admin_id}
+    order by s.SessionID
+) to stdout with (format csv, header)
+""",
+}
+
+class AttendeeRow(BaseModel):
+    email: EmailStr = Field(...)
+    fname: str = Field(..., max_length=15)
+    lname: str = Field(..., max_length=15)
+    password: str = Field(..., min_length=1)
+    address: str = Field(..., max_length=100)
+
+    @validator('email')
+    def check_email_length(cls, v):
+        if len(v) > 50:
+            raise ValueError('Email must be at most 50 characters')
+        return v
+
+# Consecutive rows with the same ref make up one session, each row adds one location
+class SessionRow(BaseModel):
+    ref: str = Field(..., min_length=1, max_length=100)
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
+    radius: Optional[float] = Field(None, gt=0, le=100000)
+    address: Optional[str] = Field(None, max_length=100)
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+    # NDJSON often numbers its sessions, pydantic would not turn those into strings
+    @validator('ref', pre=True)
+    def ref_as_string(cls, v):
+        if isinstance(v, int) and not isinstance(v, bool):
+            return str(v)
+        return v
+
+class LocationRow(BaseModel):
+    sessionid: int
+    address: Optional[str] = Field(None, max_length=100)
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+
+class ImportReport:
+    def __init__(self, max_errors=MAX_ERRORS):
+        self.max_errors = max_errors
+        self.rows = 0
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, row, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row, "error": message})
+
+    def result(self, **extra):
+        return {
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+            **extra,
+        }
+
+def describe(error: ValidationError):
+    return "; ".join(f"{'.'.join(str(x) for x in e['loc'])}: {e['msg']}" for e in error.errors())
+
+def clean(record):
+    # CSV has no nulls, an empty cell means the field was left out
+    return {str(k).strip().lower(): (v.strip() or None) if isinstance(v, str) else v for k, v in record.items()}
+
+async def read_lines(stream):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+async def read_records(stream, content_type):
+    """(row number, record, error) for every row of a CSV or NDJSON upload"""
+    if "ndjson" in content_type or "jsonl" in content_type:
+        row = 0
+        async for line in read_lines(stream):
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield row, None, "Expected a JSON object"
+                continue
+            yield row, clean(record), None
+        return
+
+    if "csv" not in content_type:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Upload text/csv or application/x-ndjson")
+
+    header = None
+    pending = ""
+    row = 0
+    async for line in read_lines(stream):
+        # A quoted cell may span lines, wait until the quotes are balanced
+        pending = f"{pending}\n{line}" if pending else line
+        if pending.count('"') % 2:
+            continue
+        fields = next(csv.reader([pending]), [])
+        pending = ""
+        if not any(f.strip() for f in fields):
+            continue
+        if header is None:
+            header = fields
+            continue
+        row += 1
+        if len(fields) != len(header):
+            yield row, None, f"Expected {len(header)} columns, got {len(fields)}"
+            continue
+        yield row, clean(dict(zip(header, fields))), None
+
+async def chunked(records, size=CHUNK_SIZE):
+    chunk = []
+    async for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def validate(chunk, model, report):
+    valid = []
+    for row, record, error in chunk:
+        report.rows += 1
+        if error:
+            report.error(row, error)
+            continue
+        try:
+            valid.append((row, model(**record)))
+        except ValidationError as e:
+            report.error(row, describe(e))
+    return valid
+
+async def import_attendees(records):
+    report = ImportReport()
+    async for chunk in chunked(records):
+        valid = validate(chunk, AttendeeRow, report)
+        if not valid:
+            continue
+
+        # Don't spend bcrypt time on emails that are already taken or repeated in the file
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute("select Email from Attendees where Email = any(%s);", ([x.email.lower() for _, x in valid],))
+                taken = {r[0] for r in await control.fetchall()}
+        fresh = []
+        for row, attendee in valid:
+            email = attendee.email.lower()
+            if email in taken:
+                report.error(row, "Attendee already exists")
+                continue
+            taken.add(email)
+            fresh.append((row, email, attendee))
+        if not fresh:
+            continue
+
+        # No connection is held while the workers hash
+        hashes = await passwords.hasher.hash_batch([attendee.password for _, _, attendee in fresh])
+
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute(STAGE_ATTENDEES)
+                async with control.copy("COPY bulk_attendees (Email, Fname, Lname, Passwd, Address) FROM STDIN") as copy:
+                    for (row, email, attendee), hashed in zip(fresh, hashes):
+                        await copy.write_row((email, attendee.fname, attendee.lname, hashed, attendee.address))
+                await control.execute(INSERT_ATTENDEES)
+                created = dict(await control.fetchall())
+                await connection.commit()
+
+        for row, email, attendee in fresh:
+            if email in created:
+                report.inserted += 1
+                forget_user("attendee", created[email])
+            else:
+                # Registered by someone else in the meantime
+                report.error(row, "Attendee already exists")
+    return report.result()
+
+def session_groups(valid, report):
+    """[(ref, (start, end, radius), [locations], [rows])] for the consecutive runs of each ref"""
+    runs = []
+    for row, line in valid:
+        if not runs or runs[-1][0] != line.ref:
+            runs.append((line.ref, [], []))
+        runs[-1][1].append(line)
+        runs[-1][2].append(row)
+
+    groups = []
+    for ref, lines, rows in runs:
+        first = lines[0]
+        try:
+            start_time = datetime.strptime(first.start_time or "", '%Y-%m-%d %H:%M:%S')
+            end_time = datetime.strptime(first.end_time or "", '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            for row in rows:
+                report.error(row, f"Session {ref}: invalid time format, expected YYYY-MM-DD HH:MM:SS")
+            continue
+        if start_time >= end_time:
+            for row in rows:
+                report.error(row, f"Session {ref}: start time must be before end time")
+            continue
+        radius = first.radius if first.radius is not None else DEFAULT_RADIUS_M
+        locations = [(x.address or "", x.longitude, x.latitude) for x in lines if x.latitude is not None and x.longitude is not None]
+        groups.append((ref, (start_time, end_time, radius), locations, rows))
+    return groups
+
+async def import_sessions(records, admin_id):
+    report = ImportReport()
+    # One entry per session so clients can map their refs to SessionIDs
+    created = []
+    # (ref, SessionID or None when it failed) of the previous chunk's last session. A chunk may cut a
+    # session in two, its rows at the start of the next chunk only add locations to it
+    last = None
+    async for chunk in chunked(records):
+        valid = validate(chunk, SessionRow, report)
+        if not valid:
+            continue
+        cut = 0
+        while last is not None and cut < len(valid) and valid[cut][1].ref == last[0]:
+            cut += 1
+        if cut:
+            await continue_session(last, valid[:cut], report)
+            valid = valid[cut:]
+            if not valid:
+                continue
+
+        groups = session_groups(valid, report)
+        ids = await insert_sessions(groups, admin_id, report)
+        created += ids
+        ref, row = valid[-1][1].ref, valid[-1][0]
+        last = (ref, ids[-1][1] if groups and groups[-1][3][-1] == row else None)
+    return report.result(sessions=[{"ref": ref, "sessionid": session_id} for ref, session_id in created])
+
+async def continue_session(last, valid, report):
+    """Adds the locations of rows continuing the session created from the previous chunk"""
+    ref, session_id = last
+    if session_id is None:
+        for row, line in valid:
+            report.error(row, f"Session {ref}: not created, see its earlier rows")
+        return
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await control.execute(STAGE_LOCATIONS)
+            async with control.copy("COPY bulk_locations (SessionID, Address, Longitude, Latitude) FROM STDIN") as copy:
+                for row, line in valid:
+                    if line.latitude is not None and line.longitude is not None:
+                        await copy.write_row((session_id, line.address or "", round(line.longitude, 6), round(line.latitude, 6)))
+            await control.execute(INSERT_LOCATIONS)
+            await sessions.registry.publish(control, session_id)
+            await connection.commit()
+    report.inserted += len(valid)
+    sessions.registry.invalidate(session_id)
+
+async def insert_sessions(groups, admin_id, report):
+    if not groups:
+        return []
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await control.execute(STAGE_SESSIONS)
+            async with control.copy("COPY bulk_sessions (Ord, StartTime, EndTime, Radius) FROM STDIN") as copy:
+                for index, (ref, (start_time, end_time, radius), locations, rows) in enumerate(groups):
+                    await copy.write_row((index, start_time, end_time, radius))
+            async with control.copy("COPY bulk_session_locations (Ord, Address, Longitude, Latitude) FROM STDIN") as copy:
+                for index, (ref, session, locations, rows) in enumerate(groups):
+                    for address, longitude, latitude in locations:
+                        await copy.write_row((index, address, round(longitude, 6), round(latitude, 6)))
+            await control.execute(INSERT_SESSIONS, {"admin_id": admin_id})
+            ids = dict(await control.fetchall())
+            for session_id in ids.values():
+                await sessions.registry.publish(control, session_id)
+            await connection.commit()
+
+    created = []
+    for index, (ref, session, locations, rows) in enumerate(groups):
+        report.inserted += len(rows)
+        created.append((ref, ids[index]))
+        sessions.registry.invalidate(ids[index])
+    return created
+
+async def import_locations(records, admin_id):
+    report = ImportReport()
+    touched = set()
+    async for chunk in chunked(records):
+        valid = validate(chunk, LocationRow, report)
+        if not valid:
+            continue
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute("select SessionID from Sessions where SessionID = any(%s) and AdminID=%s;", (list({x.sessionid for _, x in valid}), admin_id))
+                owned = {r[0] for r in await control.fetchall()}
+                await control.execute(STAGE_LOCATIONS)
+                async with control.copy("COPY bulk_locations (SessionID, Address, Longitude, Latitude) FROM STDIN") as copy:
+                    for row, location in valid:
+                        if location.sessionid not in owned:
+                            report.error(row, "Session not found or you are not the session manager")
+                            continue
+                        await copy.write_row((location.sessionid, location.address or "", round(location.longitude, 6), round(location.latitude, 6)))
+                        touched.add(location.sessionid)
+                await control.execute(INSERT_LOCATIONS)
+                # Locations already present are skipped, they are not errors
+                report.inserted += control.rowcount
+                await connection.commit()
+
+    # Pings already counted against the old locations are scored again
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            for session_id in sorted(touched):
+                await rebuild_session_scores(control, session_id)
+                await sessions.registry.publish(control, session_id)
+                await connection.commit()
+                sessions.registry.invalidate(session_id)
+            if touched:
+                await reports.invalidate(control, admin_id)
+                await connection.commit()
+    return report.result()
+
+async def export_csv(kind, admin_id):
+    query = sql.SQL(EXPORTS[kind]).format(admin_id=sql.Literal(admin_id))
+    async with get_read_connection(("admin", admin_id)) as connection:
+        async with get_cursor(connection) as control:
+            async with control.copy(query) as copy:
+                async for data in copy:
+                    yield bytes(data)
@@ -0,0 +1,318 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, status
+from psycopg.pq import TransactionStatus
+from psycopg_pool import AsyncConnectionPool, PoolTimeout, TooManyRequests
+import asyncio
+import logging
+import metrics
+import os
+import psycopg
+import time
+
+logger = logging.getLogger(__name__)
+
+# Created on startup so that .env.local has been loaded and we are inside the event loop
+pool = None
+
+# Set on startup when SQL_REPLICA_URL is given
+replica = None
+
+# Checkout counters on top of what psycopg_pool tracks itself
+acquire_stats = {
+    "acquired": 0,
+    "timeouts": 0,
+    "rejected": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+}
+
+class TimedCursor(psycopg.AsyncCursor):
+    """Records how long each statement takes, labelled by its text, in metrics.QUERY_SECONDS"""
+
+    async def execute(self, query, params=None, **kwargs):
+        with metrics.QUERY_SECONDS.time(metrics.statement(query)):
+            return await super().execute(query, params, **kwargs)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        with metrics.QUERY_SECONDS.time(metrics.statement(query)):
+            return await super().executemany(query, params_seq, **kwargs)
+
+# Recent checkout wait: a moving average that halves every PRESSURE_HALF_LIFE seconds without
+# checkouts, so it falls back once load is shed. Read by admission.py.
+PRESSURE_HALF_LIFE = 2.0
+pressure = {"wait": 0.0, "at": 0.0}
+
+def pool_pressure(now=None):
+    now = now or time.monotonic()
+    return pressure["wait"] * 0.5 ** ((now - pressure["at"]) / PRESSURE_HALF_LIFE)
+
+def record_wait(waited):
+    now = time.monotonic()
+    pressure["wait"] = 0.8 * pool_pressure(now) + 0.2 * waited
+    pressure["at"] = now
+
+def create_pool():
+    return AsyncConnectionPool(
+        os.getenv("SQL_URL"),
+        min_size=int(os.getenv("DB_POOL_MIN", "1")),
+        max_size=int(os.getenv("DB_POOL_MAX", "30")),
+        # Seconds a request may wait for a free connection before we answer 503
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", "5")),
+        # 0 means the wait queue is unbounded
+        max_waiting=int(os.getenv("DB_POOL_MAX_WAITING", "0")),
+        # Connections are pinged before being handed out, broken ones are replaced
+        check=AsyncConnectionPool.check_connection,
+        kwargs={"cursor_factory": TimedCursor},
+        open=False,
+    )
+
+# Seconds the replica is behind the primary: 0 when it has replayed everything it received or is
+# not a standby at all, otherwise the age of the last transaction it replayed. Null before the
+# first replayed transaction.
+REPLICA_LAG = """
+select case
+    when not pg_is_in_recovery() then 0
+    when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+    else extract(epoch from now() - pg_last_xact_replay_timestamp())
+end::float8;
+"""
+
+class ReplicaRouter:
+    """
+    A second pool on a read replica for the read-only endpoints. A read goes to the replica while
+    its last lag check, at most check_interval seconds old, answered and found it at most max_lag
+    seconds behind. Otherwise, and when no replica connection is free within timeout, it goes to
+    the primary.
+
+    A user who wrote in the last sticky seconds reads from the primary, so they see their own
+    joins and sessions. Writes are remembered per worker process, at most max_users of them, so
+    with several workers a read served by another worker than the write relies on max_lag alone.
+    """
+
+    def __init__(self, conninfo, max_lag=1.0, sticky=5.0, check_interval=1.0, timeout=0.5, min_size=1, max_size=30, max_users=100000):
+        self.max_lag = max_lag
+        self.sticky = sticky
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.max_users = max_users
+        self.pool = AsyncConnectionPool(
+            conninfo,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=timeout,
+            check=AsyncConnectionPool.check_connection,
+            kwargs={"cursor_factory": TimedCursor},
+            open=False,
+        )
+        # None until the replica answers, and again after it fails
+        self.lag = None
+        # (role, id) -> monotonic time of the user's last write
+        self.writes = OrderedDict()
+        self.monitor = None
+        self.stats = {"replica_reads": 0, "primary_reads": 0, "unavailable": 0, "lagging": 0, "sticky": 0, "fallbacks": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            os.getenv("SQL_REPLICA_URL"),
+            max_lag=float(os.getenv("DB_REPLICA_MAX_LAG", "1")),
+            sticky=float(os.getenv("DB_REPLICA_STICKY", "5")),
+            check_interval=float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "1")),
+            timeout=float(os.getenv("DB_REPLICA_TIMEOUT", "0.5")),
+            min_size=int(os.getenv("DB_REPLICA_POOL_MIN", "1")),
+            max_size=int(os.getenv("DB_REPLICA_POOL_MAX", os.getenv("DB_POOL_MAX", "30"))),
+        )
+
+    async def start(self):
+        # A replica that is down at startup is not a reason to stay down, reads use the primary
+        await self.pool.open(wait=False)
+        self.monitor = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.monitor is not None:
+            self.monitor.cancel()
+            try:
+                await self.monitor
+            except asyncio.CancelledError:
+                pass
+            self.monitor = None
+        await self.pool.close(timeout=float(os.getenv("DB_POOL_CLOSE_TIMEOUT", "10")))
+
+    async def check(self):
+        try:
+            async with self.pool.connection(timeout=self.timeout) as connection:
+                cursor = await connection.execute(REPLICA_LAG)
+                self.lag = (await cursor.fetchone())[0]
+        except Exception as e:
+            if self.lag is not None:
+                logger.warning("Replica unavailable, reading from the primary: %s", e)
+            self.lag = None
+
+    async def watch(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.check_interval)
+
+    def wrote(self, user):
+        self.writes[user] = time.monotonic()
+        self.writes.move_to_end(user)
+        if len(self.writes) > self.max_users:
+            self.writes.popitem(last=False)
+
+    def usable(self, user):
+        """Whether user's next read may go to the replica, counted by the reason when not"""
+        if self.lag is None:
+            self.stats["unavailable"] += 1
+            return False
+        if self.lag > self.max_lag:
+            self.stats["lagging"] += 1
+            return False
+        written = self.writes.get(user)
+        if written is not None:
+            if time.monotonic() - written < self.sticky:
+                self.stats["sticky"] += 1
+                return False
+            del self.writes[user]
+        return True
+
+    def failed(self):
+        self.stats["fallbacks"] += 1
+        self.lag = None
+
+    def metrics(self):
+        stats = self.pool.get_stats()
+        return {
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+            "pool_size": stats.get("pool_size", 0),
+            "pool_available": stats.get("pool_available", 0),
+            "recent_writers": len(self.writes),
+            **self.stats,
+        }
+
+async def open_pool():
+    global pool, replica
+    if pool is None:
+        pool = create_pool()
+    # Warm: startup finishes once DB_POOL_MIN connections are open and checked, not on the first requests
+    await pool.open(wait=True, timeout=float(os.getenv("DB_POOL_OPEN_TIMEOUT", "30")))
+    if replica is None and os.getenv("SQL_REPLICA_URL"):
+        replica = ReplicaRouter.from_env()
+        await replica.start()
+
+async def close_pool():
+    global pool, replica
+    if replica is not None:
+        await replica.stop()
+        replica = None
+    if pool is not None:
+        # Connections still checked out get this long to be returned before they are closed
+        await pool.close(timeout=float(os.getenv("DB_POOL_CLOSE_TIMEOUT", "10")))
+        pool = None
+
+@asynccontextmanager
+async def get_connection():
+    start = time.perf_counter()
+    try:
+        connection = await pool.getconn()
+    except PoolTimeout:
+        acquire_stats["timeouts"] += 1
+        record_wait(time.perf_counter() - start)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database is busy, please retry")
+    except TooManyRequests:
+        acquire_stats["rejected"] += 1
+        # The wait queue is full, count it as a checkout that waited the whole timeout
+        record_wait(pool.timeout)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database is busy, please retry")
+
+    waited = time.perf_counter() - start
+    metrics.POOL_WAIT_SECONDS.observe(waited)
+    record_wait(waited)
+    acquire_stats["acquired"] += 1
+    acquire_stats["wait_seconds_total"] += waited
+    acquire_stats["wait_seconds_max"] = max(acquire_stats["wait_seconds_max"], waited)
+    try:
+        yield connection
+    finally:
+        # Read-only handlers never commit, end their transaction before handing the connection back
+        if connection.info.transaction_status == TransactionStatus.INTRANS:
+            await connection.rollback()
+        await pool.putconn(connection)
+
+@asynccontextmanager
+async def get_read_connection(user=None):
+    """
+    A connection for read-only queries, on the replica when there is one that keeps up and user,
+    a (role, id) pair, has not written in the last few seconds
+    """
+    if replica is None or not replica.usable(user):
+        if replica is not None:
+            replica.stats["primary_reads"] += 1
+        async with get_connection() as connection:
+            yield connection
+        return
+
+    try:
+        connection = await replica.pool.getconn()
+    except (PoolTimeout, TooManyRequests, psycopg.OperationalError):
+        # Down or saturated, the primary takes its reads until the next lag check succeeds
+        replica.failed()
+        replica.stats["primary_reads"] += 1
+        async with get_connection() as connection:
+            yield connection
+        return
+
+    replica.stats["replica_reads"] += 1
+    try:
+        yield connection
+    finally:
+        if connection.info.transaction_status == TransactionStatus.INTRANS:
+            await connection.rollback()
+        await replica.pool.putconn(connection)
+
+def wrote(user):
+    """Sends user's reads to the primary for a while, call once their write has committed"""
+    if replica is not None:
+        replica.wrote(user)
+
+@asynccontextmanager
+async def get_cursor(connection, name=None):
+    # A name opens a server-side cursor, rows are fetched as they are iterated
+    cursor = connection.cursor(name) if name else connection.cursor()
+    try:
+        yield cursor
+    finally:
+        await cursor.close()
+
+def pool_metrics():
+    if pool is None:
+        return {"open": False, **acquire_stats}
+    if replica is not None:
+        return {**primary_metrics(), "replica": replica.metrics()}
+    return primary_metrics()
+
+def replica_metrics():
+    return None if replica is None else replica.metrics()
+
+def primary_metrics():
+    stats = pool.get_stats()
+    size = stats.get("pool_size", 0)
+    available = stats.get("pool_available", 0)
+    max_size = stats.get("pool_max", pool.max_size)
+    in_use = size - available
+    return {
+        "open": True,
+        "pool_min": stats.get("pool_min", pool.min_size),
+        "pool_max": max_size,
+        "pool_size": size,
+        "pool_available": available,
+        "in_use": in_use,
+        "utilization": in_use / max_size if max_size else 0.0,
+        "requests_waiting": stats.get("requests_waiting", 0),
+        "requests_queued": stats.get("requests_queued", 0),
+        "requests_wait_ms": stats.get("requests_wait_ms", 0),
+        "connections_errors": stats.get("connections_errors", 0),
+        "connections_lost": stats.get("connections_lost", 0),
+        **acquire_stats,
+    }
@@ -0,0 +1,229 @@
+"""
+Dwell compression of location pings. An attendee sitting in class sends the same position every
+few seconds; a run of such pings is stored as one AttendeesLocations row holding the position of
+its first ping, the time of its first ping in LocationTimestamp and of its last in EndTimestamp,
+and the number of pings in PingCount.
+
+A ping only joins a run when recomputing attendance from the run's row gives the same verdicts
+as from the pings themselves: it is within tolerance_m of the run's position, the run's position
+is more than tolerance_m from the edge of every running session's geofence, and no session starts
+or ends during the run. Runs are closed whenever the worker's cached sessions change, so a session
+created while a run is open only misses the pings merged before the worker heard of it (at most
+SESSION_CACHE_TTL seconds with the local cache backend). Every ping in a run is then inside or outside the
+same fences and the same session windows as its first one, so attendance.score_pings weighting
+each row by PingCount counts exactly what it counted from the raw pings. AttendanceScores is kept
+up to date from the pings themselves and does not depend on any of this.
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from geofence import haversine_m
+import os
+
+# Adds the pings merged since the row was last written, found by the values it was written with
+EXTEND_DWELLS = """
+update AttendeesLocations al
+set EndTimestamp=d.last_ts, PingCount=al.PingCount+d.added
+from unnest(%(ids)s::int[], %(starts)s::timestamp[], %(written_ends)s::timestamp[], %(latitudes)s::numeric[],
+            %(longitudes)s::numeric[], %(last_ts)s::timestamp[], %(added)s::int[])
+     d(unique_id, start_ts, written_end, latitude, longitude, last_ts, added)
+where al.UniqueID=d.unique_id and al.LocationTimestamp=d.start_ts and al.EndTimestamp=d.written_end
+and al.Latitude=d.latitude and al.Longitude=d.longitude
+returning al.UniqueID, al.LocationTimestamp;
+"""
+
+# Set on startup unless PING_DWELL_TOLERANCE_M=0
+compressor = None
+
+class Dwell:
+    def __init__(self, latitude, longitude, start, end_bound, start_bound):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.start = start
+        self.end = start
+        # The run has to stop before the next session start and by the first session end
+        self.end_bound = end_bound
+        self.start_bound = start_bound
+        # The row while it is part of the batch being written, afterwards the EndTimestamp it
+        # was written with and the pings merged since
+        self.row = None
+        self.written_end = None
+        self.added = 0
+        self.added_from = None
+        # Pings since the last one that fit, a single stray one does not end the run
+        self.misfits = 0
+
+class DwellCompressor:
+    """
+    Open runs per attendee, at most max_open of them, least recently pinged dropped first. A run
+    ends after a gap of more than max_gap seconds between pings, once it spans max_span seconds or
+    when two pings in a row are too far from it, a single one is stored as a row of its own.
+
+    plan() turns pings into rows to insert and runs to extend and assumes they get written. When
+    the transaction fails, forget() the pings so their runs are started afresh.
+    """
+
+    def __init__(self, tolerance_m=5.0, max_gap=60.0, max_span=1800.0, max_open=100000):
+        self.tolerance_m = tolerance_m
+        # Slack for the Python and numpy haversines disagreeing in the last digits
+        self.margin_m = tolerance_m + 0.01
+        self.max_gap = timedelta(seconds=max_gap)
+        self.max_span = timedelta(seconds=max_span)
+        self.max_open = max_open
+        self.open = OrderedDict()
+        # The registry drops a session once it ends, pings queued before that still need it
+        self.sessions = {}
+        self.stats = {"pings": 0, "rows": 0, "extended": 0, "near_boundary": 0, "missed": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            tolerance_m=float(os.getenv("PING_DWELL_TOLERANCE_M", "5")),
+            max_gap=float(os.getenv("PING_DWELL_MAX_GAP", "60")),
+            max_span=float(os.getenv("PING_DWELL_MAX_SPAN", "1800")),
+            max_open=int(os.getenv("PING_DWELL_OPEN", "100000")),
+        )
+
+    def begin(self, latitude, longitude, at):
+        """A run starting with this ping, or None when the next ping may already score differently"""
+        end_bound = start_bound = datetime.max
+        for session in self.sessions.values():
+            if session.start_time > at:
+                start_bound = min(start_bound, session.start_time)
+            elif at <= session.end_time:
+                end_bound = min(end_bound, session.end_time)
+                # A session without locations yet may get them
+                if session.fence is None or session.fence.near_boundary(latitude, longitude, self.margin_m):
+                    self.stats["near_boundary"] += 1
+                    return None
+        return Dwell(latitude, longitude, at, end_bound, start_bound)
+
+    def lasts(self, dwell, at):
+        return (
+            dwell.end <= at <= dwell.end + self.max_gap
+            and at - dwell.start <= self.max_span
+            and at <= dwell.end_bound and at < dwell.start_bound
+        )
+
+    def plan(self, pings, sessions):
+        """
+        ([UniqueID, Latitude, Longitude, LocationTimestamp, EndTimestamp, PingCount] rows to insert,
+        runs already written to extend) for pings in time order and the sessions known to the worker
+        """
+        changed = False
+        for session in sessions:
+            known = self.sessions.get(session.session_id)
+            if known is not session:
+                # Reloads hand out new objects for unchanged sessions
+                if known is None or known[:5] != session[:5] or sorted(known.locations) != sorted(session.locations):
+                    changed = True
+                self.sessions[session.session_id] = session
+        if changed:
+            # A new or moved session may start, end or draw its fence inside an open run
+            self.open.clear()
+        rows = []
+        started = []
+        extended = {}
+        for unique_id, latitude, longitude, timestamp in pings:
+            at = timestamp if isinstance(timestamp, datetime) else datetime.fromisoformat(timestamp)
+            # As AttendeesLocations stores them
+            latitude, longitude = round(float(latitude), 6), round(float(longitude), 6)
+            dwell = self.open.get(unique_id)
+            if dwell is not None and self.lasts(dwell, at):
+                if haversine_m(dwell.latitude, dwell.longitude, latitude, longitude) <= self.tolerance_m:
+                    self.open.move_to_end(unique_id)
+                    dwell.misfits = 0
+                    dwell.end = at
+                    if dwell.row is not None:
+                        dwell.row[4] = at
+                        dwell.row[5] += 1
+                    else:
+                        if not dwell.added:
+                            dwell.added_from = at
+                        dwell.added += 1
+                        extended[unique_id] = dwell
+                    continue
+                dwell.misfits += 1
+                if dwell.misfits == 1:
+                    # Most likely a GPS outlier, stored on its own while the run goes on
+                    rows.append([unique_id, latitude, longitude, at, at, 1])
+                    continue
+
+            row = [unique_id, latitude, longitude, at, at, 1]
+            rows.append(row)
+            dwell = self.begin(latitude, longitude, at)
+            if dwell is None:
+                self.open.pop(unique_id, None)
+                continue
+            dwell.row = row
+            started.append(dwell)
+            self.open[unique_id] = dwell
+            self.open.move_to_end(unique_id)
+            if len(self.open) > self.max_open:
+                self.open.popitem(last=False)
+
+        extends = []
+        for unique_id, dwell in extended.items():
+            extends.append((unique_id, dwell.start, dwell.written_end, dwell.latitude, dwell.longitude, dwell.end, dwell.added, dwell.added_from))
+            dwell.written_end = dwell.end
+            dwell.added = 0
+        for dwell in started:
+            dwell.written_end = dwell.end
+            dwell.row = None
+        if pings:
+            # Kept an hour past their end for batches that are retried
+            cutoff = min(row[3] for row in rows) if rows else at
+            for session_id in [s.session_id for s in self.sessions.values() if s.end_time < cutoff - timedelta(hours=1)]:
+                del self.sessions[session_id]
+        self.stats["pings"] += len(pings)
+        self.stats["rows"] += len(rows)
+        self.stats["extended"] += len(extends)
+        return rows, extends
+
+    def missed(self, extends, found):
+        """Rows for the runs whose row was not found, e.g. written by a transaction that has not committed"""
+        found = set(found)
+        rows = []
+        for unique_id, start, _, latitude, longitude, end, added, added_from in extends:
+            if (unique_id, start) not in found:
+                rows.append([unique_id, latitude, longitude, added_from, end, added])
+                self.open.pop(unique_id, None)
+        self.stats["missed"] += len(rows)
+        self.stats["rows"] += len(rows)
+        return rows
+
+    def forget(self, pings):
+        for ping in pings:
+            self.open.pop(ping[0], None)
+
+    def metrics(self):
+        return {
+            "open": len(self.open),
+            "tolerance_m": self.tolerance_m,
+            "compression_ratio": self.stats["pings"] / self.stats["rows"] if self.stats["rows"] else None,
+            **self.stats,
+        }
+
+def extend_params(extends):
+    columns = list(zip(*extends))
+    return {
+        "ids": list(columns[0]),
+        "starts": list(columns[1]),
+        "written_ends": list(columns[2]),
+        "latitudes": list(columns[3]),
+        "longitudes": list(columns[4]),
+        "last_ts": list(columns[5]),
+        "added": list(columns[6]),
+    }
+
+def forget(pings):
+    if compressor is not None:
+        compressor.forget(pings)
+
+def start_compressor():
+    global compressor
+    if float(os.getenv("PING_DWELL_TOLERANCE_M", "5")) > 0:
+        compressor = DwellCompressor.from_env()
+
+def stop_compressor():
+    global compressor
+    compressor = None
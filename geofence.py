@@ -0,0 +1,87 @@
+from math import asin, ceil, cos, floor, radians, sin, sqrt
+import os
+
+EARTH_RADIUS_M = 6371008.8
+
+# Used for sessions created without an explicit radius
+DEFAULT_RADIUS_M = float(os.getenv("DEFAULT_GEOFENCE_RADIUS", "100"))
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * asin(min(1.0, sqrt(a)))
+
+def unit_vector(lat, lon):
+    lat, lon = radians(lat), radians(lon)
+    return (cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat))
+
+class GeofenceIndex:
+    """
+    The locations of one session bucketed on a 3D grid over the unit sphere.
+
+    Points are placed by their unit vector, so straight-line (chord) distance between two points
+    grows with their distance along the ground, with no special cases for longitude shrinking
+    towards the poles or wrapping at +/-180. The grid cell is the chord of the radius, so every
+    location within the radius of a point sits in the point's cell or one of its 26 neighbours
+    and a lookup only measures those candidates, however many locations the session has.
+    """
+
+    def __init__(self, locations, radius_m=DEFAULT_RADIUS_M):
+        self.radius_m = float(radius_m)
+        # Chord length on the unit sphere for an arc of radius_m
+        self.cell = max(2 * sin(min(self.radius_m / EARTH_RADIUS_M, 3.14159) / 2), 1e-9)
+        self.buckets = {}
+        self.size = 0
+        for lat, lon in locations:
+            self.add(float(lat), float(lon))
+
+    def key(self, vector):
+        return (floor(vector[0] / self.cell), floor(vector[1] / self.cell), floor(vector[2] / self.cell))
+
+    def add(self, lat, lon):
+        self.buckets.setdefault(self.key(unit_vector(lat, lon)), []).append((lat, lon))
+        self.size += 1
+
+    def candidates(self, lat, lon, ring=1):
+        # Every location within ring cells along each axis, a chord of up to ring * cell is covered
+        x, y, z = self.key(unit_vector(lat, lon))
+        offsets = range(-ring, ring + 1)
+        for dx in offsets:
+            for dy in offsets:
+                for dz in offsets:
+                    bucket = self.buckets.get((x + dx, y + dy, z + dz))
+                    if bucket:
+                        yield from bucket
+
+    def nearest(self, lat, lon):
+        """Distance in metres to the closest location within the radius, or None"""
+        lat, lon = float(lat), float(lon)
+        best = None
+        for location_lat, location_lon in self.candidates(lat, lon):
+            distance = haversine_m(lat, lon, location_lat, location_lon)
+            if distance <= self.radius_m and (best is None or distance < best):
+                best = distance
+        return best
+
+    def contains(self, lat, lon):
+        lat, lon = float(lat), float(lon)
+        for location_lat, location_lon in self.candidates(lat, lon):
+            if haversine_m(lat, lon, location_lat, location_lon) <= self.radius_m:
+                return True
+        return False
+
+    def near_boundary(self, lat, lon, margin_m):
+        """Whether a point within margin_m of (lat, lon) could be on the other side of the fence from it"""
+        if self.radius_m <= 0:
+            return True
+        lat, lon = float(lat), float(lon)
+        if self.size <= 8:
+            # Cheaper to measure them all than to look up the cells
+            locations = (location for bucket in self.buckets.values() for location in bucket)
+        else:
+            # Locations outside these cells are more than radius + margin_m away
+            locations = self.candidates(lat, lon, 1 + ceil(margin_m / self.radius_m))
+        for location_lat, location_lon in locations:
+            if abs(haversine_m(lat, lon, location_lat, location_lon) - self.radius_m) <= margin_m:
+                return True
+        return False
@@ -0,0 +1,144 @@
+"""
+Keyset-paginated and streamed session history for /get-sessions-created, /my-sessions and
+/get-attended-sessions.
+
+Sessions are ordered newest first by (StartTime, SessionID). A page ends with an opaque cursor
+holding that pair for its last session, and the next page starts strictly after it, so pages stay
+cheap however deep the client goes. Streaming reads a server-side cursor and writes one session
+per NDJSON line, so memory stays flat for any history length.
+"""
+from fastapi import HTTPException, status
+from pydantic import BaseModel
+from db import get_read_connection, get_cursor
+from datetime import datetime
+from typing import List, Optional
+import base64
+import json
+
+class SessionLocation(BaseModel):
+    latitude: float
+    longitude: float
+
+class SessionSummary(BaseModel):
+    sessionid: int
+    starttime: datetime
+    endtime: datetime
+    adminid: Optional[int] = None
+
+class SessionWithLocations(SessionSummary):
+    locations: List[SessionLocation] = []
+
+class SessionPage(BaseModel):
+    sessions: List[SessionSummary]
+    next_cursor: Optional[str] = None
+
+class AttendedSessionPage(BaseModel):
+    sessions: List[SessionWithLocations]
+    next_cursor: Optional[str] = None
+
+AFTER = " and (s.StartTime, s.SessionID) < (%(after_start)s, %(after_id)s)"
+
+# {after} is replaced by AFTER when a cursor is given, limit null means no limit
+QUERIES = {
+    "created": """
+select s.SessionID, s.StartTime, s.EndTime, s.AdminID
+from Sessions s
+where s.AdminID=%(user_id)s{after}
+order by s.StartTime desc, s.SessionID desc
+limit %(limit)s;
+""",
+    "joined": """
+select s.SessionID, s.StartTime, s.EndTime, s.AdminID
+from Attended_By ab
+join Sessions s on s.SessionID=ab.SessionID
+where ab.UniqueID=%(user_id)s{after}
+order by s.StartTime desc, s.SessionID desc
+limit %(limit)s;
+""",
+    # The limit counts sessions, so the locations are joined after picking the page
+    "attended": """
+with page as (
+    select s.SessionID, s.StartTime, s.EndTime, s.AdminID
+    from Attended_By ab
+    join Sessions s on s.SessionID=ab.SessionID
+    where ab.UniqueID=%(user_id)s{after}
+    order by s.StartTime desc, s.SessionID desc
+    limit %(limit)s
+)
+select p.SessionID, p.StartTime, p.EndTime, p.AdminID, sl.Latitude::float8, sl.Longitude::float8
+from page p
+left join SessionLocations sl on sl.SessionID=p.SessionID
+order by p.StartTime desc, p.SessionID desc;
+""",
+}
+
+def reader(kind, user_id):
+    # The (role, id) whose own writes the history has to show, see db.get_read_connection
+    return ("admin" if kind == "created" else "attendee", user_id)
+
+def encode_cursor(session):
+    raw = json.dumps([session.starttime.isoformat(), session.sessionid]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor):
+    try:
+        start, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(start), int(session_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+def query(kind, cursor, limit):
+    params = {"limit": limit, "after_start": None, "after_id": None}
+    if cursor:
+        params["after_start"], params["after_id"] = decode_cursor(cursor)
+    return QUERIES[kind].format(after=AFTER if cursor else ""), params
+
+async def sessions_from(kind, rows):
+    """Typed sessions from the rows of a query, locations folded into their session for "attended" """
+    if kind != "attended":
+        async for row in rows:
+            yield SessionSummary(sessionid=row[0], starttime=row[1], endtime=row[2], adminid=row[3])
+        return
+
+    current = None
+    async for row in rows:
+        if current is None or current.sessionid != row[0]:
+            if current is not None:
+                yield current
+            current = SessionWithLocations(sessionid=row[0], starttime=row[1], endtime=row[2], adminid=row[3])
+        if row[4] is not None:
+            current.locations.append(SessionLocation(latitude=row[4], longitude=row[5]))
+    if current is not None:
+        yield current
+
+async def page(kind, user_id, cursor=None, limit=50):
+    sql, params = query(kind, cursor, limit + 1)
+    params["user_id"] = user_id
+    async with get_read_connection(reader(kind, user_id)) as connection:
+        async with get_cursor(connection) as control:
+            await control.execute(sql, params)
+            # One extra session tells whether there is a next page
+            sessions = [s async for s in sessions_from(kind, control)]
+
+    next_cursor = None
+    if len(sessions) > limit:
+        sessions = sessions[:limit]
+        next_cursor = encode_cursor(sessions[-1])
+    if kind == "attended":
+        return AttendedSessionPage(sessions=sessions, next_cursor=next_cursor)
+    return SessionPage(sessions=sessions, next_cursor=next_cursor)
+
+def stream(kind, user_id, cursor=None):
+    # Checked here rather than in the generator, a bad cursor is a 400 and not a broken stream
+    sql, params = query(kind, cursor, None)
+    params["user_id"] = user_id
+    return ndjson(kind, sql, params)
+
+async def ndjson(kind, sql, params):
+    async with get_read_connection(reader(kind, params["user_id"])) as connection:
+        # Server-side cursor, rows are fetched itersize at a time while the response is written
+        async with get_cursor(connection, name="history") as control:
+            control.itersize = 500
+            await control.execute(sql, params)
+            async for session in sessions_from(kind, control):
+                yield session.model_dump_json() + "\n"
@@ -0,0 +1,203 @@
+from fastapi import HTTPException, status
+from db import get_connection, get_cursor
+from scores import record_pings
+import dwell
+import presence
+import sessions
+import asyncio
+import logging
+import os
+import psycopg
+import time
+
+logger = logging.getLogger(__name__)
+
+COPY_PINGS = "COPY AttendeesLocations (UniqueID, Latitude, Longitude, LocationTimestamp) FROM STDIN"
+INSERT_PING = "insert into AttendeesLocations (UniqueID, Latitude, Longitude, LocationTimestamp) values (%s, %s, %s, %s);"
+COPY_DWELLS = "COPY AttendeesLocations (UniqueID, Latitude, Longitude, LocationTimestamp, EndTimestamp, PingCount) FROM STDIN"
+
+async def store_pings(control, pings):
+    """Write pings to AttendeesLocations, runs of them collapsed into dwell rows when dwell.py is on"""
+    if dwell.compressor is None or sessions.registry is None:
+        async with control.copy(COPY_PINGS) as copy:
+            for ping in pings:
+                await copy.write_row(ping)
+        return
+
+    rows, extends = dwell.compressor.plan(pings, await sessions.registry.known())
+    if extends:
+        await control.execute(dwell.EXTEND_DWELLS, dwell.extend_params(extends))
+        rows += dwell.compressor.missed(extends, await control.fetchall())
+    async with control.copy(COPY_DWELLS) as copy:
+        for row in rows:
+            await copy.write_row(row)
+
+# Set on startup when PING_INGEST_MODE=buffered, otherwise pings are written inline
+ingestor = None
+
+class PingIngestor:
+    """
+    Acknowledges location pings immediately and writes them to AttendeesLocations from a
+    background task, one COPY per batch. A batch is flushed once it holds batch_size pings or
+    flush_interval seconds after its first ping, whichever comes first.
+
+    The queue is bounded: when it is full, submit() waits up to enqueue_timeout for room and then
+    answers 503 so clients back off instead of the process growing without limit.
+    """
+
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=0.5, enqueue_timeout=0.05, max_retries=3):
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.max_retries = max_retries
+        self.closing = False
+        self.task = None
+        self.stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "flushed": 0,
+            "dropped": 0,
+            "batches": 0,
+            "flush_errors": 0,
+            "flush_seconds_last": 0.0,
+            "flush_seconds_total": 0.0,
+            "flush_seconds_max": 0.0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_queue=int(os.getenv("PING_QUEUE_SIZE", "10000")),
+            batch_size=int(os.getenv("PING_BATCH_SIZE", "500")),
+            flush_interval=float(os.getenv("PING_FLUSH_INTERVAL", "0.5")),
+            enqueue_timeout=float(os.getenv("PING_ENQUEUE_TIMEOUT", "0.05")),
+        )
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def submit(self, ping):
+        if self.closing:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server is shutting down", headers={"Retry-After": "5"})
+        try:
+            self.queue.put_nowait(ping)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(ping), self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["rejected"] += 1
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many location updates, retry later", headers={"Retry-After": "1"})
+        self.stats["enqueued"] += 1
+
+    async def stop(self, timeout=10.0):
+        # Refuse new pings, let the writer empty the queue, then give up after timeout
+        self.closing = True
+        if self.task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.put(None), timeout)
+            await asyncio.wait_for(self.task, timeout)
+        except asyncio.TimeoutError:
+            self.task.cancel()
+            self.stats["dropped"] += self.queue.qsize()
+            logger.error("Ping writer did not drain within %ss, %s pings lost", timeout, self.queue.qsize())
+
+    async def next_batch(self):
+        first = await self.queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                ping = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    ping = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if ping is None:
+                return batch, True
+            batch.append(ping)
+        return batch, False
+
+    async def run(self):
+        finished = False
+        while not finished:
+            batch, finished = await self.next_batch()
+            if batch:
+                await self.flush(batch)
+
+    async def flush(self, batch):
+        for attempt in range(self.max_retries):
+            start = time.perf_counter()
+            try:
+                written = await self.write(batch)
+            except Exception:
+                dwell.forget(batch)
+                self.stats["flush_errors"] += 1
+                logger.exception("Writing %s pings failed (attempt %s)", len(batch), attempt + 1)
+                await asyncio.sleep(0.1 * 2 ** attempt)
+                continue
+
+            elapsed = time.perf_counter() - start
+            self.stats["batches"] += 1
+            self.stats["flushed"] += written
+            self.stats["dropped"] += len(batch) - written
+            self.stats["flush_seconds_last"] = elapsed
+            self.stats["flush_seconds_total"] += elapsed
+            self.stats["flush_seconds_max"] = max(self.stats["flush_seconds_max"], elapsed)
+            return
+        self.stats["dropped"] += len(batch)
+
+    async def write(self, batch):
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                try:
+                    await store_pings(control, batch)
+                except (psycopg.DataError, psycopg.errors.RaiseException):
+                    # A malformed row or the attendee check trigger fails the whole COPY
+                    await connection.rollback()
+                    dwell.forget(batch)
+                else:
+                    events = presence.ping_events(await record_pings(control, batch))
+                    await presence.broker.publish(control, events)
+                    await connection.commit()
+                    presence.broker.committed(events)
+                    return len(batch)
+
+                # Fall back to row by row so one bad ping does not sink the batch, each row in
+                # its own savepoint so a retry after a failure never writes a ping twice. These
+                # are written uncompressed.
+                written = []
+                async with connection.transaction():
+                    for ping in batch:
+                        try:
+                            async with connection.transaction():
+                                await control.execute(INSERT_PING, ping)
+                            written.append(ping)
+                        except (psycopg.DataError, psycopg.errors.RaiseException):
+                            pass
+                    events = presence.ping_events(await record_pings(control, written))
+                    await presence.broker.publish(control, events)
+                presence.broker.committed(events)
+                return len(written)
+
+    def metrics(self):
+        return {"queue_depth": self.queue.qsize(), "queue_capacity": self.queue.maxsize, **self.stats}
+
+def start_ingestor():
+    global ingestor
+    if os.getenv("PING_INGEST_MODE", "direct") == "buffered":
+        ingestor = PingIngestor.from_env()
+        ingestor.start()
+
+async def stop_ingestor():
+    global ingestor
+    if ingestor is not None:
+        await ingestor.stop(timeout=float(os.getenv("PING_DRAIN_TIMEOUT", "10")))
+        ingestor = None
@@ -1,20 +1,66 @@
-from decimal import Decimal
-from fastapi import FastAPI, status, HTTPException
+from fastapi import FastAPI, Request, status, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr, Field, validator
 from dotenv import load_dotenv
-from psycopg2 import pool
-from contextlib import contextmanager
-import bcrypt
-import os
-from jose import jwt
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+
+# Before the local modules, some of them read their settings on import
+load_dotenv('.env.local')
+
+from db import get_connection, get_read_connection, get_cursor, wrote, open_pool, close_pool, pool_metrics, replica_metrics
+import ingest
+import dwell
+import passwords
+import sessions
+import retention
+import bulk
+import history
+import presence
+import metrics
+import ratelimit
+import admission
+import reports
+import uploads
+from responses import FastJSONResponse, model_response
+from auth import create_jwt_token, decode_jwt_token, require_user, forget_user, auth_metrics
+from geofence import DEFAULT_RADIUS_M
+from attendance import student_attendance
+from scores import record_pings, rebuild_session_scores
 from pytz import timezone
 from typing import Tuple, Optional
 from datetime import datetime
+import asyncio
 import re
-
-app = FastAPI()
+import threading
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_pool()
+    await ratelimit.start_limiter()
+    await retention.start_maintainer()
+    await presence.start_broker()
+    dwell.start_compressor()
+    ingest.start_ingestor()
+    await passwords.start_hasher()
+    await sessions.start_registry()
+    reports.start_queue()
+    yield
+    await reports.stop_queue()
+    await sessions.stop_registry()
+    await passwords.stop_hasher()
+    await ingest.stop_ingestor()
+    dwell.stop_compressor()
+    await presence.stop_broker()
+    await retention.stop_maintainer()
+    await ratelimit.stop_limiter()
+    await close_pool()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+
+app.add_middleware(admission.AdmissionMiddleware)
+
+app.add_middleware(metrics.LatencyMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,52 +70,84 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-load_dotenv('.env.local')
-
-SQL_URL=os.getenv("SQL_URL")
-JWT_SECRET = os.getenv("JWT_SECRET")
-ALGORITHM = 'HS256'
-
-connection_pool = pool.SimpleConnectionPool(1, 30, dsn=SQL_URL)
-
-@contextmanager
-def get_connection():
-    connection = connection_pool.getconn()
-    try:
-        yield connection
-    finally:
-        connection_pool.putconn(connection)
-
-@contextmanager
-def get_cursor(connection):
-    cursor = connection.cursor()
-    try:
-        yield cursor
-    finally:
-        cursor.close()
-
 @app.get("/hello")
-def hello():
+async def hello():
     return {"Hello": "World"}
 
 @app.get("/robots.txt")
-def robots_begone():
+async def robots_begone():
     return {"User-agent":"*","Disallow":"/"}
 
-def hash_password(password: str):
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    return hashed_password.decode('utf-8')
-
-def create_jwt_token(data: dict):
-    to_encode = data.copy()
-    # Add 14 days to the current time in IST and format the result
-    exp_time = datetime.now(timezone("Asia/Kolkata")) + timedelta(days=14)
-    to_encode.update({"exp": exp_time})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=ALGORITHM)
-    return encoded_jwt
-
-def decode_jwt_token(tok: str):
-    return jwt.decode(tok, JWT_SECRET, algorithms=[ALGORITHM])
+@app.get("/pool-stats")
+async def return_pool_stats():
+    return pool_metrics()
+
+@app.get("/ingest-stats")
+async def return_ingest_stats():
+    stats = {"mode": "direct"} if ingest.ingestor is None else {"mode": "buffered", **ingest.ingestor.metrics()}
+    if dwell.compressor is not None:
+        stats["dwell"] = dwell.compressor.metrics()
+    stats["uploads"] = uploads.upload_metrics()
+    return stats
+
+@app.get("/password-stats")
+async def return_password_stats():
+    return passwords.hasher.metrics()
+
+@app.get("/auth-stats")
+async def return_auth_stats():
+    return auth_metrics()
+
+@app.get("/session-cache-stats")
+async def return_session_cache_stats():
+    return sessions.registry.metrics()
+
+@app.get("/presence-stats")
+async def return_presence_stats():
+    return presence.broker.metrics()
+
+@app.get("/admission-stats")
+async def return_admission_stats():
+    return {"rate_limits": ratelimit.limiter.metrics(), "admission": admission.admission_metrics()}
+
+@app.get("/report-stats")
+async def return_report_stats():
+    return {"workers": 0} if reports.queue is None else reports.queue.metrics()
+
+@app.get("/metrics")
+async def return_metrics():
+    tokens = auth_metrics()
+    stats = {
+        "pool": pool_metrics(),
+        "password": passwords.hasher.metrics(),
+        "token_cache": tokens["tokens"],
+        "id_cache": tokens["ids"],
+        "session_cache": sessions.registry.metrics(),
+        "presence": presence.broker.metrics(),
+        "rate_limit": ratelimit.limiter.metrics(),
+        "admission": admission.admission_metrics(),
+        "uploads": uploads.upload_metrics(),
+    }
+    if replica_metrics() is not None:
+        stats["replica"] = replica_metrics()
+    if ingest.ingestor is not None:
+        stats["ingest"] = ingest.ingestor.metrics()
+    if dwell.compressor is not None:
+        stats["dwell"] = dwell.compressor.metrics()
+    if reports.queue is not None:
+        stats["reports"] = reports.queue.metrics()
+    return PlainTextResponse(metrics.render(stats), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def capture_profile(tok: str, seconds: float = 10.0):
+    """Collapsed stacks of the event loop thread, sampled for the given seconds, when PROFILER_ENABLED=1"""
+    if not metrics.PROFILER_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profiler is disabled")
+    require_admin(tok)
+    collapsed = await asyncio.to_thread(metrics.profile, threading.get_ident(), seconds)
+    if collapsed is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A profile is already running")
+    return PlainTextResponse(collapsed)
 
 class Admin(BaseModel):
     email: EmailStr = Field(..., description="Email of the admin")
@@ -85,30 +163,31 @@ curl -X POST "http://127.0.0.1:8000/auth/register-admin" \
 -d '{"email": "abcd@gmail.com", "fname": "ab", "lname": "cd", "password": "123"}' 
 """
 @app.post("/auth/register-admin")
-def register_admin(admin: Admin):
+async def register_admin(admin: Admin):
     email = admin.email.lower()  # Lowercase the email to maintain consistency
     fname = admin.fname
     lname = admin.lname
     password = admin.password
 
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
             # Check if admin already exists
-            control.execute("SELECT 1 FROM Admins WHERE Email = %s;", (email,))
-            existing_admins = control.fetchone()
+            await control.execute("SELECT 1 FROM Admins WHERE Email = %s;", (email,))
+            existing_admins = await control.fetchone()
             if existing_admins:
                 raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Admin already exists")
             
             # Hash password
-            hashed_passwd = hash_password(password)
+            hashed_passwd = await passwords.hasher.hash(password)
             
             # Insert new admin and get the ID
-            control.execute(
+            await control.execute(
                 "INSERT INTO Admins (Email, FirstName, LastName, Passwd) VALUES (%s, %s, %s, %s) RETURNING AdminID;",
                 (email, fname, lname, hashed_passwd)
             )
-            last_row_id = control.fetchone()[0]
-            connection.commit()
+            last_row_id = (await control.fetchone())[0]
+            await connection.commit()
+    forget_user("admin", last_row_id)
 
     # Generate JWT token
     access_token = create_jwt_token({"id": last_row_id, "email": email, "role": "admin", "fname": fname, "lname": lname})
@@ -124,31 +203,32 @@ class Attendee(BaseModel):
 
 # Register attendee endpoint
 @app.post("/auth/register-attendee")
-def register_attendee(attendee: Attendee):
+async def register_attendee(attendee: Attendee):
     email = attendee.email.lower()
     fname = attendee.fname
     lname = attendee.lname
     password = attendee.password
     address = attendee.address
 
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
             # Check if attendee already exists
-            control.execute("SELECT 1 FROM Attendees WHERE Email = %s;", (email,))
-            existing_attendees = control.fetchone()
+            await control.execute("SELECT 1 FROM Attendees WHERE Email = %s;", (email,))
+            existing_attendees = await control.fetchone()
             if existing_attendees:
                 raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Attendee already exists")
             
             # Hash password
-            hashed_passwd = hash_password(password)
+            hashed_passwd = await passwords.hasher.hash(password)
 
             # Insert new attendee and get the ID
-            control.execute(
+            await control.execute(
                 "INSERT INTO Attendees (Email, Fname, Lname, Passwd, Address) VALUES (%s, %s, %s, %s, %s) RETURNING UniqueID;",
                 (email, fname, lname, hashed_passwd, address)
             )
-            last_row_id = control.fetchone()[0]
-            connection.commit()
+            last_row_id = (await control.fetchone())[0]
+            await connection.commit()
+    forget_user("attendee", last_row_id)
     
     # Generate JWT token
     access_token = create_jwt_token({"id": last_row_id, "email": email, "role": "attendee", "fname": fname, "lname": lname})
@@ -161,16 +241,23 @@ class Login(BaseModel):
 
 # Admin login endpoint
 @app.post("/auth/login-admin")
-def login_admin(details: Login):
+async def login_admin(details: Login, request: Request):
     email = details.email.lower()
     password = details.password
+    await ratelimit.limiter.check("login_ip", request.client.host if request.client else "")
+    await ratelimit.limiter.check("login", email)
 
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
             # Check if admin exists and verify password
-            control.execute("SELECT AdminID, FirstName, LastName, Passwd FROM Admins WHERE Email = %s;", (email,))
-            match = control.fetchone()
-            if match and bcrypt.checkpw(password.encode('utf-8'), match[3].strip().encode('utf-8')):  # Verify hashed password
+            await control.execute("SELECT AdminID, FirstName, LastName, Passwd FROM Admins WHERE Email = %s;", (email,))
+            match = await control.fetchone()
+            if match and await passwords.hasher.verify(password, match[3]):  # Verify hashed password
+                # Bring the hash up to the configured cost while we have the plain password
+                rehashed = await passwords.hasher.rehash(password, match[3])
+                if rehashed:
+                    await control.execute("UPDATE Admins SET Passwd = %s WHERE AdminID = %s;", (rehashed, match[0]))
+                    await connection.commit()
                 access_token = create_jwt_token({
                     "id": match[0],
                     "email": email,
@@ -183,16 +270,23 @@ def login_admin(details: Login):
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Please sign up first")
 
 @app.post("/auth/login-attendee")
-def login_attendee(details: Login):
+async def login_attendee(details: Login, request: Request):
     email = details.email.lower()
     password = details.password
+    await ratelimit.limiter.check("login_ip", request.client.host if request.client else "")
+    await ratelimit.limiter.check("login", email)
 
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
             # Check if attendee exists and verify password
-            control.execute("SELECT UniqueID, Fname, Lname, Passwd FROM Attendees WHERE Email = %s;", (email,))
-            match = control.fetchone()
-            if match and bcrypt.checkpw(password.encode('utf-8'), match[3].strip().encode('utf-8')):  # Verify hashed password
+            await control.execute("SELECT UniqueID, Fname, Lname, Passwd FROM Attendees WHERE Email = %s;", (email,))
+            match = await control.fetchone()
+            if match and await passwords.hasher.verify(password, match[3]):  # Verify hashed password
+                # Bring the hash up to the configured cost while we have the plain password
+                rehashed = await passwords.hasher.rehash(password, match[3])
+                if rehashed:
+                    await control.execute("UPDATE Attendees SET Passwd = %s WHERE UniqueID = %s;", (rehashed, match[0]))
+                    await connection.commit()
                 access_token = create_jwt_token({
                     "id": match[0],
                     "email": email,
@@ -214,6 +308,7 @@ class create_session_info(BaseModel):
     start_time: str = Field(..., description="Start time for the session")
     end_time: str = Field(..., description="End time of the session")
     locs: Optional[Tuple[session_locs, ...]] = Field(..., description="A tuple with the session locations for this session")
+    radius: Optional[float] = Field(None, description="Geofence radius around each session location in metres", gt=0, le=100000)
     
     @validator('start_time', 'end_time')
     def check_time_format(cls, v):
@@ -227,43 +322,44 @@ class add_locs(BaseModel):
     locs: Optional[Tuple[session_locs, ...]] = Field(..., description="A tuple with the session locations for this session")
 
 @app.post("/create-session")
-def create_session(details: create_session_info):
+async def create_session(details: create_session_info):
     admin_details = decode_jwt_token(details.tok)
     start_time = datetime.strptime(details.start_time, '%Y-%m-%d %H:%M:%S')
     end_time = datetime.strptime(details.end_time, '%Y-%m-%d %H:%M:%S')
     locations = details.locs
+    radius = details.radius if details.radius is not None else DEFAULT_RADIUS_M
 
     if admin_details["role"] != "admin":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not an admin")
 
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            control.execute("SELECT 1 FROM Admins WHERE AdminID = %s;", (admin_details["id"],))
-            existing_admin = control.fetchone()
-            if not existing_admin:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Admin does not exist")
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await require_user("admin", admin_details["id"], control)
 
             if start_time >= end_time:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ensure the session start and end times are correct")
 
-            control.execute(
-                "INSERT INTO Sessions (StartTime, EndTime, AdminID) VALUES (%s, %s, %s) RETURNING SessionID;",
-                (start_time, end_time, admin_details["id"])
+            await control.execute(
+                "INSERT INTO Sessions (StartTime, EndTime, AdminID, GeofenceRadius) VALUES (%s, %s, %s, %s) RETURNING SessionID;",
+                (start_time, end_time, admin_details["id"], radius)
             )
-            session_id = control.fetchone()[0]
-            connection.commit()
+            session_id = (await control.fetchone())[0]
+            await connection.commit()
 
             for x in locations:
-                control.execute(
+                await control.execute(
                     "INSERT INTO SessionLocations (Address, Longitude, Latitude, SessionID) VALUES (%s, %s, %s, %s);",
                     (x.address, x.longitude, x.latitude, session_id)
                 )
-            connection.commit()
+            await sessions.registry.publish(control, session_id)
+            await connection.commit()
+    sessions.registry.invalidate(session_id)
+    wrote(("admin", admin_details["id"]))
 
     return {"result": "Session successfully created"}
 
 @app.post("/add-locations")
-def add_session_locations(details: add_locs):
+async def add_session_locations(details: add_locs):
     admin_details=decode_jwt_token(details.tok)
     session_id=details.sessionid
     locations=details.locs
@@ -271,16 +367,24 @@ def add_session_locations(details: add_locs):
     if admin_details["role"]!="admin":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not an admin")
     
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            control.execute("select AdminID from Sessions where SessionID=%s;", (session_id,))
-            match = control.fetchone()
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await control.execute("select AdminID from Sessions where SessionID=%s;", (session_id,))
+            match = await control.fetchone()
             if match[0]!=admin_details["id"]:
                 raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not the session manager")
             
             for x in locations:
-                control.execute("insert into SessionLocations (Address, Longitude, Latitude, SessionID) values (%s, %s, %s, %s);", (x.address, x.longitude, x.latitude, session_id))
-                connection.commit()
+                await control.execute("insert into SessionLocations (Address, Longitude, Latitude, SessionID) values (%s, %s, %s, %s);", (x.address, x.longitude, x.latitude, session_id))
+                await connection.commit()
+
+            # Pings already counted against the old locations are scored again
+            await rebuild_session_scores(control, session_id)
+            await reports.invalidate(control, admin_details["id"])
+            await sessions.registry.publish(control, session_id)
+            await connection.commit()
+    sessions.registry.invalidate(session_id)
+    wrote(("admin", admin_details["id"]))
     
     return {"result":"Session locations updated"}
     
@@ -290,8 +394,17 @@ class join_sess(BaseModel):
     latitude: float = Field(..., description="Latitude of the current location", ge=-90, le=90)
     longitude: float = Field(..., description="Longitude of the current location", ge=-180, le=180)
 
+# Outcomes of join_session() other than joined and already_joined
+JOIN_REFUSALS = {
+    "no_attendee": (status.HTTP_404_NOT_FOUND, "Attendee does not exist"),
+    "no_session": (status.HTTP_404_NOT_FOUND, "Session does not exist"),
+    "not_active": (status.HTTP_400_BAD_REQUEST, "Session not active"),
+    "no_location": (status.HTTP_404_NOT_FOUND, "Session location not found"),
+    "outside": (status.HTTP_400_BAD_REQUEST, "You are not in the session location"),
+}
+
 @app.post("/join-session")
-def join_session(details: join_sess):
+async def join_session(details: join_sess):
     attendee_details = decode_jwt_token(details.tok)
     session_id = details.sessionid
     latitude = round(details.latitude, 6)
@@ -300,49 +413,29 @@ def join_session(details: join_sess):
     if attendee_details["role"] == "admin":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not an attendee")
     
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            # Check if attendee exists
-            control.execute("SELECT 1 FROM Attendees WHERE UniqueID = %s;", (attendee_details["id"],))
-            existing_attendee = control.fetchone()
-            if not existing_attendee:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attendee does not exist")
-            
-            # Check if session exists and is active
-            control.execute("SELECT StartTime, EndTime FROM Sessions WHERE SessionID = %s;", (session_id,))
-            existing_session = control.fetchone()
-            if not existing_session:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session does not exist")
-            
-            start_time, end_time = existing_session
-            start_time = start_time.replace(tzinfo=timezone("Asia/Kolkata"))
-            end_time = end_time.replace(tzinfo=timezone("Asia/Kolkata"))
-            current_time = datetime.now(timezone("Asia/Kolkata"))
-            if current_time < start_time or current_time > end_time:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Session not active")
-            
-            # Check if the attendee is within session location
-            control.execute("SELECT Longitude, Latitude FROM SessionLocations WHERE SessionID = %s;", (session_id,))
-            session_location = control.fetchone()
-            if not session_location:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session location not found")
-
-            session_longitude, session_latitude = session_location
-            if abs(Decimal(latitude) - Decimal(session_latitude)) > Decimal('0.001') or abs(Decimal(longitude) - Decimal(session_longitude)) > Decimal('0.001'):
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="You are not in the session location")
-
-            # Record attendance in 'Attended_By' and location in 'AttendeesLocations'
-            control.execute(
-                "INSERT INTO Attended_By (UniqueID, SessionID) VALUES (%s, %s);", 
-                (attendee_details["id"], session_id)
-            )
-            control.execute(
-                "INSERT INTO AttendeesLocations (LocationTimestamp, Longitude, Latitude, UniqueID) VALUES (%s, %s, %s, %s);", 
-                (datetime.now(timezone("Asia/Kolkata")).strftime('%Y-%m-%d %H:%M:%S'), longitude, latitude, attendee_details["id"])
+    # Validation, Attended_By, the ping, the score and the presence notification in one statement,
+    # see join_session() in migrations/0008_join_session_function.sql
+    joined_at = datetime.now(timezone("Asia/Kolkata")).strftime('%Y-%m-%d %H:%M:%S')
+    events = [presence.join_event(session_id, attendee_details["id"], joined_at)]
+    channel, payload = presence.broker.notification(events)
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await control.execute(
+                "select join_session(%s, %s, %s, %s, %s, %s, %s);",
+                (attendee_details["id"], session_id, latitude, longitude, joined_at, channel, payload)
             )
-            connection.commit()
-    
-    return {"result": "Session joined successfully"}
+            outcome = (await control.fetchone())[0]
+            await connection.commit()
+
+    if outcome in JOIN_REFUSALS:
+        code, detail = JOIN_REFUSALS[outcome]
+        raise HTTPException(status_code=code, detail=detail)
+    if outcome == "joined":
+        presence.broker.committed(events)
+        # The attendee's next /active-sessions and /my-sessions must list the join
+        wrote(("attendee", attendee_details["id"]))
+        return {"result": "Session joined successfully", "outcome": outcome}
+    return {"result": "Session already joined", "outcome": outcome}
     
 class curr_loc(BaseModel):
     tok: str = Field(..., description="JWT token from the client") 
@@ -350,51 +443,69 @@ class curr_loc(BaseModel):
     latitude: float = Field(..., description="Latitude of the current location", ge=-90, le=90)
 
 @app.post("/current-location")
-def store_current_location(position: curr_loc):
+async def store_current_location(position: curr_loc):
     attendee_details=decode_jwt_token(position.tok)
 
     if attendee_details["role"]=="admin":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not an attendee")
+    await ratelimit.limiter.check("ping", attendee_details["id"])
     
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            control.execute("select 1 from Attendees where UniqueID=%s;", (attendee_details["id"],))
-            existing_attendee = control.fetchone()
-            if not existing_attendee:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Attendee does not exist")
-            
-            control.execute("insert into AttendeesLocations (UniqueID, Latitude, Longitude, LocationTimestamp) values (%s, %s, %s, %s);", (attendee_details["id"], position.latitude, position.longitude, datetime.now(timezone("Asia/Kolkata")).strftime('%Y-%m-%d %H:%M:%S')))
-            connection.commit()
-    
+    ping = (attendee_details["id"], position.latitude, position.longitude, datetime.now(timezone("Asia/Kolkata")).strftime('%Y-%m-%d %H:%M:%S'))
+
+    # In buffered mode the ping is acknowledged once queued, the background writer stores it
+    if ingest.ingestor is not None:
+        await require_user("attendee", attendee_details["id"])
+        await ingest.ingestor.submit(ping)
+        return {"Status":"Location recieved"}
+
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await require_user("attendee", attendee_details["id"], control)
+            try:
+                await ingest.store_pings(control, [ping])
+                events = presence.ping_events(await record_pings(control, [ping]))
+                await presence.broker.publish(control, events)
+                await connection.commit()
+            except BaseException:
+                # Its dwell may count on a row that was never written
+                dwell.forget([ping])
+                raise
+            presence.broker.committed(events)
+
     return {"Status":"Location recieved"}
+
+"""
+Phones that were offline upload their stored pings in one compressed batch, see uploads.py:
+
+gzip -c outbox.json | curl -X POST "http://127.0.0.1:8000/current-location/batch?tok=$TOKEN" \
+-H "Content-Type: application/json" -H "Content-Encoding: gzip" --data-binary @-
+"""
+@app.post("/current-location/batch")
+async def store_location_batch(request: Request, tok: str):
+    attendee_details = decode_jwt_token(tok)
+    if attendee_details["role"] != "attendee":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not an attendee")
+    await ratelimit.limiter.check("ping_batch", attendee_details["id"])
+    batch = uploads.parse(await uploads.read_body(request.stream(), request.headers.get("content-encoding")))
+    await require_user("attendee", attendee_details["id"])
+    return await uploads.store_batch(attendee_details["id"], batch)
         
 class identify(BaseModel):
     tok:  str = Field(..., description="JWT token from the client") 
 
 @app.post("/active-sessions")
-def return_active_sessions(details: identify):
+async def return_active_sessions(details: identify):
     identity=decode_jwt_token(details.tok)
     if identity["role"]=="admin" or identity["role"]=="attendee":
-        rn=datetime.now(timezone("Asia/Kolkata")).strftime('%Y-%m-%d %H:%M:%S')
-        ret = []
-        with get_connection() as connection:
-            with get_cursor(connection) as control:
-                r=[]
-                if identity["role"]=="attendee":
-                    control.execute("select SessionID from Attended_By where UniqueID=%s",(identity["id"],))
-                    r=control.fetchall()
-                    r=[x[0] for x in r]
-                control.execute("select * from Sessions where EndTime > %s and StartTime <= %s order by StartTime desc;",(rn,rn))
-                for x in control:
-                    if x[0] not in r:
-                        ret.append(x)
-                for i in range(len(ret)):
-                    control.execute("select Latitude, Longitude from SessionLocations where SessionID=%s",(ret[i][0],))
-                    for x in control:
-                        ret[i]=ret[i]+x
-        if not ret:
-            return{"sessions":[]}
-        return {"sessions":ret}
+        active = await sessions.registry.active()
+        r=set()
+        if identity["role"]=="attendee" and active:
+            async with get_read_connection(("attendee", identity["id"])) as connection:
+                async with get_cursor(connection) as control:
+                    await control.execute("select SessionID from Attended_By where UniqueID=%s",(identity["id"],))
+                    r={x[0] for x in await control.fetchall()}
+        # Each session followed by the latitude and longitude of all its locations
+        return FastJSONResponse({"sessions": [x.row for x in active if x.session_id not in r]})
     else:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not the authorized")
 
@@ -403,7 +514,7 @@ class admin_check(BaseModel):
     id: int = Field(..., description="UniqueID of the student")
 
 @app.post("/get-attendance")
-def return_student_attendance(details: admin_check):
+async def return_student_attendance(details: admin_check):
     admin_details=decode_jwt_token(details.tok)
     student_id=details.id
     if admin_details["role"]!="admin":
@@ -411,113 +522,70 @@ def return_student_attendance(details: admin_check):
     adid=admin_details["id"]
     time_now=datetime.now(timezone("Asia/Kolkata")).strftime('%Y-%m-%d %H:%M:%S')
 
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            control.callproc('GetSessionDetails', (adid, time_now, student_id))
-            t1={}
-            for result in control.stored_results():
-                t1=result.fetchall()
-
-            control.execute("select * from AttendeesLocations where UniqueID=%s",(student_id,))
-
-            t2=control.fetchall()
-
-            satt = {}
-            temp = {}
-            for i in t2:
-                temp = {}
-                for j in t1:
-                    if i[0]>=j[0] and i[0]<=j[1]:
-                        if abs(i[1]-j[3])<0.0001 and abs(i[2]-j[4])<0.0001: #About 10 metres
-                            temp[j[2]]=1
-                        else:
-                            if i[2] not in temp:
-                                temp[j[2]]=0
-
-                for k in temp:
-                    if k not in satt:
-                        satt[k]=[0,0]
-                    satt[k][0]+=temp[k]
-                    satt[k][1]+=1
-
-            for k in satt:
-                satt[k]=(satt[k][0]/satt[k][1])>=0.8
-
-            return satt
+    async with get_read_connection(("admin", adid)) as connection:
+        async with get_cursor(connection) as control:
+            return await student_attendance(control, student_id, time_now, admin_id=adid)
         
     return {"result":"Error in fetching attendance"}
     
 @app.post("/check-attendance")
-def check_your_attendance(details: identify):
+async def check_your_attendance(details: identify):
     identity=decode_jwt_token(details.tok)
     student_id=identity["id"]
     if identity["role"]!="attendee":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not the authorized")
     time_now=datetime.now(timezone("Asia/Kolkata")).strftime('%Y-%m-%d %H:%M:%S')
 
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            control.callproc('GetSessionDetailsForStudent', (time_now,student_id))
-            for result in control.stored_results():
-                t1=result.fetchall()
-
-            control.execute("select * from AttendeesLocations where UniqueID=%s",(student_id,))
-
-            t2=control.fetchall()
-
-            satt = {}
-            temp = {}
-            for i in t2:
-                temp = {}
-                for j in t1:
-                    if i[0]>=j[0] and i[0]<=j[1]:
-                        if abs(i[1]-j[3])<0.0001 and abs(i[2]-j[4])<0.0001: #About 10 metres
-                            temp[j[2]]=1
-                        else:
-                            if i[2] not in temp:
-                                temp[j[2]]=0
-
-                for k in temp:
-                    if k not in satt:
-                        satt[k]=[0,0]
-                    satt[k][0]+=temp[k]
-                    satt[k][1]+=1
-
-            for k in satt:
-                satt[k]=(satt[k][0]/satt[k][1])>=0.8
-
-            return satt
+    async with get_read_connection(("attendee", student_id)) as connection:
+        async with get_cursor(connection) as control:
+            return await student_attendance(control, student_id, time_now)
     return {"result":"Error in fetching attendance"}
 
+class history_query(BaseModel):
+    tok: str = Field(..., description="JWT token from the client")
+    limit: Optional[int] = Field(None, ge=1, le=500, description="Sessions per page, a page with next_cursor is returned when set")
+    cursor: Optional[str] = Field(None, description="next_cursor of the previous page")
+    stream: bool = Field(False, description="Stream every session as NDJSON instead")
+
+async def session_history(kind, user_id, details):
+    """None when the client asked for neither pages nor a stream, the endpoint answers as before"""
+    if details.stream:
+        return StreamingResponse(history.stream(kind, user_id, details.cursor), media_type="application/x-ndjson")
+    if details.limit is not None or details.cursor is not None:
+        return model_response(await history.page(kind, user_id, details.cursor, details.limit or 50))
+    return None
+
 @app.post("/get-sessions-created")
-def get_sessions_created(details: identify):
+async def get_sessions_created(details: history_query):
     identity = decode_jwt_token(details.tok)
     if identity["role"] != "admin":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not the authorized")
     adid = identity["id"]
+    paged = await session_history("created", adid, details)
+    if paged is not None:
+        return paged
     try:
-        with get_connection() as connection:
-            with get_cursor(connection) as control:
-                control.execute("select SessionID, StartTime, EndTime from Sessions where AdminID=%s order by StartTime desc;", (adid,))
-                result = control.fetchall()
-                return result
+        async with get_read_connection(("admin", adid)) as connection:
+            async with get_cursor(connection) as control:
+                await control.execute("select SessionID, StartTime, EndTime from Sessions where AdminID=%s order by StartTime desc;", (adid,))
+                return FastJSONResponse(await control.fetchall())
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error in fetching sessions created")
     
     
 @app.post("/my-sessions")
-def get_joined_sessions(details: identify):
+async def get_joined_sessions(details: history_query):
     identity = decode_jwt_token(details.tok)
     if identity["role"] != "attendee":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not the authorized")
     adid = identity["id"]
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            control.execute("select Sessions.SessionID, Sessions.StartTime, Sessions.EndTime, Sessions.AdminID from Attended_By, Sessions where Attended_By.UniqueID=%s and Sessions.SessionID=Attended_By.SessionID",(adid,))
-            ret=[]
-            for x in control:
-                ret.append(x)
-            return {"sessions":ret}
+    paged = await session_history("joined", adid, details)
+    if paged is not None:
+        return paged
+    async with get_read_connection(("attendee", adid)) as connection:
+        async with get_cursor(connection) as control:
+            await control.execute("select Sessions.SessionID, Sessions.StartTime, Sessions.EndTime, Sessions.AdminID from Attended_By, Sessions where Attended_By.UniqueID=%s and Sessions.SessionID=Attended_By.SessionID",(adid,))
+            return FastJSONResponse({"sessions": await control.fetchall()})
     return {"sessions":[]}
 
 class session_details(BaseModel):
@@ -525,7 +593,7 @@ class session_details(BaseModel):
     sessionid: int = Field(..., description="ID of the session")
 
 @app.post("/get-session-attendees")
-def get_session_attendees(details: session_details):
+async def get_session_attendees(details: session_details):
     tok = details.tok
     sessionid = details.sessionid
     identity = decode_jwt_token(tok)
@@ -539,10 +607,10 @@ def get_session_attendees(details: session_details):
     longitude = None
     attendees = []
     
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            control.execute("select StartTime, EndTime, AdminID from Sessions where SessionID=%s and AdminID=%s;", (sessionid, identity["id"]))
-            match = control.fetchone()
+    async with get_read_connection(("admin", identity["id"])) as connection:
+        async with get_cursor(connection) as control:
+            await control.execute("select StartTime, EndTime, AdminID from Sessions where SessionID=%s and AdminID=%s;", (sessionid, identity["id"]))
+            match = await control.fetchone()
 
             if not match:
                 raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
@@ -550,17 +618,16 @@ def get_session_attendees(details: session_details):
             starttime = match[0]
             endtime = match[1]
 
-            control.execute("select Address, Longitude, Latitude from SessionLocations where SessionID=%s;", (sessionid,))
+            await control.execute("select Address, Longitude::float8, Latitude::float8 from SessionLocations where SessionID=%s;", (sessionid,))
 
-            data = control.fetchall()
+            data = await control.fetchall()
             address = data[0][0]
             longitude = data[0][1]
             latitude = data[0][2]
 
-            control.execute("select a.Email, a.Fname, a.Lname from Attendees a, Attended_By ab where ab.UniqueID=a.UniqueID and ab.SessionID=%s;", (sessionid,))
+            await control.execute("select a.Email, a.Fname, a.Lname from Attendees a, Attended_By ab where ab.UniqueID=a.UniqueID and ab.SessionID=%s;", (sessionid,))
 
-            for x in control:
-                attendees.append({"email": x[0], "fname": x[1], "lname": x[2]})
+            attendees = [{"email": x[0], "fname": x[1], "lname": x[2]} for x in await control.fetchall()]
 
     if starttime == None or endtime == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found")
@@ -568,19 +635,137 @@ def get_session_attendees(details: session_details):
     if address == None or latitude == None or longitude == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session location not found")
     
-    return {"starttime": starttime, "endtime": endtime, "address": address, "longitude": longitude, "latitude": latitude, "attendees": attendees}
+    return FastJSONResponse({"starttime": starttime, "endtime": endtime, "address": address, "longitude": longitude, "latitude": latitude, "attendees": attendees})
 
 @app.post("/get-attended-sessions")
-def get_attended_sessions(details: identify):
+async def get_attended_sessions(details: history_query):
     identity = decode_jwt_token(details.tok)
     if identity["role"] != "attendee":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not the authorized")
     adid = identity["id"]
-    with get_connection() as connection:
-        with get_cursor(connection) as control:
-            control.execute("select Sessions.SessionID, Sessions.StartTime, Sessions.EndTime, Sessions.AdminID, SessionLocations.Latitude, SessionLocations.Longitude from Attended_By, Sessions, SessionLocations where Attended_By.UniqueID=%s and Sessions.SessionID=Attended_By.SessionID and Sessions.SessionID=SessionLocations.SessionID order by Sessions.StartTime desc;",(adid,))
-            ret=[]
-            for x in control:
-                ret.append(x)
-            return {"sessions":ret}
-    return {"sessions":[]}
\ No newline at end of file
+    paged = await session_history("attended", adid, details)
+    if paged is not None:
+        return paged
+    async with get_read_connection(("attendee", adid)) as connection:
+        async with get_cursor(connection) as control:
+            await control.execute("select Sessions.SessionID, Sessions.StartTime, Sessions.EndTime, Sessions.AdminID, SessionLocations.Latitude::float8, SessionLocations.Longitude::float8 from Attended_By, Sessions, SessionLocations where Attended_By.UniqueID=%s and Sessions.SessionID=Attended_By.SessionID and Sessions.SessionID=SessionLocations.SessionID order by Sessions.StartTime desc;",(adid,))
+            return FastJSONResponse({"sessions": await control.fetchall()})
+    return {"sessions":[]}
+
+def require_admin(tok: str):
+    identity = decode_jwt_token(tok)
+    if identity["role"] != "admin":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not the authorized")
+    return identity
+
+"""
+Bulk uploads send the file as the request body, CSV with a header row or one JSON object per line:
+
+curl -X POST "http://127.0.0.1:8000/bulk/attendees?tok=$TOKEN" \
+-H "Content-Type: text/csv" \
+--data-binary @attendees.csv
+"""
+# Columns: email, fname, lname, password, address
+@app.post("/bulk/attendees")
+async def bulk_import_attendees(request: Request, tok: str):
+    require_admin(tok)
+    return await bulk.import_attendees(bulk.read_records(request.stream(), request.headers.get("content-type", "")))
+
+# Columns: ref, start_time, end_time, radius, address, latitude, longitude
+# Consecutive rows with the same ref are one session, each row adds one of its locations
+@app.post("/bulk/sessions")
+async def bulk_import_sessions(request: Request, tok: str):
+    identity = require_admin(tok)
+    await require_user("admin", identity["id"])
+    report = await bulk.import_sessions(bulk.read_records(request.stream(), request.headers.get("content-type", "")), identity["id"])
+    wrote(("admin", identity["id"]))
+    return report
+
+# Columns: sessionid, address, latitude, longitude
+@app.post("/bulk/locations")
+async def bulk_import_locations(request: Request, tok: str):
+    identity = require_admin(tok)
+    report = await bulk.import_locations(bulk.read_records(request.stream(), request.headers.get("content-type", "")), identity["id"])
+    wrote(("admin", identity["id"]))
+    return report
+
+@app.get("/bulk/export/{kind}")
+async def bulk_export(kind: str, tok: str):
+    identity = require_admin(tok)
+    if kind not in bulk.EXPORTS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown export")
+    return StreamingResponse(
+        bulk.export_csv(kind, identity["id"]),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{kind}.csv"'},
+    )
+
+"""
+Admins follow a session as server-sent events instead of polling /get-session-attendees:
+
+curl -N "http://127.0.0.1:8000/sessions/$SESSION/presence?tok=$TOKEN"
+"""
+@app.get("/sessions/{session_id}/presence")
+async def session_presence(session_id: int, tok: str):
+    identity = require_admin(tok)
+    session = await sessions.registry.get(session_id)
+    if session is None or session.admin_id != identity["id"]:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session does not exist")
+
+    # Subscribed before reading the attendees so no join falls between the two
+    subscriber = presence.broker.subscribe(session_id)
+    try:
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute("select UniqueID from Attended_By where SessionID=%s order by UniqueID;", (session_id,))
+                joined = [row[0] for row in await control.fetchall()]
+    except BaseException:
+        presence.broker.unsubscribe(subscriber)
+        raise
+    return StreamingResponse(
+        presence.broker.feed(subscriber, joined),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+"""
+End of term reports are built in the background, the admin polls the job until it is done:
+
+curl -X POST http://127.0.0.1:8000/reports -H "Content-Type: application/json" -d "{\"tok\": \"$TOKEN\"}"
+curl "http://127.0.0.1:8000/reports/$JOB?tok=$TOKEN"
+curl -o report.csv "http://127.0.0.1:8000/reports/$JOB/download?tok=$TOKEN&format=csv"
+"""
+class report_request(BaseModel):
+    tok: str = Field(..., description="JWT token from the client")
+    fresh: bool = Field(False, description="Build a new report even if nothing has ended since the last one")
+
+@app.post("/reports", status_code=status.HTTP_202_ACCEPTED)
+async def request_report(details: report_request):
+    identity = require_admin(details.tok)
+    await require_user("admin", identity["id"])
+    return await reports.request_report(identity["id"], details.fresh)
+
+@app.get("/reports/{job_id}")
+async def report_status(job_id: int, tok: str):
+    identity = require_admin(tok)
+    job = await reports.get_job(identity["id"], job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Report does not exist")
+    return job
+
+@app.get("/reports/{job_id}/download")
+async def report_download(job_id: int, tok: str, format: str = "csv"):
+    identity = require_admin(tok)
+    if format not in reports.FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown format")
+    result = await reports.get_result(identity["id"], job_id)
+    if result is None:
+        if await reports.get_job(identity["id"], job_id) is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Report does not exist")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Report is not ready")
+    headers = {"Content-Disposition": f'attachment; filename="report-{job_id}.{format}"'}
+    if format == "csv":
+        return StreamingResponse(reports.to_csv(result), media_type=reports.FORMATS[format], headers=headers)
+    if format == "npz":
+        return Response(reports.to_npz(result), media_type=reports.FORMATS[format], headers=headers)
+    return FastJSONResponse(result, headers=headers)
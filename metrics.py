@@ -0,0 +1,171 @@
+"""
+Latency histograms for requests, pool checkouts, SQL statements and hot sections of the code,
+rendered in the Prometheus text format at GET /metrics, and a sampling profiler that returns
+collapsed stacks for flamegraph.pl or speedscope.
+
+Everything here is per process, with several workers each one reports its own numbers.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import bisect
+import os
+import re
+import sys
+import threading
+import time
+
+# Seconds, from a cache hit to an end of term report
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Statements are labelled by their text, queries built at runtime beyond this many share one label
+MAX_STATEMENTS = 500
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+
+registry = []
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def label_text(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket and +Inf, sum]
+        self.series = {}
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{label_text(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{label_text(self.labels, labels)} {cumulative}")
+        return lines
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time to the response headers, by route", ("method", "route", "status"))
+POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Time spent waiting for a database connection")
+QUERY_SECONDS = Histogram("db_query_duration_seconds", "Time to execute a statement, fetching excluded", ("statement",))
+SECTION_SECONDS = Histogram("app_section_duration_seconds", "Time spent in instrumented sections of the app", ("section",))
+
+def timed(section):
+    return SECTION_SECONDS.time(section)
+
+statements = {}
+
+def statement(query):
+    """A short, stable label for a statement: its text with whitespace collapsed"""
+    if not isinstance(query, str):
+        return "(composed)"
+    label = statements.get(query)
+    if label is None:
+        label = re.sub(r"\s+", " ", query).strip()[:80] if len(statements) < MAX_STATEMENTS else "(other)"
+        statements[query] = label
+    return label
+
+def render_stats(prefix, stats):
+    """The numbers of one of the /xxx-stats endpoints as gauges"""
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, (int, float)):
+            name = f"app_{prefix}_{key}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {float(value)}")
+    return lines
+
+def render(stats=None):
+    lines = []
+    for histogram in registry:
+        lines.extend(histogram.render())
+    for prefix, values in (stats or {}).items():
+        lines.extend(render_stats(prefix, values))
+    return "\n".join(lines) + "\n"
+
+class LatencyMiddleware:
+    """ASGI middleware recording REQUEST_SECONDS, labelled by the matched route's path template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        started = False
+
+        def observe(status):
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], getattr(route, "path", "(unmatched)"), str(status))
+
+        async def timed_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        except BaseException:
+            if not started:
+                observe(500)
+            raise
+
+profiling = threading.Lock()
+
+def stack(frame):
+    names = []
+    while frame is not None:
+        names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def profile(thread_id, seconds, interval=PROFILER_INTERVAL):
+    """
+    Samples the stack of thread_id every interval for seconds, run it on another thread. Returns
+    the collapsed stacks, one "frame;frame;frame count" line per distinct stack, or None when a
+    profile is already running.
+    """
+    if not profiling.acquire(blocking=False):
+        return None
+    try:
+        samples = Counter()
+        deadline = time.monotonic() + min(seconds, PROFILER_MAX_SECONDS)
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                samples[stack(frame)] += 1
+            time.sleep(interval)
+        return "".join(f"{frames} {count}\n" for frames, count in samples.most_common())
+    finally:
+        profiling.release()
@@ -0,0 +1,75 @@
+"""
+Applies the SQL files in migrations/ in version order, each at most once. Applied versions are
+recorded in SchemaMigrations. A database created from the current SQL script has every migration
+recorded already, when adding one also add its version to the end of that script.
+
+A file whose first line is "-- no-transaction" runs statement by statement outside a
+transaction, for CREATE INDEX CONCURRENTLY.
+
+python migrate.py [--list]
+"""
+from dotenv import load_dotenv
+import argparse
+import os
+import psycopg
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS SchemaMigrations (
+    Version VARCHAR(100) PRIMARY KEY,
+    AppliedAt TIMESTAMP DEFAULT now()
+);
+"""
+
+def migration_files():
+    return sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith(".sql"))
+
+def statements(sql):
+    # Only used for no-transaction files, which hold plain statements without semicolons inside
+    chunks = []
+    for chunk in sql.split(";"):
+        code = [line for line in chunk.splitlines() if line.strip() and not line.strip().startswith("--")]
+        if code:
+            chunks.append("\n".join(code))
+    return chunks
+
+def apply(connection, name):
+    with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+        sql = f.read()
+
+    if sql.startswith("-- no-transaction"):
+        connection.autocommit = True
+        try:
+            for statement in statements(sql):
+                connection.execute(statement)
+            connection.execute("INSERT INTO SchemaMigrations (Version) VALUES (%s);", (name,))
+        finally:
+            connection.autocommit = False
+        return
+
+    with connection.transaction():
+        connection.execute(sql)
+        connection.execute("INSERT INTO SchemaMigrations (Version) VALUES (%s);", (name,))
+
+def main():
+    load_dotenv('.env.local')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--list", action="store_true", help="Show which migrations are applied and exit")
+    args = parser.parse_args()
+
+    with psycopg.connect(os.getenv("SQL_URL")) as connection:
+        connection.execute(CREATE_TABLE)
+        connection.commit()
+        applied = {row[0] for row in connection.execute("SELECT Version FROM SchemaMigrations;").fetchall()}
+        connection.commit()
+
+        for name in migration_files():
+            if args.list:
+                print(f"{'applied' if name in applied else 'pending'}  {name}")
+            elif name not in applied:
+                print(f"Applying {name}")
+                apply(connection, name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+-- Metres around each session location that count as present
+ALTER TABLE Sessions ADD COLUMN IF NOT EXISTS GeofenceRadius REAL DEFAULT 100;
@@ -0,0 +1,9 @@
+-- Pings of each joined session inside and outside its geofence, maintained by scores.py
+-- Fill it afterwards with: python scores.py rebuild
+CREATE TABLE IF NOT EXISTS AttendanceScores (
+    UniqueID INT REFERENCES Attendees(UniqueID),
+    SessionID INT REFERENCES Sessions(SessionID),
+    InRange INT NOT NULL DEFAULT 0,
+    Total INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (UniqueID, SessionID)
+);
@@ -0,0 +1,23 @@
+-- no-transaction
+-- Built concurrently so pings keep being written. If a build fails, drop the INVALID index it
+-- leaves behind before running the migration again.
+
+-- Attendance: one attendee's pings within the session windows, read without touching the heap
+CREATE INDEX CONCURRENTLY IF NOT EXISTS attendeeslocations_attendee_time
+    ON AttendeesLocations (UniqueID, LocationTimestamp) INCLUDE (Latitude, Longitude);
+
+-- Pings arrive in time order, a BRIN index keeps time range scans (retention, reports) cheap
+CREATE INDEX CONCURRENTLY IF NOT EXISTS attendeeslocations_time_brin
+    ON AttendeesLocations USING BRIN (LocationTimestamp);
+
+-- Active sessions: few sessions end in the future, so EndTime leads
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sessions_end_start
+    ON Sessions (EndTime, StartTime);
+
+-- Sessions created by an admin, newest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sessions_admin_start
+    ON Sessions (AdminID, StartTime DESC);
+
+-- The primary key leads with SessionID, most lookups start from the attendee
+CREATE INDEX CONCURRENTLY IF NOT EXISTS attended_by_attendee
+    ON Attended_By (UniqueID, SessionID);
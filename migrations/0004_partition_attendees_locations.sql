@@ -0,0 +1,75 @@
+-- Moves AttendeesLocations onto monthly range partitions. Does nothing if it already is partitioned.
+-- Rewrites the whole ping log in one transaction, run it in a quiet period.
+
+CREATE TABLE IF NOT EXISTS PingRetention (
+    DroppedBefore TIMESTAMP PRIMARY KEY,
+    DroppedAt TIMESTAMP DEFAULT now()
+);
+
+-- Creates the missing monthly partitions between first_ts and last_ts. Pings that already landed in
+-- the default partition for one of those months are moved into the new partition.
+CREATE OR REPLACE FUNCTION ensure_ping_partitions(first_ts TIMESTAMP, last_ts TIMESTAMP)
+RETURNS INT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', first_ts);
+    part_name TEXT;
+    created INT := 0;
+BEGIN
+    -- Several workers run this on startup
+    PERFORM pg_advisory_xact_lock(hashtext('attendeeslocations_partitions'));
+    WHILE month_start <= last_ts LOOP
+        part_name := 'attendeeslocations_p' || to_char(month_start, 'YYYYMM');
+        IF to_regclass(part_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I (LIKE AttendeesLocations INCLUDING DEFAULTS)', part_name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM attendeeslocations_default WHERE LocationTimestamp >= %L AND LocationTimestamp < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                month_start, month_start + interval '1 month', part_name
+            );
+            EXECUTE format(
+                'ALTER TABLE AttendeesLocations ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                part_name, month_start, month_start + interval '1 month'
+            );
+            created := created + 1;
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$;
+
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('attendeeslocations')) = 'p' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE AttendeesLocations RENAME TO attendeeslocations_unpartitioned;
+
+    CREATE TABLE AttendeesLocations (
+        LocationTimestamp TIMESTAMP,
+        Longitude NUMERIC(9, 6),
+        Latitude NUMERIC(8, 6),
+        UniqueID INT REFERENCES Attendees(UniqueID)
+    ) PARTITION BY RANGE (LocationTimestamp);
+    CREATE TABLE attendeeslocations_default PARTITION OF AttendeesLocations DEFAULT;
+
+    PERFORM ensure_ping_partitions(
+        coalesce((SELECT min(LocationTimestamp) FROM attendeeslocations_unpartitioned), now()::timestamp),
+        now()::timestamp + interval '2 months'
+    );
+
+    -- The rows were validated when they were written, the trigger is only added afterwards
+    INSERT INTO AttendeesLocations (LocationTimestamp, Longitude, Latitude, UniqueID)
+    SELECT LocationTimestamp, Longitude, Latitude, UniqueID FROM attendeeslocations_unpartitioned;
+    DROP TABLE attendeeslocations_unpartitioned;
+
+    CREATE INDEX attendeeslocations_attendee_time ON AttendeesLocations (UniqueID, LocationTimestamp) INCLUDE (Latitude, Longitude);
+    CREATE INDEX attendeeslocations_time_brin ON AttendeesLocations USING BRIN (LocationTimestamp);
+    CREATE TRIGGER validate_attendees_location
+    BEFORE INSERT ON AttendeesLocations
+    FOR EACH ROW
+    EXECUTE FUNCTION validate_attendees_location();
+END;
+$$;
@@ -0,0 +1,7 @@
+-- no-transaction
+-- Sessions created by an admin, paged newest first on (StartTime, SessionID). SessionID joins the
+-- key so the page boundary is an index condition, the old index is dropped once this one is built.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sessions_admin_start_id
+    ON Sessions (AdminID, StartTime DESC, SessionID DESC);
+
+DROP INDEX CONCURRENTLY IF EXISTS sessions_admin_start;
@@ -0,0 +1,8 @@
+-- Token buckets shared by the workers when RATE_LIMIT_BACKEND=postgres, see ratelimit.py.
+-- Unlogged, losing them in a crash only resets the limits.
+CREATE UNLOGGED TABLE IF NOT EXISTS RateLimits (
+    Key VARCHAR(300) PRIMARY KEY,
+    Tokens DOUBLE PRECISION NOT NULL,
+    UpdatedAt TIMESTAMP NOT NULL,
+    Allowed BOOLEAN NOT NULL
+);
@@ -0,0 +1,12 @@
+-- Dwell rows (dwell.py): one row for a run of pings from an attendee standing still, EndTimestamp
+-- holds the time of its last ping, LocationTimestamp's for a single ping. Existing rows and pings
+-- written with compression off are single pings with EndTimestamp NULL.
+-- Adding the columns only touches the catalog, but the attendance index is rebuilt to carry
+-- PingCount and blocks ping writes while it builds, run this outside class hours.
+ALTER TABLE AttendeesLocations ADD COLUMN IF NOT EXISTS EndTimestamp TIMESTAMP;
+ALTER TABLE AttendeesLocations ADD COLUMN IF NOT EXISTS PingCount INT NOT NULL DEFAULT 1;
+
+-- Attendance keeps reading the pings in its windows without touching the heap
+DROP INDEX IF EXISTS attendeeslocations_attendee_time;
+CREATE INDEX attendeeslocations_attendee_time
+    ON AttendeesLocations (UniqueID, LocationTimestamp) INCLUDE (Latitude, Longitude, PingCount);
@@ -0,0 +1,71 @@
+-- /join-session in one statement, see main.join_session.
+
+-- Great-circle distance in metres, the same formula and earth radius as geofence.haversine_m
+CREATE OR REPLACE FUNCTION haversine_m(lat1 FLOAT8, lon1 FLOAT8, lat2 FLOAT8, lon2 FLOAT8)
+RETURNS FLOAT8
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$
+    SELECT 2 * 6371008.8 * asin(least(1.0, sqrt(
+        sin((radians(lat2) - radians(lat1)) / 2) ^ 2
+        + cos(radians(lat1)) * cos(radians(lat2)) * sin((radians(lon2) - radians(lon1)) / 2) ^ 2)))
+$$;
+
+-- Checks the attendee, that the session is running at p_now and that the position is inside its
+-- geofence, then records the join, its ping and the session's score from the pings sent before
+-- joining, and notifies p_channel when given. Returns joined, already_joined, no_attendee,
+-- no_session, not_active, no_location or outside, nothing is written unless it is joined.
+CREATE OR REPLACE FUNCTION join_session(p_attendee INT, p_session INT, p_latitude FLOAT8, p_longitude FLOAT8,
+                                        p_now TIMESTAMP, p_channel TEXT DEFAULT NULL, p_payload TEXT DEFAULT NULL)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    s RECORD;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM Attendees WHERE UniqueID = p_attendee) THEN
+        RETURN 'no_attendee';
+    END IF;
+    SELECT StartTime, EndTime, GeofenceRadius INTO s FROM Sessions WHERE SessionID = p_session;
+    IF NOT FOUND THEN
+        RETURN 'no_session';
+    END IF;
+    IF p_now < s.StartTime OR p_now > s.EndTime THEN
+        RETURN 'not_active';
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM SessionLocations WHERE SessionID = p_session) THEN
+        RETURN 'no_location';
+    END IF;
+    IF NOT EXISTS (
+        SELECT 1 FROM SessionLocations sl
+        WHERE sl.SessionID = p_session
+        AND haversine_m(p_latitude, p_longitude, sl.Latitude::float8, sl.Longitude::float8) <= s.GeofenceRadius
+    ) THEN
+        RETURN 'outside';
+    END IF;
+
+    INSERT INTO Attended_By (UniqueID, SessionID) VALUES (p_attendee, p_session) ON CONFLICT DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN 'already_joined';
+    END IF;
+    INSERT INTO AttendeesLocations (LocationTimestamp, Longitude, Latitude, UniqueID)
+    VALUES (p_now, p_longitude, p_latitude, p_attendee);
+
+    -- Pings sent during the session before joining count towards it too, as in scores.rebuild_scores
+    INSERT INTO AttendanceScores (SessionID, UniqueID, InRange, Total)
+    SELECT p_session, p_attendee,
+           coalesce(sum(CASE WHEN EXISTS (
+               SELECT 1 FROM SessionLocations sl
+               WHERE sl.SessionID = p_session
+               AND haversine_m(al.Latitude::float8, al.Longitude::float8, sl.Latitude::float8, sl.Longitude::float8) <= s.GeofenceRadius
+           ) THEN al.PingCount ELSE 0 END), 0),
+           coalesce(sum(al.PingCount), 0)
+    FROM AttendeesLocations al
+    WHERE al.UniqueID = p_attendee AND al.LocationTimestamp BETWEEN s.StartTime AND s.EndTime
+    ON CONFLICT (UniqueID, SessionID) DO UPDATE SET InRange = excluded.InRange, Total = excluded.Total;
+
+    IF p_channel IS NOT NULL THEN
+        PERFORM pg_notify(p_channel, p_payload);
+    END IF;
+    RETURN 'joined';
+END;
+$$;
@@ -0,0 +1,18 @@
+-- Attendance report jobs, queued by POST /reports and taken by whichever worker is free, see reports.py
+CREATE TABLE IF NOT EXISTS ReportJobs (
+    JobID SERIAL PRIMARY KEY,
+    AdminID INT NOT NULL REFERENCES Admins(AdminID),
+    Status VARCHAR(10) NOT NULL DEFAULT 'queued',
+    -- Sessions ended by ReportTime as count:last end, cleared when the job may no longer be reused
+    Fingerprint VARCHAR(100),
+    ReportTime TIMESTAMP NOT NULL,
+    SessionsDone INT NOT NULL DEFAULT 0,
+    SessionsTotal INT,
+    CreatedAt TIMESTAMP NOT NULL DEFAULT now(),
+    StartedAt TIMESTAMP,
+    FinishedAt TIMESTAMP,
+    Error TEXT,
+    Result JSONB
+);
+CREATE INDEX IF NOT EXISTS reportjobs_admin_fingerprint ON ReportJobs (AdminID, Fingerprint);
+CREATE INDEX IF NOT EXISTS reportjobs_pending ON ReportJobs (JobID) WHERE Status IN ('queued', 'running');
@@ -0,0 +1,8 @@
+-- Highest sequence number stored per attendee and device by the batched ping upload, see uploads.py
+CREATE TABLE IF NOT EXISTS PingUploads (
+    UniqueID INT NOT NULL REFERENCES Attendees(UniqueID),
+    Device VARCHAR(64) NOT NULL,
+    LastSeq BIGINT NOT NULL,
+    UpdatedAt TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (UniqueID, Device)
+);
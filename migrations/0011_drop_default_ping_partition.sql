@@ -0,0 +1,52 @@
+-- Removes the default partition of AttendeesLocations: Postgres refuses DETACH PARTITION CONCURRENTLY
+-- on a table that has one, and retention.py detaches old months that way. Pings it holds are moved
+-- into monthly partitions first. PartitionMaintainer keeps PARTITION_MONTHS_AHEAD months created.
+
+DO $$
+DECLARE
+    first_ts TIMESTAMP;
+    last_ts TIMESTAMP;
+BEGIN
+    IF to_regclass('attendeeslocations_default') IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- A ping without a time counts towards no session and fits no monthly partition
+    DELETE FROM attendeeslocations_default WHERE LocationTimestamp IS NULL;
+    SELECT min(LocationTimestamp), max(LocationTimestamp) INTO first_ts, last_ts FROM attendeeslocations_default;
+    IF first_ts IS NOT NULL THEN
+        PERFORM ensure_ping_partitions(first_ts, last_ts);
+    END IF;
+
+    ALTER TABLE AttendeesLocations DETACH PARTITION attendeeslocations_default;
+    DROP TABLE attendeeslocations_default;
+END;
+$$;
+
+-- Creates the missing monthly partitions between first_ts and last_ts
+CREATE OR REPLACE FUNCTION ensure_ping_partitions(first_ts TIMESTAMP, last_ts TIMESTAMP)
+RETURNS INT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', first_ts);
+    part_name TEXT;
+    created INT := 0;
+BEGIN
+    -- Several workers run this on startup
+    PERFORM pg_advisory_xact_lock(hashtext('attendeeslocations_partitions'));
+    WHILE month_start <= last_ts LOOP
+        part_name := 'attendeeslocations_p' || to_char(month_start, 'YYYYMM');
+        IF to_regclass(part_name) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I (LIKE AttendeesLocations INCLUDING DEFAULTS)', part_name);
+            EXECUTE format(
+                'ALTER TABLE AttendeesLocations ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                part_name, month_start, month_start + interval '1 month'
+            );
+            created := created + 1;
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+    RETURN created;
+END;
+$$;
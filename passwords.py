@@ -0,0 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
+import asyncio
+import bcrypt
+import metrics
+import os
+import time
+
+# Work factor for new hashes, existing hashes with another cost are replaced on the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# Set on startup, bcrypt runs in its own processes instead of the request threadpool
+hasher = None
+
+# Module level so they can be sent to the worker processes
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS):
+    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds))
+    return hashed_password.decode('utf-8')
+
+def hash_passwords(passwords, rounds: int = BCRYPT_ROUNDS):
+    return [hash_password(password, rounds) for password in passwords]
+
+def verify_password(password: str, hashed_password: str):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.strip().encode('utf-8'))
+
+def hash_rounds(hashed_password: str):
+    # $2b$12$<salt and digest>
+    try:
+        return int(hashed_password.strip().split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a pool of worker processes, one per core by default, so a login storm uses
+    every core and does not hold up the threadpool other endpoints share.
+
+    At most max_pending jobs are queued or running. Further requests wait up to wait_timeout
+    for a slot and then answer 503, rather than piling up behind work that will time out anyway.
+    """
+
+    def __init__(self, workers=None, max_pending=None, wait_timeout=0.5, rounds=BCRYPT_ROUNDS):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 8
+        self.wait_timeout = wait_timeout
+        self.rounds = rounds
+        self.executor = None
+        self.slots = None
+        self.pending = 0
+        self.stats = {
+            "hashed": 0,
+            "verified": 0,
+            "rehashed": 0,
+            "rejected": 0,
+            "seconds_total": 0.0,
+            "seconds_max": 0.0,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.getenv("PASSWORD_WORKERS", "0")),
+            max_pending=int(os.getenv("PASSWORD_MAX_PENDING", "0")),
+            wait_timeout=float(os.getenv("PASSWORD_WAIT_TIMEOUT", "0.5")),
+            rounds=BCRYPT_ROUNDS,
+        )
+
+    async def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.slots = asyncio.Semaphore(self.max_pending)
+        # Spawn every worker now instead of on the first logins
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, hash_password, "", 4) for _ in range(self.workers)))
+
+    async def stop(self):
+        if self.executor is not None:
+            await asyncio.to_thread(self.executor.shutdown, wait=True, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, fn, *args, shed=True):
+        if shed:
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self.stats["rejected"] += 1
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many logins, retry later", headers={"Retry-After": "1"})
+        else:
+            await self.slots.acquire()
+
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.SECTION_SECONDS.observe(elapsed, fn.__name__)
+            self.stats["seconds_total"] += elapsed
+            self.stats["seconds_max"] = max(self.stats["seconds_max"], elapsed)
+            self.pending -= 1
+            self.slots.release()
+
+    async def hash(self, password):
+        hashed = await self.run(hash_password, password, self.rounds)
+        self.stats["hashed"] += 1
+        return hashed
+
+    async def hash_batch(self, passwords):
+        """
+        Hashes for a bulk import, one job per worker. Each job waits for its slot instead of
+        shedding and the batch never holds more than one slot per worker, so logins keep the rest.
+        """
+        size = -(-len(passwords) // self.workers) or 1
+        jobs = [self.run(hash_passwords, passwords[i:i + size], self.rounds, shed=False) for i in range(0, len(passwords), size)]
+        hashed = [h for part in await asyncio.gather(*jobs) for h in part]
+        self.stats["hashed"] += len(hashed)
+        return hashed
+
+    async def verify(self, password, hashed_password):
+        matched = await self.run(verify_password, password, hashed_password)
+        self.stats["verified"] += 1
+        return matched
+
+    def needs_rehash(self, hashed_password):
+        return hash_rounds(hashed_password) != self.rounds
+
+    async def rehash(self, password, hashed_password):
+        """New hash when the stored one uses another cost, or None. Never fails the login."""
+        if not self.needs_rehash(hashed_password):
+            return None
+        try:
+            hashed = await self.hash(password)
+        except HTTPException:
+            # Saturated, try again on a later login
+            return None
+        self.stats["rehashed"] += 1
+        return hashed
+
+    def metrics(self):
+        return {"workers": self.workers, "rounds": self.rounds, "pending": self.pending, "max_pending": self.max_pending, **self.stats}
+
+async def start_hasher():
+    global hasher
+    hasher = PasswordHasher.from_env()
+    await hasher.start()
+
+async def stop_hasher():
+    global hasher
+    if hasher is not None:
+        await hasher.stop()
+        hasher = None
@@ -0,0 +1,229 @@
+from collections import deque
+import asyncio
+import json
+import logging
+import os
+import psycopg
+
+logger = logging.getLogger(__name__)
+
+# Workers publish presence events here when PRESENCE_BACKEND=postgres
+CHANNEL = "session_presence"
+
+# NOTIFY payloads must stay under 8000 bytes, larger batches are split
+MAX_PAYLOAD = 7000
+
+# Set on startup
+broker = None
+
+def join_event(session_id, student_id, at):
+    return ("join", session_id, student_id, str(at), True)
+
+def ping_events(verdicts):
+    """Events for the (SessionID, UniqueID, inside, LocationTimestamp) verdicts of record_pings"""
+    return [("ping", session_id, student_id, str(at), inside) for session_id, student_id, inside, at in verdicts]
+
+def sse(kind, data):
+    return f"event: {kind}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+def payloads(events):
+    chunk, size = [], 0
+    for event in events:
+        encoded = json.dumps(event, separators=(",", ":"))
+        if chunk and size + len(encoded) + 1 > MAX_PAYLOAD:
+            yield "[" + ",".join(chunk) + "]"
+            chunk, size = [], 0
+        chunk.append(encoded)
+        size += len(encoded) + 1
+    if chunk:
+        yield "[" + ",".join(chunk) + "]"
+
+class Subscriber:
+    """
+    One admin's feed of a session. Holds at most buffer messages, when the consumer falls behind
+    the oldest are dropped and it is told how many it missed.
+    """
+
+    def __init__(self, session_id, buffer):
+        self.session_id = session_id
+        self.messages = deque(maxlen=buffer)
+        self.ready = asyncio.Event()
+        self.missed = 0
+        self.closed = False
+
+    def push(self, message):
+        """False when the oldest message was dropped to make room"""
+        full = len(self.messages) == self.messages.maxlen
+        self.missed += full
+        self.messages.append(message)
+        self.ready.set()
+        return not full
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    async def next(self, timeout):
+        """The next message, or None when nothing arrived within timeout or the feed was closed"""
+        if not self.messages and not self.closed:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        if self.closed:
+            return None
+        if self.missed:
+            missed, self.missed = self.missed, 0
+            return sse("lagged", {"session": self.session_id, "missed": missed})
+        return self.messages.popleft()
+
+class PresenceBroker:
+    """
+    Fans join and geofence enter/leave events out to the admins watching a session, so they do
+    not poll /get-session-attendees.
+
+    /join-session and the ping writers publish the events of a transaction after it commits. Pings
+    carry their in-range verdict from the score counters, the broker turns a change of verdict into
+    enter or leave, the first ping seen for an attendee reports its current state. Each event is
+    encoded once and the same text is queued for every subscriber.
+
+    With the postgres backend events go over NOTIFY, delivered on commit, and every worker fans
+    out what it hears to its own subscribers.
+    """
+
+    def __init__(self, buffer=256, backend="local", keepalive=15.0):
+        self.buffer = buffer
+        self.backend = backend
+        self.keepalive = keepalive
+        self.subscribers = {}
+        # Last verdict per attendee, kept only for sessions someone is watching
+        self.inside = {}
+        self.listener = None
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0, "notifies": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            buffer=int(os.getenv("PRESENCE_BUFFER", "256")),
+            backend=os.getenv("PRESENCE_BACKEND", "local"),
+            keepalive=float(os.getenv("PRESENCE_KEEPALIVE", "15")),
+        )
+
+    async def start(self):
+        if self.backend == "postgres":
+            self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        for watchers in self.subscribers.values():
+            for subscriber in watchers:
+                subscriber.close()
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+
+    def subscribe(self, session_id):
+        subscriber = Subscriber(session_id, self.buffer)
+        self.subscribers.setdefault(session_id, set()).add(subscriber)
+        self.inside.setdefault(session_id, {})
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        watchers = self.subscribers.get(subscriber.session_id)
+        if watchers is None:
+            return
+        watchers.discard(subscriber)
+        if not watchers:
+            del self.subscribers[subscriber.session_id]
+            self.inside.pop(subscriber.session_id, None)
+
+    async def publish(self, control, events):
+        """Send events to the other workers, delivered when the caller's transaction commits"""
+        if self.backend != "postgres" or not events:
+            return
+        for payload in payloads(events):
+            await control.execute("select pg_notify(%s, %s);", (CHANNEL, payload))
+            self.stats["notifies"] += 1
+
+    def notification(self, events):
+        """(channel, payload) for a statement that notifies by itself, (None, None) unless postgres"""
+        if self.backend != "postgres" or not events:
+            return None, None
+        # Only for a handful of events, they have to fit in one payload
+        payload, = payloads(events)
+        return CHANNEL, payload
+
+    def committed(self, events):
+        """Fan out events once their transaction has committed, with postgres they come back over LISTEN"""
+        if self.backend != "postgres":
+            self.dispatch(events)
+
+    def dispatch(self, events):
+        for kind, session_id, student_id, at, inside in events:
+            watchers = self.subscribers.get(session_id)
+            if not watchers:
+                continue
+            states = self.inside[session_id]
+            was = states.get(student_id)
+            states[student_id] = inside
+            if kind == "ping":
+                if was == inside:
+                    continue
+                kind = "enter" if inside else "leave"
+
+            message = sse(kind, {"session": session_id, "attendee": student_id, "at": at})
+            for subscriber in watchers:
+                if not subscriber.push(message):
+                    self.stats["dropped"] += 1
+            self.stats["published"] += 1
+            self.stats["delivered"] += len(watchers)
+
+    async def feed(self, subscriber, snapshot):
+        """Server-sent events for one subscriber, starting with the attendees already joined"""
+        try:
+            yield sse("snapshot", {"session": subscriber.session_id, "attendees": snapshot})
+            while True:
+                message = await subscriber.next(self.keepalive)
+                if subscriber.closed:
+                    return
+                # A comment line keeps proxies from closing an idle stream
+                yield message if message is not None else ": keepalive\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    async def listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(os.getenv("SQL_URL"), autocommit=True) as connection:
+                    await connection.execute(f"LISTEN {CHANNEL};")
+                    async for notify in connection.notifies():
+                        self.dispatch([tuple(event) for event in json.loads(notify.payload)])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Presence listener lost its connection, reconnecting")
+                await asyncio.sleep(1)
+
+    def metrics(self):
+        return {
+            "backend": self.backend,
+            "sessions": len(self.subscribers),
+            "subscribers": sum(len(watchers) for watchers in self.subscribers.values()),
+            "buffer": self.buffer,
+            **self.stats,
+        }
+
+async def start_broker():
+    global broker
+    broker = PresenceBroker.from_env()
+    await broker.start()
+
+async def stop_broker():
+    global broker
+    if broker is not None:
+        await broker.stop()
+        broker = None
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from fastapi import HTTPException, status
+from db import get_connection, get_cursor
+import asyncio
+import logging
+import math
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Refills the bucket for the time since its last use and takes a token if there is one. Allowed
+# records whether this call got the token, RETURNING cannot see the row as it was before.
+TAKE_SHARED = """
+insert into RateLimits (Key, Tokens, UpdatedAt, Allowed) values (%(key)s, %(burst)s - 1, clock_timestamp(), true)
+on conflict (Key) do update set
+    Tokens = least(%(burst)s, RateLimits.Tokens + extract(epoch from clock_timestamp() - RateLimits.UpdatedAt) * %(rate)s)
+             - case when least(%(burst)s, RateLimits.Tokens + extract(epoch from clock_timestamp() - RateLimits.UpdatedAt) * %(rate)s) >= 1 then 1 else 0 end,
+    Allowed = least(%(burst)s, RateLimits.Tokens + extract(epoch from clock_timestamp() - RateLimits.UpdatedAt) * %(rate)s) >= 1,
+    UpdatedAt = clock_timestamp()
+returning Allowed, Tokens;
+"""
+
+# Set on startup
+limiter = None
+
+class RateLimiter:
+    """
+    Token buckets per client: each rule allows rate requests per second on average and bursts of
+    up to burst. A client over its limit gets 429 with a Retry-After for its next token, before
+    the request takes a database connection or a bcrypt slot.
+
+    Buckets live in memory, at most max_keys of them, least recently used dropped first. Each
+    worker then enforces the limits on its own share of the traffic. The postgres backend keeps
+    the buckets in the unlogged RateLimits table instead so all workers share them, at the cost of
+    one statement per check.
+    """
+
+    def __init__(self, rules, max_keys=100000, backend="local", idle_after=3600.0):
+        self.rules = rules
+        self.max_keys = max_keys
+        self.backend = backend
+        self.idle_after = idle_after
+        # (rule, key) -> [tokens, monotonic time of the last refill]
+        self.buckets = OrderedDict()
+        self.cleaner = None
+        self.stats = {"allowed": 0, **{f"limited_{rule}": 0 for rule in rules}}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            rules={
+                # Misbehaving clients ping every second, the app sends one every few seconds
+                "ping": (float(os.getenv("PING_RATE_LIMIT", "0.5")), float(os.getenv("PING_BURST", "5"))),
+                # An outbox of pings is one upload, retries after a dropped connection come in bursts
+                "ping_batch": (float(os.getenv("PING_BATCH_RATE_LIMIT", "0.05")), float(os.getenv("PING_BATCH_BURST", "10"))),
+                "login": (float(os.getenv("LOGIN_RATE_LIMIT", "0.1")), float(os.getenv("LOGIN_BURST", "5"))),
+                # A campus NAT puts a whole class behind one address
+                "login_ip": (float(os.getenv("LOGIN_IP_RATE_LIMIT", "20")), float(os.getenv("LOGIN_IP_BURST", "500"))),
+            },
+            max_keys=int(os.getenv("RATE_LIMIT_KEYS", "100000")),
+            backend=os.getenv("RATE_LIMIT_BACKEND", "local"),
+        )
+
+    async def start(self):
+        if self.backend == "postgres":
+            self.cleaner = asyncio.create_task(self.clean())
+
+    async def stop(self):
+        if self.cleaner is not None:
+            self.cleaner.cancel()
+            try:
+                await self.cleaner
+            except asyncio.CancelledError:
+                pass
+            self.cleaner = None
+
+    def take_local(self, rule, key, rate, burst):
+        now = time.monotonic()
+        bucket = self.buckets.get((rule, key))
+        if bucket is None:
+            bucket = self.buckets[(rule, key)] = [burst, now]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end((rule, key))
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, bucket[0]
+        return False, bucket[0]
+
+    async def take_shared(self, rule, key, rate, burst):
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute(TAKE_SHARED, {"key": f"{rule}:{key}", "rate": rate, "burst": burst})
+                allowed, tokens = await control.fetchone()
+                await connection.commit()
+        return allowed, tokens
+
+    async def check(self, rule, key):
+        """429 when the client identified by key is over the rule's limit, a rate of 0 disables the rule"""
+        rate, burst = self.rules[rule]
+        if rate <= 0:
+            return
+        if self.backend == "postgres":
+            allowed, tokens = await self.take_shared(rule, key, rate, burst)
+        else:
+            allowed, tokens = self.take_local(rule, key, rate, burst)
+        if allowed:
+            self.stats["allowed"] += 1
+            return
+        self.stats[f"limited_{rule}"] += 1
+        retry_after = max(1, math.ceil((1 - tokens) / rate))
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many requests, slow down", headers={"Retry-After": str(retry_after)})
+
+    async def clean(self):
+        # A bucket idle this long is full again, its row can go
+        while True:
+            await asyncio.sleep(self.idle_after / 4)
+            try:
+                async with get_connection() as connection:
+                    async with get_cursor(connection) as control:
+                        await control.execute("delete from RateLimits where UpdatedAt < clock_timestamp() - %s * interval '1 second';", (self.idle_after,))
+                        await connection.commit()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Cleaning up idle rate limit buckets failed")
+
+    def metrics(self):
+        return {"backend": self.backend, "buckets": len(self.buckets), "max_keys": self.max_keys, **self.stats}
+
+async def start_limiter():
+    global limiter
+    limiter = RateLimiter.from_env()
+    await limiter.start()
+
+async def stop_limiter():
+    global limiter
+    if limiter is not None:
+        await limiter.stop()
+        limiter = None
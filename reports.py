@@ -0,0 +1,352 @@
+"""
+Attendance reports for an admin: every session of theirs that has ended against every attendee
+who joined any of them, built by a background job instead of one /get-attendance call per student.
+
+Jobs live in ReportJobs so that any worker can take a job and any worker can answer for its
+progress and result. Each worker runs REPORT_WORKERS tasks that claim queued jobs with
+FOR UPDATE SKIP LOCKED and read the stored scores of REPORT_CHUNK_SESSIONS sessions per query,
+recording progress after each chunk. The result is kept as columns, one entry per
+(session, attendee) pair, and downloaded as a CSV matrix, JSON or numpy columns.
+
+A finished job is handed out again for the same admin until another of their sessions ends,
+which changes its fingerprint, or add-locations or a late batch of pings rescores one of them,
+which clears it.
+"""
+from attendance import PRESENCE_THRESHOLD
+from db import get_connection, get_cursor
+from sessions import ist_now
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {"csv": "text/csv", "json": "application/json", "npz": "application/octet-stream"}
+
+JOB_COLUMNS = "JobID, Status, SessionsDone, SessionsTotal, CreatedAt, StartedAt, FinishedAt, Error"
+
+FINGERPRINT = "select count(*), max(EndTime) from Sessions where AdminID=%s and EndTime<=%s;"
+
+REUSABLE = f"""
+select {JOB_COLUMNS} from ReportJobs
+where AdminID=%s and Fingerprint=%s and Status<>'failed'
+order by JobID desc limit 1;
+"""
+
+# Running jobs whose worker went away are taken over after stale_after seconds
+CLAIM = """
+update ReportJobs set Status='running', StartedAt=now(), SessionsDone=0
+where JobID=(
+    select JobID from ReportJobs
+    where Status='queued' or (Status='running' and StartedAt<now() - make_interval(secs => %s))
+    order by JobID
+    for update skip locked
+    limit 1
+)
+returning JobID, AdminID, ReportTime;
+"""
+
+ENDED_SESSIONS = """
+select SessionID, StartTime, EndTime from Sessions
+where AdminID=%s and EndTime<=%s
+order by StartTime, SessionID;
+"""
+
+# Attendees who joined without a single scored ping have total 0: no verdict, as /get-attendance
+MATRIX = """
+select ab.SessionID, ab.UniqueID, coalesce(sc.InRange, 0), coalesce(sc.Total, 0)
+from Attended_By ab
+left join AttendanceScores sc on sc.UniqueID=ab.UniqueID and sc.SessionID=ab.SessionID
+where ab.SessionID=any(%(ids)s)
+order by ab.SessionID, ab.UniqueID;
+"""
+
+ATTENDEES = "select UniqueID, Email, Fname, Lname from Attendees where UniqueID=any(%s) order by UniqueID;"
+
+# Set on startup unless REPORT_WORKERS=0
+queue = None
+
+def job_status(row):
+    job_id, state, done, total, created_at, started_at, finished_at, error = row
+    return {
+        "job_id": job_id,
+        "status": state,
+        "sessions_done": done,
+        "sessions_total": total,
+        "created_at": created_at,
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "error": error,
+    }
+
+async def fingerprint(control, admin_id, now):
+    await control.execute(FINGERPRINT, (admin_id, now))
+    count, last_end = await control.fetchone()
+    return f"{count}:{last_end}"
+
+async def request_report(admin_id, fresh=False):
+    """A job for the admin's report, an earlier one when nothing has ended since unless fresh"""
+    now = ist_now()
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            current = await fingerprint(control, admin_id, now)
+            if not fresh:
+                await control.execute(REUSABLE, (admin_id, current))
+                row = await control.fetchone()
+                if row is not None:
+                    return job_status(row)
+            await control.execute(
+                f"insert into ReportJobs (AdminID, Fingerprint, ReportTime) values (%s, %s, %s) returning {JOB_COLUMNS};",
+                (admin_id, current, now)
+            )
+            row = await control.fetchone()
+            await connection.commit()
+    if queue is not None:
+        queue.wake.set()
+    return job_status(row)
+
+async def get_job(admin_id, job_id):
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await control.execute(f"select {JOB_COLUMNS} from ReportJobs where JobID=%s and AdminID=%s;", (job_id, admin_id))
+            row = await control.fetchone()
+    return None if row is None else job_status(row)
+
+async def get_result(admin_id, job_id):
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await control.execute("select Result from ReportJobs where JobID=%s and AdminID=%s and Status='done';", (job_id, admin_id))
+            row = await control.fetchone()
+    return None if row is None else row[0]
+
+async def invalidate(control, admin_id):
+    """Stops the admin's earlier jobs from being reused, in the caller's transaction"""
+    await control.execute("update ReportJobs set Fingerprint=null where AdminID=%s and Fingerprint is not null;", (admin_id,))
+
+async def invalidate_ended(control, session_ids, now):
+    """invalidate() for the admins of the sessions that had ended by now, after late pings were scored into them"""
+    await control.execute(
+        "update ReportJobs set Fingerprint=null where Fingerprint is not null and AdminID in "
+        "(select AdminID from Sessions where SessionID=any(%s) and EndTime<=%s);",
+        (sorted(session_ids), now)
+    )
+
+def present(in_range, total):
+    return total > 0 and in_range / total >= PRESENCE_THRESHOLD
+
+def verdict(in_range, total):
+    # /get-attendance leaves sessions without pings out instead of calling them absent
+    if total == 0:
+        return "no pings"
+    return "present" if present(in_range, total) else "absent"
+
+def to_csv(result):
+    """Lines of a CSV with an attendee per row and a column per session: present, absent, no pings or empty when not joined"""
+    sessions, attendees, scores = result["sessions"], result["attendees"], result["scores"]
+    cells = {}
+    for session_id, unique_id, in_range, total in zip(scores["session_id"], scores["unique_id"], scores["in_range"], scores["total"]):
+        cells[unique_id, session_id] = verdict(in_range, total)
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    def line(values):
+        writer.writerow(values)
+        text = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return text
+
+    yield line(["unique_id", "email", "fname", "lname", "present"]
+               + [f"session {session_id} {start}" for session_id, start in zip(sessions["session_id"], sessions["start_time"])])
+    for unique_id, email, fname, lname in zip(attendees["unique_id"], attendees["email"], attendees["fname"], attendees["lname"]):
+        row = [cells.get((unique_id, session_id), "") for session_id in sessions["session_id"]]
+        yield line([unique_id, email, fname, lname, row.count("present")] + row)
+
+def to_npz(result):
+    """The columns as numpy arrays in one compressed .npz, np.load() gives them back by name"""
+    import numpy as np
+
+    scores = result["scores"]
+    in_range = np.asarray(scores["in_range"], dtype=np.int64)
+    total = np.asarray(scores["total"], dtype=np.int64)
+    arrays = {
+        "session_id": np.asarray(scores["session_id"], dtype=np.int64),
+        "unique_id": np.asarray(scores["unique_id"], dtype=np.int64),
+        "in_range": in_range,
+        "total": total,
+        "present": (total > 0) & (in_range / np.maximum(total, 1) >= PRESENCE_THRESHOLD),
+        # False where the attendee joined but sent no pings, present is no verdict there
+        "scored": total > 0,
+        "sessions_session_id": np.asarray(result["sessions"]["session_id"], dtype=np.int64),
+        "sessions_start_time": np.asarray(result["sessions"]["start_time"], dtype="datetime64[s]"),
+        "sessions_end_time": np.asarray(result["sessions"]["end_time"], dtype="datetime64[s]"),
+        "attendees_unique_id": np.asarray(result["attendees"]["unique_id"], dtype=np.int64),
+        "attendees_email": np.asarray(result["attendees"]["email"], dtype=str),
+    }
+    out = io.BytesIO()
+    np.savez_compressed(out, **arrays)
+    return out.getvalue()
+
+class ReportQueue:
+    """
+    Worker tasks taking jobs from ReportJobs. A new job wakes this worker's tasks right away,
+    the others find it within poll_interval seconds. Finished jobs are deleted after keep seconds.
+    """
+
+    def __init__(self, workers=1, chunk_sessions=100, poll_interval=2.0, stale_after=600.0, keep=86400.0):
+        self.workers = workers
+        self.chunk_sessions = chunk_sessions
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.keep = keep
+        self.wake = asyncio.Event()
+        self.tasks = []
+        self.cleaned_at = 0.0
+        self.running = 0
+        self.stats = {"jobs": 0, "failed": 0, "sessions": 0, "pairs": 0, "seconds": 0.0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.getenv("REPORT_WORKERS", "1")),
+            chunk_sessions=int(os.getenv("REPORT_CHUNK_SESSIONS", "100")),
+            poll_interval=float(os.getenv("REPORT_POLL_INTERVAL", "2")),
+            stale_after=float(os.getenv("REPORT_STALE_AFTER", "600")),
+            keep=float(os.getenv("REPORT_KEEP", "86400")),
+        )
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # An interrupted job is left running and taken over by another worker once it is stale
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def work(self):
+        while True:
+            try:
+                job = await self.claim()
+                if job is None:
+                    await self.clean()
+            except Exception:
+                logger.exception("Claiming a report job failed")
+                job = None
+            if job is None:
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.run(*job)
+
+    async def claim(self):
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute(CLAIM, (self.stale_after,))
+                job = await control.fetchone()
+                await connection.commit()
+        return job
+
+    async def clean(self):
+        if time.monotonic() - self.cleaned_at < min(self.keep, 600.0):
+            return
+        self.cleaned_at = time.monotonic()
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute(
+                    "delete from ReportJobs where Status in ('done', 'failed') and FinishedAt<now() - make_interval(secs => %s);",
+                    (self.keep,)
+                )
+                await connection.commit()
+
+    async def run(self, job_id, admin_id, report_time):
+        start = time.perf_counter()
+        self.running += 1
+        try:
+            await self.build(job_id, admin_id, report_time)
+            self.stats["jobs"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Report job %s failed", job_id)
+            self.stats["failed"] += 1
+            async with get_connection() as connection:
+                async with get_cursor(connection) as control:
+                    await control.execute(
+                        "update ReportJobs set Status='failed', Error=%s, FinishedAt=now() where JobID=%s;",
+                        (str(e)[:1000], job_id)
+                    )
+                    await connection.commit()
+        finally:
+            self.running -= 1
+            self.stats["seconds"] += time.perf_counter() - start
+
+    async def build(self, job_id, admin_id, report_time):
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute(ENDED_SESSIONS, (admin_id, report_time))
+                ended = await control.fetchall()
+                await control.execute("update ReportJobs set SessionsTotal=%s where JobID=%s;", (len(ended), job_id))
+                await connection.commit()
+
+                scores = {"session_id": [], "unique_id": [], "in_range": [], "total": []}
+                for i in range(0, len(ended), self.chunk_sessions):
+                    chunk = ended[i:i + self.chunk_sessions]
+                    await control.execute(MATRIX, {"ids": [row[0] for row in chunk]})
+                    for session_id, unique_id, in_range, total in await control.fetchall():
+                        scores["session_id"].append(session_id)
+                        scores["unique_id"].append(unique_id)
+                        scores["in_range"].append(in_range)
+                        scores["total"].append(total)
+                    await control.execute("update ReportJobs set SessionsDone=%s where JobID=%s;", (i + len(chunk), job_id))
+                    await connection.commit()
+
+                await control.execute(ATTENDEES, (sorted(set(scores["unique_id"])),))
+                attendees = await control.fetchall()
+                result = {
+                    "report_time": str(report_time),
+                    "threshold": PRESENCE_THRESHOLD,
+                    "sessions": {
+                        "session_id": [row[0] for row in ended],
+                        "start_time": [str(row[1]) for row in ended],
+                        "end_time": [str(row[2]) for row in ended],
+                    },
+                    "attendees": {
+                        "unique_id": [row[0] for row in attendees],
+                        "email": [row[1] for row in attendees],
+                        "fname": [row[2] for row in attendees],
+                        "lname": [row[3] for row in attendees],
+                    },
+                    "scores": scores,
+                }
+                await control.execute(
+                    "update ReportJobs set Status='done', Result=%s::jsonb, FinishedAt=now(), Error=null where JobID=%s;",
+                    (json.dumps(result), job_id)
+                )
+                await connection.commit()
+        self.stats["sessions"] += len(ended)
+        self.stats["pairs"] += len(scores["session_id"])
+
+    def metrics(self):
+        return {"workers": len(self.tasks), "running": self.running, **self.stats}
+
+def start_queue():
+    global queue
+    if int(os.getenv("REPORT_WORKERS", "1")) > 0:
+        queue = ReportQueue.from_env()
+        queue.start()
+
+async def stop_queue():
+    global queue
+    if queue is not None:
+        await queue.stop()
+        queue = None
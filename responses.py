@@ -0,0 +1,31 @@
+"""
+JSON responses encoded by orjson.
+
+FastAPI passes whatever a handler returns through jsonable_encoder, which walks every row and
+value in Python before the response class encodes the copy. Handlers returning many rows hand
+back a FastJSONResponse or model_response() instead, which skips that walk: orjson encodes
+tuples, datetimes and floats in one pass, and pydantic models are dumped by their compiled
+serializer.
+
+Timestamps are ISO 8601 without a zone, as before. Coordinates are JSON numbers everywhere; the
+queries cast them to float8 so no Decimal reaches the encoder, default() covers any that do.
+"""
+from decimal import Decimal
+from fastapi.responses import JSONResponse, Response
+import orjson
+
+def default(value):
+    # As jsonable_encoder turns NUMERIC values into numbers
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps(content):
+    return orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+def model_response(model, status_code=200):
+    return Response(model.model_dump_json(), status_code=status_code, media_type="application/json")
@@ -0,0 +1,208 @@
+"""
+Housekeeping for the monthly AttendeesLocations partitions: creates the coming months ahead of
+time and, when PING_RETENTION_DAYS is set, drops months older than that.
+
+Before a month is dropped, every session that started in or before it must have ended. Their
+AttendanceScores are then recomputed from the raw pings and PingRetention records the new
+boundary, so attendance for those sessions keeps being served from the scores alone. Once that is
+committed the partition is detached CONCURRENTLY, which waits for queries still reading it instead
+of locking AttendeesLocations, and dropped. A run interrupted after the commit finishes the detach
+and drop the next time.
+
+python retention.py [--dry-run]
+"""
+from attendance import RETAINED_SINCE
+from db import get_connection, get_cursor, open_pool, close_pool
+from scores import rebuild_session_scores
+from sessions import ist_now
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from psycopg import sql
+import argparse
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Also months detached by a run that stopped before dropping them
+PARTITIONS = """
+select relname from pg_class
+where relkind='r' and relname ~ '^attendeeslocations_p[0-9]{6}$'
+order by relname;
+"""
+
+# No row once dropped, NULL once detached, true while a concurrent detach was interrupted
+PARTITION_STATE = """
+select i.inhdetachpending
+from pg_class c
+left join pg_inherits i on i.inhrelid=c.oid
+where c.relname=%s and c.relkind='r';
+"""
+
+RETENTION_LOCK = "hashtext('attendeeslocations_retention')"
+
+# Set on startup
+maintainer = None
+
+def next_month(month_start):
+    return (month_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+async def ensure_partitions(connection, control, months_ahead):
+    now = ist_now()
+    await control.execute("select ensure_ping_partitions(%s, %s);", (now, now + timedelta(days=31 * months_ahead)))
+    created = (await control.fetchone())[0]
+    await connection.commit()
+    return created
+
+async def detach_and_drop(connection, control, name):
+    await control.execute(PARTITION_STATE, (name,))
+    row = await control.fetchone()
+    await connection.rollback()
+    if row is None:
+        return
+    identifier = sql.Identifier(name)
+    # DETACH CONCURRENTLY runs in two transactions of its own, outside any transaction block
+    await connection.set_autocommit(True)
+    try:
+        if row[0] is not None:
+            mode = sql.SQL("finalize" if row[0] else "concurrently")
+            await control.execute(sql.SQL("alter table AttendeesLocations detach partition {} {};").format(identifier, mode))
+        # Detached, the drop only locks the month's own table
+        await control.execute(sql.SQL("drop table {};").format(identifier))
+    finally:
+        await connection.set_autocommit(False)
+
+async def drop_partition(connection, control, name, upper, dry_run=False):
+    """Roll the sessions covered by the partition into their scores, detach and drop it, False if it has to wait"""
+    # One worker at a time, the others skip this round. Held by the session across the commits below
+    await control.execute(f"select pg_try_advisory_lock({RETENTION_LOCK});")
+    locked = (await control.fetchone())[0]
+    await connection.rollback()
+    if not locked:
+        return False
+
+    try:
+        # Frozen by an earlier run already, the pings may be detached since
+        await control.execute("select exists (select 1 from PingRetention where DroppedBefore>=%s);", (upper,))
+        frozen = (await control.fetchone())[0]
+        if not frozen:
+            await control.execute("select SessionID, EndTime from Sessions where StartTime<%s and StartTime>=" + RETAINED_SINCE + " order by SessionID;", (upper,))
+            covered = await control.fetchall()
+            now = ist_now()
+            running = [session_id for session_id, end_time in covered if end_time is None or end_time > now]
+            if running:
+                logger.warning("Keeping %s, sessions %s have not ended", name, running)
+                await connection.rollback()
+                return False
+
+        if dry_run:
+            print(f"Would drop {name}" + ("" if frozen else f" and freeze the scores of {len(covered)} sessions"))
+            await connection.rollback()
+            return True
+
+        if not frozen:
+            for session_id, _ in covered:
+                await rebuild_session_scores(control, session_id)
+            await control.execute("insert into PingRetention (DroppedBefore) values (%s) on conflict do nothing;", (upper,))
+            await connection.commit()
+            logger.info("Froze the scores of %s sessions before %s", len(covered), name)
+
+        await detach_and_drop(connection, control, name)
+        logger.info("Dropped %s", name)
+        return True
+    finally:
+        await connection.rollback()
+        await control.execute(f"select pg_advisory_unlock({RETENTION_LOCK});")
+        await connection.commit()
+
+async def drop_expired(connection, control, retention_days, dry_run=False):
+    cutoff = ist_now() - timedelta(days=retention_days)
+    await control.execute(PARTITIONS)
+    names = [row[0] for row in await control.fetchall()]
+    await connection.rollback()
+
+    dropped = []
+    # Oldest first, stop at the first month that is too recent or has to wait
+    for name in names:
+        upper = next_month(datetime.strptime(name[-6:], "%Y%m"))
+        if upper > cutoff or not await drop_partition(connection, control, name, upper, dry_run):
+            break
+        dropped.append(name)
+    return dropped
+
+class PartitionMaintainer:
+    def __init__(self, interval=3600.0, months_ahead=2, retention_days=0):
+        self.interval = interval
+        self.months_ahead = months_ahead
+        self.retention_days = retention_days
+        self.task = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            interval=float(os.getenv("PARTITION_CHECK_INTERVAL", "3600")),
+            months_ahead=int(os.getenv("PARTITION_MONTHS_AHEAD", "2")),
+            # 0 keeps every ping
+            retention_days=int(os.getenv("PING_RETENTION_DAYS", "0")),
+        )
+
+    async def maintain(self, dry_run=False):
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                if not dry_run:
+                    await ensure_partitions(connection, control, self.months_ahead)
+                if self.retention_days > 0:
+                    await drop_expired(connection, control, self.retention_days, dry_run)
+
+    async def start(self):
+        # Partitions for this month and the next exist before the first ping arrives
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await ensure_partitions(connection, control, self.months_ahead)
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.maintain()
+            except Exception:
+                logger.exception("Partition maintenance failed")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+async def start_maintainer():
+    global maintainer
+    maintainer = PartitionMaintainer.from_env()
+    await maintainer.start()
+
+async def stop_maintainer():
+    global maintainer
+    if maintainer is not None:
+        await maintainer.stop()
+        maintainer = None
+
+async def run(args):
+    await open_pool()
+    try:
+        await PartitionMaintainer.from_env().maintain(dry_run=args.dry_run)
+    finally:
+        await close_pool()
+
+def main():
+    load_dotenv('.env.local')
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="Report which months would be dropped")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Per (session, attendee) counters of in-range and total pings, kept in AttendanceScores so the
+attendance endpoints only read one row per session instead of scoring raw pings.
+
+Pings are counted as they are stored, against every session the attendee has joined whose window
+contains the ping. Once a session has ended only uploaded offline pings (uploads.py) can still
+fall inside its window, so its counters are final PING_BATCH_MAX_AGE seconds after it ends.
+Joining a session or changing its locations recomputes the affected rows from the raw pings with
+the attendance engine.
+
+python scores.py rebuild [--attendee ID] [--session ID]
+python scores.py check
+"""
+from attendance import RETAINED_SINCE, fetch_scores, stored_scores
+from db import get_connection, get_cursor, open_pool, close_pool
+from geofence import haversine_m
+from datetime import datetime
+from dotenv import load_dotenv
+from pytz import timezone
+import argparse
+import asyncio
+import metrics
+import sys
+
+# Every location of every session a ping falls inside, for sessions its attendee has joined
+PING_SESSIONS = """
+select p.idx, s.SessionID, p.uid, s.GeofenceRadius, sl.Latitude::float8, sl.Longitude::float8
+from unnest(%(ids)s::int[], %(times)s::timestamp[]) with ordinality p(uid, ts, idx)
+join Attended_By ab on ab.UniqueID=p.uid
+join Sessions s on s.SessionID=ab.SessionID and p.ts between s.StartTime and s.EndTime
+join SessionLocations sl on sl.SessionID=s.SessionID
+order by p.idx, s.SessionID;
+"""
+
+ADD_SCORE = """
+insert into AttendanceScores (SessionID, UniqueID, InRange, Total) values (%s, %s, %s, %s)
+on conflict (UniqueID, SessionID) do update
+set InRange=AttendanceScores.InRange+excluded.InRange, Total=AttendanceScores.Total+excluded.Total;
+"""
+
+INSERT_SCORE = "insert into AttendanceScores (SessionID, UniqueID, InRange, Total) values (%s, %s, %s, %s);"
+
+async def record_pings(control, pings):
+    """
+    Add (UniqueID, Latitude, Longitude, LocationTimestamp) pings to the counters of the sessions
+    they fall in. Runs in the caller's transaction so the counters commit with the pings.
+    Returns the (SessionID, UniqueID, inside, LocationTimestamp) verdicts in ping order.
+    """
+    if not pings:
+        return []
+    await control.execute(PING_SESSIONS, {"ids": [p[0] for p in pings], "times": [p[3] for p in pings]})
+    rows = await control.fetchall()
+
+    with metrics.timed("score_pings"):
+        # One verdict per (ping, session): inside if any of the session's locations is within radius
+        inside = {}
+        for idx, session_id, student_id, radius, location_lat, location_lon in rows:
+            key = (idx, session_id, student_id)
+            if inside.get(key):
+                continue
+            # Compare against the coordinates as AttendeesLocations stores them
+            ping = pings[idx - 1]
+            inside[key] = haversine_m(round(ping[1], 6), round(ping[2], 6), location_lat, location_lon) <= radius
+
+        deltas = {}
+        for (idx, session_id, student_id), hit in inside.items():
+            counts = deltas.setdefault((student_id, session_id), [0, 0])
+            counts[0] += hit
+            counts[1] += 1
+    # Sorted so concurrent batches lock the rows in the same order
+    await control.executemany(ADD_SCORE, [(session_id, student_id, in_range, total) for (student_id, session_id), (in_range, total) in sorted(deltas.items())])
+    return [(session_id, student_id, hit, pings[idx - 1][3]) for (idx, session_id, student_id), hit in inside.items()]
+
+async def rebuild_scores(control, student_id, session_id=None):
+    """
+    Recompute the attendee's counters from raw pings, for every session or just session_id.
+    Sessions whose pings were dropped by retention keep their counters.
+    """
+    scores = await fetch_scores(control, student_id, datetime.max, session_id=session_id)
+    await control.execute(
+        "delete from AttendanceScores where UniqueID=%s and (%s::int is null or SessionID=%s) "
+        "and SessionID in (select SessionID from Sessions where StartTime>=" + RETAINED_SINCE + ");",
+        (student_id, session_id, session_id)
+    )
+    if scores:
+        await control.executemany(INSERT_SCORE, [(sid, student_id, in_range, total) for sid, (in_range, total) in sorted(scores.items())])
+
+async def rebuild_session_scores(control, session_id):
+    await control.execute("select UniqueID from Attended_By where SessionID=%s order by UniqueID;", (session_id,))
+    for (student_id,) in await control.fetchall():
+        await rebuild_scores(control, student_id, session_id)
+
+async def attendee_ids(control, student_id=None, session_id=None):
+    await control.execute(
+        "select distinct UniqueID from Attended_By where (%s::int is null or UniqueID=%s) and (%s::int is null or SessionID=%s) order by UniqueID;",
+        (student_id, student_id, session_id, session_id)
+    )
+    return [row[0] for row in await control.fetchall()]
+
+async def rebuild(student_id=None, session_id=None):
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            students = await attendee_ids(control, student_id, session_id)
+            # One transaction per attendee keeps locks short while pings keep arriving
+            for student in students:
+                await rebuild_scores(control, student, session_id)
+                await connection.commit()
+    print(f"Rebuilt attendance scores for {len(students)} attendees")
+
+async def check():
+    """Compare the stored counters of ended sessions with a fresh computation from raw pings"""
+    time_now = datetime.now(timezone("Asia/Kolkata")).strftime('%Y-%m-%d %H:%M:%S')
+    mismatches = 0
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            # Nothing left to compare these with
+            await control.execute("select SessionID from Sessions where StartTime<" + RETAINED_SINCE + ";")
+            archived = {row[0] for row in await control.fetchall()}
+
+            students = await attendee_ids(control)
+            for student in students:
+                stored = await stored_scores(control, student, time_now)
+                stored = {sid: score for sid, score in stored.items() if sid not in archived}
+                live = await fetch_scores(control, student, time_now)
+                for session_id in sorted(stored.keys() | live.keys()):
+                    if stored.get(session_id) != live.get(session_id):
+                        mismatches += 1
+                        print(f"attendee {student} session {session_id}: stored {stored.get(session_id)} computed {live.get(session_id)}")
+    print(f"Checked {len(students)} attendees, {mismatches} mismatches")
+    return mismatches
+
+async def run(args):
+    await open_pool()
+    try:
+        if args.command == "rebuild":
+            await rebuild(args.attendee, args.session)
+            return 0
+        return 1 if await check() else 0
+    finally:
+        await close_pool()
+
+def main():
+    load_dotenv('.env.local')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = commands.add_parser("rebuild", help="Recompute stored scores from raw pings")
+    rebuild_parser.add_argument("--attendee", type=int)
+    rebuild_parser.add_argument("--session", type=int)
+    commands.add_parser("check", help="Report ended sessions whose stored scores differ from the raw pings")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Production entry point: uvicorn with one worker per available core, the database connection budget
+and the bcrypt processes split between the workers so that adding workers never asks Postgres for
+more than DB_CONNECTION_BUDGET connections or the machine for more than one bcrypt process per core.
+
+Settings come from the environment or .env.local and are handed to the workers through the
+environment, each worker opens its own pool on startup.
+
+python serve.py [--workers N] [--host 0.0.0.0] [--port 8000] [--dry-run]
+"""
+from dotenv import load_dotenv
+import argparse
+import math
+import os
+
+def available_cores():
+    """Cores this process may run on, within the CPU quota of its container if it has one"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        # cgroup v2, "max 100000" when there is no quota
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cores = min(cores, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+def worker_settings(workers, cores, budget):
+    """Environment for each worker: its share of the connection budget and of the cores for bcrypt"""
+    # LISTEN connections are opened outside the pool, one per worker for each postgres backend
+    listeners = sum(os.getenv(name, "local") == "postgres" for name in ("SESSION_CACHE_BACKEND", "PRESENCE_BACKEND"))
+    pool_max = budget // workers - listeners
+    if pool_max < 2:
+        raise SystemExit(f"DB_CONNECTION_BUDGET={budget} leaves fewer than 2 connections for each of {workers} workers")
+
+    # Explicit settings are kept as long as they fit in the worker's share
+    pool_max = min(pool_max, int(os.getenv("DB_POOL_MAX", pool_max)))
+    return {
+        "DB_POOL_MAX": str(pool_max),
+        "DB_POOL_MIN": str(min(pool_max, int(os.getenv("DB_POOL_MIN", "2")))),
+        "PASSWORD_WORKERS": str(min(max(1, cores // workers), int(os.getenv("PASSWORD_WORKERS", "0")) or cores)),
+    }
+
+def main():
+    load_dotenv(".env.local")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")) or None)
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--dry-run", action="store_true", help="Print the per worker settings and exit")
+    args = parser.parse_args()
+
+    cores = available_cores()
+    workers = args.workers or cores
+    settings = worker_settings(workers, cores, int(os.getenv("DB_CONNECTION_BUDGET", "80")))
+    print(f"{workers} workers on {cores} cores, each with " + ", ".join(f"{k}={v}" for k, v in settings.items()))
+    if args.dry_run:
+        return
+    os.environ.update(settings)
+
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        # In-flight requests get this long to finish on shutdown before the pools are drained
+        timeout_graceful_shutdown=int(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "20")),
+        proxy_headers=True,
+        access_log=os.getenv("ACCESS_LOG", "0") == "1",
+    )
+
+if __name__ == "__main__":
+    main()
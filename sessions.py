@@ -0,0 +1,194 @@
+from collections import namedtuple
+from db import get_connection, get_cursor
+from geofence import GeofenceIndex
+from datetime import datetime, timedelta
+from pytz import timezone
+import asyncio
+import logging
+import os
+import psycopg
+import time
+
+logger = logging.getLogger(__name__)
+
+# Workers publish the ids of sessions they changed here when SESSION_CACHE_BACKEND=postgres
+CHANNEL = "session_changes"
+
+SELECT_SESSIONS = """
+select s.SessionID, s.StartTime, s.EndTime, s.AdminID, s.GeofenceRadius, sl.Latitude, sl.Longitude
+from Sessions s
+left join SessionLocations sl on sl.SessionID=s.SessionID
+"""
+
+# Sessions running now or starting within the horizon
+WINDOW_SESSIONS = SELECT_SESSIONS + "where s.EndTime > %(now)s and s.StartTime <= %(until)s order by s.SessionID;"
+
+SESSIONS_BY_ID = SELECT_SESSIONS + "where s.SessionID = any(%(ids)s) order by s.SessionID;"
+
+# row is the session as /active-sessions returns it, id, times and admin followed by the
+# latitude and longitude of each location, built once per load instead of on every request
+ActiveSession = namedtuple("ActiveSession", ["session_id", "start_time", "end_time", "admin_id", "radius", "locations", "fence", "row"])
+
+# Set on startup
+registry = None
+
+def ist_now():
+    # Session times are stored as naive IST timestamps
+    return datetime.now(timezone("Asia/Kolkata")).replace(tzinfo=None)
+
+def group_sessions(rows):
+    sessions = {}
+    for session_id, start_time, end_time, admin_id, radius, latitude, longitude in rows:
+        if session_id not in sessions:
+            sessions[session_id] = (session_id, start_time, end_time, admin_id, radius, [])
+        if latitude is not None:
+            sessions[session_id][5].append((latitude, longitude))
+    return {
+        session_id: ActiveSession(
+            *row,
+            GeofenceIndex(row[5], row[4]) if row[5] else None,
+            row[:4] + tuple(float(value) for location in row[5] for value in location),
+        )
+        for session_id, row in sessions.items()
+    }
+
+class SessionRegistry:
+    """
+    Sessions that are running or start within horizon seconds, with their locations and
+    geofence, so /active-sessions and /join-session do not query Sessions and SessionLocations
+    on every request.
+
+    Sessions become active and expire by their own start and end times. The whole window is
+    reloaded every ttl seconds to pick up sessions entering the horizon. A session written by
+    create-session or add-locations is dropped and read again on the next lookup. With the
+    postgres backend the change is also sent over NOTIFY so other workers drop it as well.
+    """
+
+    def __init__(self, ttl=30.0, horizon=86400.0, backend="local"):
+        self.ttl = ttl
+        self.horizon = horizon
+        self.backend = backend
+        self.sessions = {}
+        self.stale = set()
+        self.loaded_at = None
+        self.lock = asyncio.Lock()
+        self.listener = None
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0, "invalidations": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl=float(os.getenv("SESSION_CACHE_TTL", "30")),
+            horizon=float(os.getenv("SESSION_CACHE_HORIZON", "86400")),
+            backend=os.getenv("SESSION_CACHE_BACKEND", "local"),
+        )
+
+    async def start(self):
+        await self.reload()
+        if self.backend == "postgres":
+            self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+
+    async def reload(self):
+        now = ist_now()
+        # Sessions invalidated while the query runs stay stale and are read again
+        covered = set(self.stale)
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute(WINDOW_SESSIONS, {"now": now, "until": now + timedelta(seconds=self.horizon)})
+                self.sessions = group_sessions(await control.fetchall())
+        self.stale -= covered
+        self.loaded_at = time.monotonic()
+        self.stats["reloads"] += 1
+
+    async def load(self, session_ids):
+        async with get_connection() as connection:
+            async with get_cursor(connection) as control:
+                await control.execute(SESSIONS_BY_ID, {"ids": list(session_ids)})
+                loaded = group_sessions(await control.fetchall())
+        for session_id in session_ids:
+            self.sessions.pop(session_id, None)
+        self.sessions.update(loaded)
+        self.stale.difference_update(session_ids)
+
+    async def refresh(self):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl and not self.stale:
+            return
+        async with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= self.ttl:
+                await self.reload()
+            elif self.stale:
+                await self.load(set(self.stale))
+
+    async def active(self, now=None):
+        """Sessions running at now, latest start first"""
+        await self.refresh()
+        now = now or ist_now()
+        self.stats["hits"] += 1
+        running = [s for s in self.sessions.values() if s.start_time <= now < s.end_time]
+        return sorted(running, key=lambda s: s.start_time, reverse=True)
+
+    async def known(self):
+        """Every cached session: running, starting within the horizon or read by id"""
+        await self.refresh()
+        return list(self.sessions.values())
+
+    async def get(self, session_id):
+        """The session, read from the database if it is outside the cached window, or None"""
+        await self.refresh()
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self.stats["hits"] += 1
+            return session
+
+        self.stats["misses"] += 1
+        async with self.lock:
+            await self.load({session_id})
+        return self.sessions.get(session_id)
+
+    def invalidate(self, session_id):
+        self.sessions.pop(session_id, None)
+        self.stale.add(session_id)
+        self.stats["invalidations"] += 1
+
+    async def publish(self, control, session_id):
+        """Tell the other workers, delivered when the caller's transaction commits"""
+        if self.backend == "postgres":
+            await control.execute("select pg_notify(%s, %s);", (CHANNEL, str(session_id)))
+
+    async def listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(os.getenv("SQL_URL"), autocommit=True) as connection:
+                    await connection.execute(f"LISTEN {CHANNEL};")
+                    # Changes made while we were not listening are picked up by a full reload
+                    self.loaded_at = None
+                    async for notify in connection.notifies():
+                        self.invalidate(int(notify.payload))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Session change listener lost its connection, reconnecting")
+                await asyncio.sleep(1)
+
+    def metrics(self):
+        return {"backend": self.backend, "cached": len(self.sessions), "stale": len(self.stale), **self.stats}
+
+async def start_registry():
+    global registry
+    registry = SessionRegistry.from_env()
+    await registry.start()
+
+async def stop_registry():
+    global registry
+    if registry is not None:
+        await registry.stop()
+        registry = None
@@ -0,0 +1,157 @@
+"""
+Batched ping uploads for phones that were offline. The app keeps pings in an outbox while it has
+no signal and uploads them later in one request, gzip or deflate compressed:
+
+{"device": "<install id>", "sent_at": <epoch seconds>, "pings": [[seq, epoch seconds, latitude, longitude], ...]}
+
+Sequence numbers count up per device. PingUploads keeps the highest one seen for each
+(attendee, device), locked for the duration of an upload, so a retried or replayed batch stores
+only the pings it did not store before. A device sends its batches in order, the next one after
+the previous was acknowledged, and drops every ping up to the acked_seq it gets back.
+
+The device clock has to be within PING_BATCH_MAX_SKEW seconds of the server's when it sends the
+batch, and each ping between PING_BATCH_MAX_AGE seconds old and sent_at. The pings are written in
+one INSERT together with the new high-water mark and scored like live pings. They are stored a row
+each: dwell.py only knows the sessions that are running now, not the ones a late ping falls in.
+"""
+from fastapi import HTTPException, status
+from pydantic import BaseModel, Field, ValidationError
+from bulk import describe
+from db import get_connection, get_cursor
+from scores import record_pings
+from sessions import ist_now
+from datetime import datetime
+from pytz import timezone
+from typing import List, Tuple
+import os
+import presence
+import reports
+import time
+import zlib
+
+IST = timezone("Asia/Kolkata")
+
+MAX_PINGS = int(os.getenv("PING_BATCH_MAX_PINGS", "5000"))
+MAX_BYTES = int(os.getenv("PING_BATCH_MAX_BYTES", "1048576"))
+MAX_SKEW = float(os.getenv("PING_BATCH_MAX_SKEW", "300"))
+MAX_AGE = float(os.getenv("PING_BATCH_MAX_AGE", "86400"))
+
+# Locks the device's row until commit, so uploads from one device are stored one after another
+LOCK_DEVICE = """
+insert into PingUploads (UniqueID, Device, LastSeq) values (%s, %s, -1)
+on conflict (UniqueID, Device) do update set UpdatedAt=now()
+returning LastSeq;
+"""
+
+STORE_BATCH = """
+with stored as (
+    insert into AttendeesLocations (UniqueID, Latitude, Longitude, LocationTimestamp)
+    select %(uid)s, p.latitude, p.longitude, p.ts
+    from unnest(%(latitudes)s::numeric[], %(longitudes)s::numeric[], %(times)s::timestamp[]) p(latitude, longitude, ts)
+    returning 1
+), mark as (
+    update PingUploads set LastSeq=greatest(LastSeq, %(last_seq)s), UpdatedAt=now()
+    where UniqueID=%(uid)s and Device=%(device)s
+)
+select count(*) from stored;
+"""
+
+DECODERS = {"gzip": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), "deflate": lambda: zlib.decompressobj()}
+
+stats = {"batches": 0, "stored": 0, "duplicates": 0, "rejected": 0}
+
+class PingBatch(BaseModel):
+    device: str = Field(..., min_length=1, max_length=64, description="Install id of the app")
+    sent_at: float = Field(..., description="Device clock when the batch was sent, epoch seconds")
+    pings: List[Tuple[int, float, float, float]] = Field(..., description="[seq, epoch seconds, latitude, longitude] per ping")
+
+async def read_body(stream, encoding):
+    """The request body decompressed, 413 once either side passes MAX_BYTES"""
+    encoding = (encoding or "identity").strip().lower()
+    if encoding != "identity" and encoding not in DECODERS:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Send gzip, deflate or uncompressed JSON")
+    decoder = DECODERS[encoding]() if encoding in DECODERS else None
+    received = 0
+    body = bytearray()
+    async for chunk in stream:
+        received += len(chunk)
+        if decoder is not None:
+            # Stops one byte past the limit, a zip bomb is never inflated further
+            chunk = decoder.decompress(chunk, MAX_BYTES + 1 - len(body))
+        body += chunk
+        if received > MAX_BYTES or len(body) > MAX_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Batches are limited to {MAX_BYTES} bytes")
+    return bytes(body)
+
+def parse(body):
+    try:
+        batch = PingBatch.model_validate_json(body)
+    except ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=describe(e))
+    if len(batch.pings) > MAX_PINGS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Batches are limited to {MAX_PINGS} pings")
+    return batch
+
+def check_clock(batch, now):
+    skew = batch.sent_at - now
+    if abs(skew) > MAX_SKEW:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Device clock is {skew:+.0f} seconds off, set it to network time")
+
+def screen(batch, last_seq, now):
+    """
+    (pings to store as (seq, latitude, longitude, IST timestamp) in sequence order, duplicates,
+    rejected as {seq, reason}) for a batch from a device whose pings up to last_seq are stored
+    """
+    fresh = {}
+    duplicates = 0
+    rejected = []
+    for seq, at, latitude, longitude in batch.pings:
+        if seq <= last_seq or seq in fresh:
+            duplicates += 1
+        elif not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            rejected.append({"seq": seq, "reason": "invalid_location"})
+        elif at > batch.sent_at + 1:
+            rejected.append({"seq": seq, "reason": "after_sent_at"})
+        elif at < now - MAX_AGE:
+            rejected.append({"seq": seq, "reason": "too_old"})
+        else:
+            # As AttendeesLocations stores them, so scoring sees the stored values
+            fresh[seq] = (seq, round(latitude, 6), round(longitude, 6), datetime.fromtimestamp(at, IST).replace(tzinfo=None))
+    return [fresh[seq] for seq in sorted(fresh)], duplicates, rejected
+
+async def store_batch(unique_id, batch):
+    now = time.time()
+    check_clock(batch, now)
+    async with get_connection() as connection:
+        async with get_cursor(connection) as control:
+            await control.execute(LOCK_DEVICE, (unique_id, batch.device))
+            last_seq = (await control.fetchone())[0]
+            pings, duplicates, rejected = screen(batch, last_seq, now)
+            # Rejected pings are acknowledged too, sending them again would not change the answer
+            acked_seq = max([last_seq] + [ping[0] for ping in batch.pings])
+            await control.execute(STORE_BATCH, {
+                "uid": unique_id,
+                "device": batch.device,
+                "last_seq": acked_seq,
+                "latitudes": [ping[1] for ping in pings],
+                "longitudes": [ping[2] for ping in pings],
+                "times": [ping[3] for ping in pings],
+            })
+            stored = (await control.fetchone())[0]
+            verdicts = await record_pings(control, [(unique_id, lat, lon, at) for _, lat, lon, at in pings])
+            # Pings from before an outage can land in sessions whose reports are already built
+            if verdicts:
+                await reports.invalidate_ended(control, {verdict[0] for verdict in verdicts}, ist_now())
+            events = presence.ping_events(verdicts)
+            await presence.broker.publish(control, events)
+            await connection.commit()
+    presence.broker.committed(events)
+
+    stats["batches"] += 1
+    stats["stored"] += stored
+    stats["duplicates"] += duplicates
+    stats["rejected"] += len(rejected)
+    return {"acked_seq": acked_seq, "stored": stored, "duplicates": duplicates, "rejected": rejected}
+
+def upload_metrics():
+    return {"max_pings": MAX_PINGS, "max_skew": MAX_SKEW, "max_age": MAX_AGE, **stats}